@@ -1,8 +1,6 @@
 import yaml
-import mysql.connector
 from logging import getLogger
 from logging.config import fileConfig
-from obonetx.ontology import Ontology
 import pathlib
 
 resource_dir = pathlib.Path(__file__).parent.joinpath('resource')
@@ -16,16 +14,24 @@ with open(resource_dir.joinpath('analysisConfig.yaml'), 'r') as yaml_file:
 
 base_dir = config['base_dir']
 hpo_obo_path = config['hp.obo.path']
-hpo = Ontology(hpo_obo_path)
 
-# set up MySql connection
-host = config['database']['host']
-user = config['database']['user']
-password = config['database']['password']
-database = config['database']['database']
 
-mydb = mysql.connector.connect(host=host,
-                               user=user,
-                               passwd=password,
-                               database=database,
-                               auth_plugin='mysql_native_password')
\ No newline at end of file
+def __getattr__(name):
+    """
+    Load the ontology (hpo) and set up the database connection (db, MySQL by default, see backend.connect) when they
+    are first used, e.g. by `from mimic_mf_analysis import db`, so that commands that need neither start without
+    loading obonetx or a database driver.
+    """
+    if name == 'hpo':
+        from obonetx.ontology import Ontology
+        value = Ontology(hpo_obo_path)
+    elif name == 'db':
+        from mimic_mf_analysis.backend import connect
+        value = connect(config['database'])
+    elif name == 'mydb':
+        # the raw connection, kept for code that talks to MySQL directly
+        value = __getattr__('db').connection
+    else:
+        raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+    globals()[name] = value
+    return value
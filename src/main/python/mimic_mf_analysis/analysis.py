@@ -1,16 +1,21 @@
 import numpy as np
-import pandas as pd
 import math
+import time
 import mutual_information.mf as mf
 import mutual_information.synergy_tree as synergy_tree
-from mimic_mf_analysis.preparation import encounterOfInterest, indexEncounterOfInterest, diagnosisProfile, rankICD, rankHpoFromLab, rankHpoFromText
+import mimic_mf_analysis.sparse_pairs as sparse_pairs
+import mimic_mf_analysis.dedup as dedup
+import mimic_mf_analysis.partials as partials
+import mimic_mf_analysis.encoding as encoding
+from mimic_mf_analysis.preparation import encounterOfInterest, indexEncounterOfInterest, diagnosisProfile, \
+    hpoDictionary, rankICD, rankHpoFromLab, rankHpoFromText
 from tqdm import tqdm
 
-from mimic_mf_analysis import mydb
-
-cursor = mydb.cursor(buffered=True)
+from mimic_mf_analysis import db
+import mimic_mf_analysis.metrics as metrics
 
 
+@metrics.timed()
 def createDiagnosisTable(diagnosis, primary_diagnosis_only):
     """
     Create a temporary table JAX_mf_diag. For encounters of interest, assign 0 or 1 to each encouter whether a diagnosis is observed.
@@ -18,33 +23,35 @@ def createDiagnosisTable(diagnosis, primary_diagnosis_only):
     @prarm primary_diagnosis_only: an encounter may be associated with one primary diagnosis and many secondary ones.
     if value is set true, only primary diagnosis counts.
     """
-    cursor.execute('DROP TEMPORARY TABLE IF EXISTS JAX_mf_diag')
+    db.drop_temp_table('JAX_mf_diag')
     if primary_diagnosis_only:
         limit = 'AND SEQ_NUM=1'
     else:
         limit = ''
-    cursor.execute('''
-                CREATE TEMPORARY TABLE IF NOT EXISTS JAX_mf_diag 
+    db.create_temp_table_as('JAX_mf_diag', '''
                 WITH 
                     d AS (
                         SELECT 
                             DISTINCT SUBJECT_ID, HADM_ID, '1' AS DIAGNOSIS
                         FROM 
                             JAX_diagnosisProfile 
-                        WHERE ICD9_CODE LIKE '{}%' {})
+                        WHERE ICD9_CODE LIKE ? {})
                     -- This is encounters with positive diagnosis
 
                 SELECT 
-                    DISTINCT a.SUBJECT_ID, a.HADM_ID, IF(d.DIAGNOSIS IS NULL, '0', '1') AS DIAGNOSIS
+                    DISTINCT a.SUBJECT_ID, a.HADM_ID, CASE WHEN d.DIAGNOSIS IS NULL THEN '0' ELSE '1' END AS DIAGNOSIS
                 FROM 
                     JAX_encounterOfInterest AS a
                 LEFT JOIN
                     d ON a.SUBJECT_ID = d.SUBJECT_ID AND a.HADM_ID = d.HADM_ID       
                 /* -- This is the first join for diagnosis (0, or 1) */    
-                '''.format(diagnosis, limit))
-    cursor.execute('CREATE INDEX JAX_mf_diag_idx01 ON JAX_mf_diag (SUBJECT_ID, HADM_ID)')
+                -- ROW_IDs follow this order, so every database replica numbers encounters the same way
+                ORDER BY a.SUBJECT_ID, a.HADM_ID
+                '''.format(limit), params=[diagnosis + '%'])
+    db.create_index('JAX_mf_diag_idx01', 'JAX_mf_diag', 'SUBJECT_ID, HADM_ID')
 
 
+@metrics.timed()
 def initTables(debug=False):
     """
     This combines LabHpo and Inferred_LabHpo, and combines TextHpo and Inferred_TextHpo.
@@ -53,6 +60,7 @@ def initTables(debug=False):
     """
     # init textHpoProfile and index it
     # I create perminant tables to save time; other users should enable them
+    # or keep persistent tables up to date with the refresh-profiles command (see profiles.py)
     # textHpoProfile(include_inferred=True, threshold=1)
     # indexTextHpoProfile()
     # init labHpoProfile and index it
@@ -64,10 +72,13 @@ def initTables(debug=False):
     indexEncounterOfInterest()
     # init diagnosisProfile
     diagnosisProfile()
+    # number HPO terms, see encoding.py
+    hpoDictionary()
 
 
+@metrics.timed()
 def indexDiagnosisTable():
-    cursor.execute("ALTER TABLE JAX_mf_diag ADD COLUMN ROW_ID INT AUTO_INCREMENT PRIMARY KEY;")
+    db.add_row_id('JAX_mf_diag')
 
 
 def batch_query(start_index,
@@ -80,6 +91,8 @@ def batch_query(start_index,
                 labHpo_threshold_max):
     """
     Queries databases in small batches, return diagnosis values, phenotypes from text data and phenotypes from lab data.
+    Phenotype rows hold the code of the phenotype (HPO_ID, see encoding.py) and its VALUE, phenotype by phenotype in
+    the order of the frequency rank table and encounter by encounter (ROW_ID) within a phenotype.
     @param start_index: minimum row_id
     @param end_index: maximum row_id
     @param textHpo_occurrance_min: minimum occurrances of a phenotype from text data for it to be called in one encounter
@@ -89,65 +102,68 @@ def batch_query(start_index,
     @param labHpo_threshold_min: minimum number of encounters of a phenotype from lab tests for it to be analyzed
     @param labHpo_threshold_max: maximum number of encounters of a phenotype from lab tests for it to be analyzed
     """
-    diagnosisVector = pd.read_sql_query('''
-        SELECT * FROM JAX_mf_diag WHERE ROW_ID BETWEEN {} AND {}
-    '''.format(start_index, end_index), mydb)
+    # the queries are prepared once and reused for every batch
+    diagnosisVector = db.prepare('''
+        SELECT * FROM JAX_mf_diag WHERE ROW_ID BETWEEN ? AND ? ORDER BY ROW_ID
+    ''').read([start_index, end_index])
 
-    textHpoFlat = pd.read_sql_query('''
+    textHpoFlat = db.prepare('''
         WITH encounters AS (
-            SELECT SUBJECT_ID, HADM_ID
+            SELECT SUBJECT_ID, HADM_ID, ROW_ID
             FROM JAX_mf_diag 
-            WHERE ROW_ID BETWEEN {} AND {}
+            WHERE ROW_ID BETWEEN ? AND ?
         ), 
         textHpoOfInterest AS (
-            SELECT MAP_TO 
+            SELECT MAP_TO, HPO_ID, N
             FROM JAX_textHpoFrequencyRank 
-            WHERE N BETWEEN {} AND {}
+            WHERE N BETWEEN ? AND ?
         ), 
         joint as (
             SELECT *
             FROM encounters 
-            JOIN textHpoOfInterest),
+            CROSS JOIN textHpoOfInterest),
         JAX_textHpoProfile_filtered AS (
             SELECT * 
             FROM JAX_textHpoProfile 
-            WHERE OCCURRANCE >= {}
+            WHERE OCCURRANCE >= ?
         )
 
-        SELECT L.SUBJECT_ID, L.HADM_ID, L.MAP_TO, IF(R.dummy IS NULL, 0, 1) AS VALUE
+        SELECT L.HPO_ID, CASE WHEN R.dummy IS NULL THEN 0 ELSE 1 END AS VALUE
         FROM joint as L
         LEFT JOIN 
         JAX_textHpoProfile_filtered AS R
-        ON L.SUBJECT_ID = R.SUBJECT_ID AND L.HADM_ID = R.HADM_ID AND L.MAP_TO = R.MAP_TO  
-    '''.format(start_index, end_index, textHpo_threshold_min, textHpo_threshold_max, textHpo_occurrance_min), mydb)
+        ON L.SUBJECT_ID = R.SUBJECT_ID AND L.HADM_ID = R.HADM_ID AND L.MAP_TO = R.MAP_TO
+        ORDER BY L.N DESC, L.HPO_ID, L.ROW_ID
+    ''').read([start_index, end_index, textHpo_threshold_min, textHpo_threshold_max, textHpo_occurrance_min])
 
-    labHpoFlat = pd.read_sql_query('''
+    labHpoFlat = db.prepare('''
         WITH encounters AS (
-            SELECT SUBJECT_ID, HADM_ID
+            SELECT SUBJECT_ID, HADM_ID, ROW_ID
             FROM JAX_mf_diag 
-            WHERE ROW_ID BETWEEN {} AND {}
+            WHERE ROW_ID BETWEEN ? AND ?
         ), 
         labHpoOfInterest AS (
-            SELECT MAP_TO 
+            SELECT MAP_TO, HPO_ID, N
             FROM JAX_labHpoFrequencyRank 
-            WHERE N BETWEEN {} AND {}
+            WHERE N BETWEEN ? AND ?
         ), 
         joint as (
             SELECT *
             FROM encounters 
-            JOIN labHpoOfInterest),
+            CROSS JOIN labHpoOfInterest),
         JAX_labHpoProfile_filtered AS (
             SELECT * 
             FROM JAX_labHpoProfile 
-            WHERE OCCURRANCE >= {}
+            WHERE OCCURRANCE >= ?
         )
 
-        SELECT L.SUBJECT_ID, L.HADM_ID, L.MAP_TO, IF(R.dummy IS NULL, 0, 1) AS VALUE
+        SELECT L.HPO_ID, CASE WHEN R.dummy IS NULL THEN 0 ELSE 1 END AS VALUE
         FROM joint as L
         LEFT JOIN 
         JAX_labHpoProfile_filtered AS R
         ON L.SUBJECT_ID = R.SUBJECT_ID AND L.HADM_ID = R.HADM_ID AND L.MAP_TO = R.MAP_TO
-    '''.format(start_index, end_index, labHpo_threshold_min, labHpo_threshold_max, labHpo_occurrance_min), mydb)
+        ORDER BY L.N DESC, L.HPO_ID, L.ROW_ID
+    ''').read([start_index, end_index, labHpo_threshold_min, labHpo_threshold_max, labHpo_occurrance_min])
 
     return diagnosisVector, textHpoFlat, labHpoFlat
 
@@ -161,7 +177,10 @@ def summarize_diagnosis_textHpo_labHpo(primary_diagnosis_only,
                                        labHpo_threshold_min,
                                        labHpo_threshold_max,
                                        disease_of_interest,
-                                       logger):
+                                       logger,
+                                       dedup_profiles=False,
+                                       shard=None,
+                                       vectors=None):
     """
     Iterate database to get summary statistics. For each disease of interest, automatically determine a list of phenotypes derived from labs (labHpo) and a list of phenotypes from text mining (textHpo). For each pair of phenotypes, count the number of encounters according to whether the phenotypes and diagnosis are observated.
     @param primary_diagnosis_only: only primary diagnosis is analyzed
@@ -173,6 +192,12 @@ def summarize_diagnosis_textHpo_labHpo(primary_diagnosis_only,
     @param labHpo_threshold_max: maximum number of encounters of a phenotype from lab tests for it to be analyzed
     @param disease_of_interest: either set to "calculated", or a list of ICD-9 codes (get all possible codes from temp table JAX_diagFrequencyRank)
     @param logger: logger for logging
+    @param dedup_profiles: compress encounters into unique (diagnosis, textHpo, labHpo) profiles with multiplicities
+    and count each unique profile once, weighted by its multiplicity
+    @param shard: a tuple (k, n) to count only the k-th of n contiguous ROW_ID ranges of encounters. The summaries of
+    all n shards add up to the summaries of all encounters (see partials.merge_shards).
+    @param vectors: a delta.EncounterVectors to keep the row of every encounter in, so that a later run can update the
+    summaries with only the encounters that changed
 
     :return: three dictionaries of summary statistics, of which the keys are diagnosis codes and the values are instances of the SummaryXYz class.
     First dictionary, X (a list of phenotype variables) are from textHpo and Y are from labHpo;
@@ -186,8 +211,8 @@ def summarize_diagnosis_textHpo_labHpo(primary_diagnosis_only,
     rankICD()
 
     if disease_of_interest == 'calculated':
-        diseaseOfInterest = pd.read_sql_query(
-            "SELECT * FROM JAX_diagFrequencyRank WHERE N > {}".format(diagnosis_threshold_min), mydb).ICD9_CODE.values
+        diseaseOfInterest = db.read_sql(
+            "SELECT * FROM JAX_diagFrequencyRank WHERE N > ?", [diagnosis_threshold_min]).ICD9_CODE.values
     elif isinstance(disease_of_interest, list) and len(disease_of_interest) > 0:
         # disable the following line to analyze all diseases of interest
         # diseaseOfInterest = ['428', '584', '038', '493']
@@ -203,6 +228,7 @@ def summarize_diagnosis_textHpo_labHpo(primary_diagnosis_only,
     pbar = tqdm(total=len(diseaseOfInterest))
     for diagnosis in diseaseOfInterest:
         logger.info("start analyzing disease {}".format(diagnosis))
+        diagnosis_start = time.perf_counter()
 
         logger.info(".......assigning values of diagnosis")
         # assign each encounter whether a diagnosis code is observed
@@ -215,39 +241,39 @@ def summarize_diagnosis_textHpo_labHpo(primary_diagnosis_only,
         rankHpoFromLab(diagnosis, labHpo_occurrance_min)
         logger.info("..............diagnosis values found")
 
-        textHpoOfInterest = pd.read_sql_query(
-            "SELECT * FROM JAX_textHpoFrequencyRank WHERE N BETWEEN {} AND {}".format(textHpo_threshold_min,
-                                                                                      textHpo_threshold_max),
-            mydb).MAP_TO.values
-        labHpoOfInterest = pd.read_sql_query(
-            "SELECT * FROM JAX_labHpoFrequencyRank WHERE N BETWEEN {} AND {}".format(labHpo_threshold_min,
-                                                                                     labHpo_threshold_max),
-            mydb).MAP_TO.values
+        textHpoCodes, textHpoOfInterest = encoding.panel('JAX_textHpoFrequencyRank', textHpo_threshold_min,
+                                                         textHpo_threshold_max)
+        labHpoCodes, labHpoOfInterest = encoding.panel('JAX_labHpoFrequencyRank', labHpo_threshold_min,
+                                                       labHpo_threshold_max)
         logger.info("TextHpo of interest established, size: {}".format(len(textHpoOfInterest)))
         logger.info("LabHpo of interest established, size: {}".format(len(labHpoOfInterest)))
 
         ## find the start and end ROW_ID for patient*encounter
         ADM_ID_START, ADM_ID_END = \
-        pd.read_sql_query('SELECT MIN(ROW_ID) AS min, MAX(ROW_ID) AS max FROM JAX_mf_diag', mydb).iloc[0]
+            db.read_sql('SELECT MIN(ROW_ID) AS min, MAX(ROW_ID) AS max FROM JAX_mf_diag').iloc[0]
+        if shard is not None:
+            ADM_ID_START, ADM_ID_END = partials.shard_range(ADM_ID_START, ADM_ID_END, shard)
+            logger.info('shard {}/{}: ROW_ID {} to {}'.format(shard[0], shard[1], ADM_ID_START, ADM_ID_END))
         batch_N = ADM_ID_END - ADM_ID_START + 1
         TOTAL_BATCH = math.ceil(batch_N / batch_size)  # total number of batches
 
         summaries_diag_textHpo_labHpo[diagnosis] = mf.SummaryXYz(textHpoOfInterest, labHpoOfInterest, diagnosis)
         summaries_diag_textHpo_textHpo[diagnosis] = mf.SummaryXYz(textHpoOfInterest, textHpoOfInterest, diagnosis)
         summaries_diag_labHpo_labHpo[diagnosis] = mf.SummaryXYz(labHpoOfInterest, labHpoOfInterest, diagnosis)
+        if dedup_profiles:
+            profiles = dedup.ProfileCounter(len(textHpoOfInterest), len(labHpoOfInterest))
 
         logger.info('starting batch queries for {}'.format(diagnosis))
         for i in np.arange(TOTAL_BATCH):
             start_index = i * batch_size + ADM_ID_START
-            if i < TOTAL_BATCH - 1:
-                end_index = start_index + batch_size - 1
-            else:
-                end_index = batch_N
+            end_index = min(start_index + batch_size - 1, ADM_ID_END)
 
-            diagnosisFlat, textHpoFlat, labHpoFlat = batch_query(start_index, end_index, textHpo_occurrance_min,
-                                                                 labHpo_occurrance_min, textHpo_threshold_min,
-                                                                 textHpo_threshold_max, labHpo_threshold_min,
-                                                                 labHpo_threshold_max)
+            with metrics.timer('batch_query', diagnosis=diagnosis) as event:
+                diagnosisFlat, textHpoFlat, labHpoFlat = batch_query(start_index, end_index, textHpo_occurrance_min,
+                                                                     labHpo_occurrance_min, textHpo_threshold_min,
+                                                                     textHpo_threshold_max, labHpo_threshold_min,
+                                                                     labHpo_threshold_max)
+                event['rows'] = len(diagnosisFlat)
 
             batch_size_actual = len(diagnosisFlat)
             textHpoOfInterest_size = len(textHpoOfInterest)
@@ -257,28 +283,45 @@ def summarize_diagnosis_textHpo_labHpo(primary_diagnosis_only,
             assert (len(labHpoFlat) == batch_size_actual * labHpoOfInterest_size)
 
             if batch_size_actual > 0:
-                diagnosisVector = diagnosisFlat.DIAGNOSIS.values.astype(int)
-                # reformat the flat vector into N x M matrix, N is batch size, i.e. number of encounters, M is the length of HPO terms
-                textHpoMatrix = textHpoFlat.VALUE.values.astype(int).reshape(
-                    [batch_size_actual, textHpoOfInterest_size], order='F')
-                labHpoMatrix = labHpoFlat.VALUE.values.astype(int).reshape([batch_size_actual, labHpoOfInterest_size],
-                                                                           order='F')
-                # check the matrix formatting is correct
-                # disable the following 4 lines to speed things up
-                textHpoLabelsMatrix = textHpoFlat.MAP_TO.values.reshape([batch_size_actual, textHpoOfInterest_size],
-                                                                        order='F')
-                labHpoLabelsMatrix = labHpoFlat.MAP_TO.values.reshape([batch_size_actual, labHpoOfInterest_size],
-                                                                      order='F')
-                assert (textHpoLabelsMatrix[0, :] == textHpoOfInterest).all()
-                assert (labHpoLabelsMatrix[0, :] == labHpoOfInterest).all()
+                with metrics.timer('reshape', diagnosis=diagnosis) as event:
+                    diagnosisVector = diagnosisFlat.DIAGNOSIS.values.astype(int)
+                    # reformat the flat vector into N x M matrix, N is batch size, i.e. number of encounters,
+                    # M is the length of HPO terms
+                    textHpoMatrix = textHpoFlat.VALUE.values.astype(int).reshape(
+                        [batch_size_actual, textHpoOfInterest_size], order='F')
+                    labHpoMatrix = labHpoFlat.VALUE.values.astype(int).reshape(
+                        [batch_size_actual, labHpoOfInterest_size], order='F')
+                    # check the matrix formatting is correct, on integer codes
+                    encoding.check_panel(textHpoCodes, textHpoFlat.HPO_ID.values, batch_size_actual)
+                    encoding.check_panel(labHpoCodes, labHpoFlat.HPO_ID.values, batch_size_actual)
+                    event['rows'] = batch_size_actual
                 if i % 100 == 0:
                     logger.info(
                         'new batch: start_index={}, end_index={}, batch_size= {}, textHpo_size = {}, labHpo_size = {}'.format(
                             start_index, end_index, batch_size_actual, textHpoMatrix.shape[1], labHpoMatrix.shape[1]))
-                summaries_diag_textHpo_labHpo[diagnosis].add_batch(textHpoMatrix, labHpoMatrix, diagnosisVector)
-                summaries_diag_textHpo_textHpo[diagnosis].add_batch(textHpoMatrix, textHpoMatrix, diagnosisVector)
-                summaries_diag_labHpo_labHpo[diagnosis].add_batch(labHpoMatrix, labHpoMatrix, diagnosisVector)
-
+                with metrics.timer('add_batch', diagnosis=diagnosis) as event:
+                    if dedup_profiles:
+                        profiles.add_batch(textHpoMatrix, labHpoMatrix, diagnosisVector)
+                    else:
+                        summaries_diag_textHpo_labHpo[diagnosis].add_batch(textHpoMatrix, labHpoMatrix,
+                                                                           diagnosisVector)
+                        summaries_diag_textHpo_textHpo[diagnosis].add_batch(textHpoMatrix, textHpoMatrix,
+                                                                            diagnosisVector)
+                        summaries_diag_labHpo_labHpo[diagnosis].add_batch(labHpoMatrix, labHpoMatrix, diagnosisVector)
+                    event['rows'] = batch_size_actual
+                if vectors is not None:
+                    vectors.add(diagnosis, diagnosisFlat.HADM_ID.values, textHpoMatrix, labHpoMatrix, diagnosisVector)
+
+        if dedup_profiles:
+            d, textHpo, labHpo, weights = profiles.profiles()
+            logger.info('{} encounters compressed into {} unique profiles'.format(profiles.N, len(weights)))
+            dedup.add_weighted(summaries_diag_textHpo_labHpo[diagnosis], textHpo, labHpo, d, weights)
+            dedup.add_weighted(summaries_diag_textHpo_textHpo[diagnosis], textHpo, textHpo, d, weights)
+            dedup.add_weighted(summaries_diag_labHpo_labHpo[diagnosis], labHpo, labHpo, d, weights)
+
+        # throughput of the diagnosis, in encounters per second
+        metrics.record('diagnosis', time.perf_counter() - diagnosis_start, rows=batch_N,
+                       labels={'diagnosis': diagnosis})
         pbar.update(1)
 
     pbar.close()
@@ -286,17 +329,124 @@ def summarize_diagnosis_textHpo_labHpo(primary_diagnosis_only,
     return summaries_diag_textHpo_labHpo, summaries_diag_textHpo_textHpo, summaries_diag_labHpo_labHpo
 
 
+def batch_query_positive(start_index, end_index, profile_table, rank_table, occurrance_min, threshold_min,
+                         threshold_max):
+    """
+    Query only the positive phenotype calls of encounters in a ROW_ID range, instead of the full encounter *
+    phenotype grid that batch_query() returns.
+    @param profile_table: JAX_textHpoProfile or JAX_labHpoProfile
+    @param rank_table: JAX_textHpoFrequencyRank or JAX_labHpoFrequencyRank
+    :return: a data frame of ROW_ID, HPO_ID
+    """
+    return db.prepare('''
+        SELECT D.ROW_ID, R.HPO_ID
+        FROM JAX_mf_diag AS D
+        JOIN {} AS P
+        ON D.SUBJECT_ID = P.SUBJECT_ID AND D.HADM_ID = P.HADM_ID
+        JOIN {} AS R
+        ON P.MAP_TO = R.MAP_TO
+        WHERE D.ROW_ID BETWEEN ? AND ? AND P.OCCURRANCE >= ? AND R.N BETWEEN ? AND ?
+    '''.format(profile_table, rank_table)).read([start_index, end_index, occurrance_min, threshold_min, threshold_max])
+
+
+def summarize_diagnosis_sparse(primary_diagnosis_only,
+                               textHpo_occurrance_min,
+                               labHpo_occurrance_min,
+                               textHpo_threshold_min,
+                               textHpo_threshold_max,
+                               labHpo_threshold_min,
+                               labHpo_threshold_max,
+                               disease_of_interest,
+                               min_support,
+                               logger,
+                               batch_size=10000):
+    """
+    Sparse version of summarize_diagnosis_textHpo_labHpo() for large phenotype panels, e.g. with low thresholds to
+    include rare phenotypes. Only positive phenotype calls are queried, co-occurrences are counted with sparse matrix
+    products, and only pairs that co-occur in at least min_support encounters are kept.
+    @param disease_of_interest: a list of ICD-9 codes
+    @param min_support: minimum number of encounters with both phenotypes for a pair to be kept
+    @param batch_size: number of encounters per query. Queries only return positive calls, so batches can be large.
+    Other parameters are the same as in summarize_diagnosis_textHpo_labHpo().
+    :return: three dictionaries from diagnosis code to instances of SparseSummaryXYz: textHpo * labHpo,
+    textHpo * textHpo and labHpo * labHpo
+    """
+    rankICD()
+    summaries_diag_textHpo_labHpo = {}
+    summaries_diag_textHpo_textHpo = {}
+    summaries_diag_labHpo_labHpo = {}
+
+    for diagnosis in tqdm(disease_of_interest):
+        logger.info("start analyzing disease {}".format(diagnosis))
+        diagnosis_start = time.perf_counter()
+        createDiagnosisTable(diagnosis, primary_diagnosis_only)
+        indexDiagnosisTable()
+        rankHpoFromText(diagnosis, textHpo_occurrance_min)
+        rankHpoFromLab(diagnosis, labHpo_occurrance_min)
+
+        textHpoCodes, textHpoOfInterest = encoding.panel('JAX_textHpoFrequencyRank', textHpo_threshold_min,
+                                                         textHpo_threshold_max)
+        labHpoCodes, labHpoOfInterest = encoding.panel('JAX_labHpoFrequencyRank', labHpo_threshold_min,
+                                                       labHpo_threshold_max)
+        logger.info("TextHpo of interest established, size: {}".format(len(textHpoOfInterest)))
+        logger.info("LabHpo of interest established, size: {}".format(len(labHpoOfInterest)))
+        textHpo_index = encoding.column_index(textHpoCodes)
+        labHpo_index = encoding.column_index(labHpoCodes)
+
+        summaries_diag_textHpo_labHpo[diagnosis] = sparse_pairs.SparseSummaryXYz(textHpoOfInterest,
+                                                                                 labHpoOfInterest, diagnosis)
+        summaries_diag_textHpo_textHpo[diagnosis] = sparse_pairs.SparseSummaryXYz(textHpoOfInterest,
+                                                                                  textHpoOfInterest, diagnosis)
+        summaries_diag_labHpo_labHpo[diagnosis] = sparse_pairs.SparseSummaryXYz(labHpoOfInterest,
+                                                                                labHpoOfInterest, diagnosis)
+
+        ADM_ID_START, ADM_ID_END = \
+            db.read_sql('SELECT MIN(ROW_ID) AS min, MAX(ROW_ID) AS max FROM JAX_mf_diag').iloc[0]
+        for start_index in range(ADM_ID_START, ADM_ID_END + 1, batch_size):
+            end_index = min(start_index + batch_size - 1, ADM_ID_END)
+            diagnosisFlat = db.prepare(
+                'SELECT ROW_ID, DIAGNOSIS FROM JAX_mf_diag WHERE ROW_ID BETWEEN ? AND ?').read([start_index, end_index])
+            if len(diagnosisFlat) == 0:
+                continue
+            textHpoFlat = batch_query_positive(start_index, end_index, 'JAX_textHpoProfile',
+                                               'JAX_textHpoFrequencyRank', textHpo_occurrance_min,
+                                               textHpo_threshold_min, textHpo_threshold_max)
+            labHpoFlat = batch_query_positive(start_index, end_index, 'JAX_labHpoProfile', 'JAX_labHpoFrequencyRank',
+                                              labHpo_occurrance_min, labHpo_threshold_min, labHpo_threshold_max)
+            # rows of the matrices are ROW_IDs of the batch; keep the ones that exist
+            present = diagnosisFlat.ROW_ID.values - start_index
+            diagnosisVector = diagnosisFlat.DIAGNOSIS.values.astype(int)
+            textHpoMatrix = sparse_pairs.positive_matrix(textHpoFlat.ROW_ID.values, textHpoFlat.HPO_ID.values,
+                                                         start_index, end_index, textHpo_index)[present]
+            labHpoMatrix = sparse_pairs.positive_matrix(labHpoFlat.ROW_ID.values, labHpoFlat.HPO_ID.values,
+                                                        start_index, end_index, labHpo_index)[present]
+            summaries_diag_textHpo_labHpo[diagnosis].add_batch(textHpoMatrix, labHpoMatrix, diagnosisVector)
+            summaries_diag_textHpo_textHpo[diagnosis].add_batch(textHpoMatrix, textHpoMatrix, diagnosisVector)
+            summaries_diag_labHpo_labHpo[diagnosis].add_batch(labHpoMatrix, labHpoMatrix, diagnosisVector)
+
+        for summaries in [summaries_diag_textHpo_labHpo, summaries_diag_textHpo_textHpo,
+                          summaries_diag_labHpo_labHpo]:
+            summaries[diagnosis].prune(min_support)
+        metrics.record('diagnosis', time.perf_counter() - diagnosis_start, rows=ADM_ID_END - ADM_ID_START + 1,
+                       labels={'diagnosis': diagnosis})
+        logger.info('{}: {} textHpo * labHpo pairs with support >= {}'.format(
+            diagnosis, summaries_diag_textHpo_labHpo[diagnosis].n_xy.nnz, min_support))
+
+    return summaries_diag_textHpo_labHpo, summaries_diag_textHpo_textHpo, summaries_diag_labHpo_labHpo
+
+
+@metrics.timed()
 def add_diag_columns(diagnosis, primary_diagnosis_only):
     createDiagnosisTable(diagnosis, primary_diagnosis_only)
     # copy into a new table Jax_multivariant_synergy_table(SUBJECT_ID, HADM_ID, DIAGNOSIS)
-    cursor.execute("""
-        CREATE TEMPORARY TABLE IF NOT EXISTS Jax_multivariant_synergy_table AS (
+    db.create_temp_table_as('Jax_multivariant_synergy_table', """
             SELECT * 
             FROM JAX_mf_diag
-        )""")
-    cursor.execute('CREATE INDEX Jax_multivariant_synergy_table_idx01 ON JAX_mf_diag (SUBJECT_ID, HADM_ID)')
+        """)
+    db.create_index('Jax_multivariant_synergy_table_idx01', 'Jax_multivariant_synergy_table', 'SUBJECT_ID, HADM_ID')
 
 
+@metrics.timed()
 def add_phenotype_columns(labHpos, textHpos, labHpo_threshold_min, textHpo_threshold_min):
     # save the variable transformation for later use
     var_dict = {}
@@ -305,31 +455,33 @@ def add_phenotype_columns(labHpos, textHpos, labHpo_threshold_min, textHpo_thres
         i = i + 1
         colName = 'V' + str(i)
         var_dict[colName] = ('LabHpo', labHpo)
-        cursor.execute("""
+        db.execute("""
             ALTER TABLE Jax_multivariant_synergy_table ADD COLUMN {} INT DEFAULT 0""".format(colName))
-        cursor.execute("""
+        db.execute("""
             UPDATE Jax_multivariant_synergy_table 
-            LEFT JOIN JAX_labHpoProfile 
-            ON Jax_multivariant_synergy_table.SUBJECT_ID = JAX_labHpoProfile.SUBJECT_ID AND 
-            Jax_multivariant_synergy_table.HADM_ID = JAX_labHpoProfile.HADM_ID
-            SET {} = IF(JAX_labHpoProfile.OCCURRANCE > {}, 1, 0)
-            WHERE JAX_labHpoProfile.MAP_TO = '{}'
-        """.format(colName, labHpo_threshold_min, labHpo))
+            SET {} = CASE WHEN EXISTS (
+                SELECT 1
+                FROM JAX_labHpoProfile
+                WHERE JAX_labHpoProfile.SUBJECT_ID = Jax_multivariant_synergy_table.SUBJECT_ID AND
+                JAX_labHpoProfile.HADM_ID = Jax_multivariant_synergy_table.HADM_ID AND
+                JAX_labHpoProfile.MAP_TO = ? AND JAX_labHpoProfile.OCCURRANCE > ?) THEN 1 ELSE 0 END
+        """.format(colName), [labHpo, labHpo_threshold_min])
 
     for textHpo in textHpos:
         i = i + 1
         colName = 'V' + str(i)
         var_dict[colName] = ('TextHpo', textHpo)
-        cursor.execute("""
+        db.execute("""
             ALTER TABLE Jax_multivariant_synergy_table ADD COLUMN {} INT DEFAULT 0""".format(colName))
-        cursor.execute("""
+        db.execute("""
             UPDATE Jax_multivariant_synergy_table 
-            LEFT JOIN JAX_textHpoProfile 
-            ON Jax_multivariant_synergy_table.SUBJECT_ID = JAX_textHpoProfile.SUBJECT_ID AND 
-            Jax_multivariant_synergy_table.HADM_ID = JAX_textHpoProfile.HADM_ID
-            SET {} = IF(JAX_textHpoProfile.OCCURRANCE > {}, 1, 0)
-            WHERE JAX_textHpoProfile.MAP_TO = '{}'
-        """.format(colName, textHpo_threshold_min, textHpo))
+            SET {} = CASE WHEN EXISTS (
+                SELECT 1
+                FROM JAX_textHpoProfile
+                WHERE JAX_textHpoProfile.SUBJECT_ID = Jax_multivariant_synergy_table.SUBJECT_ID AND
+                JAX_textHpoProfile.HADM_ID = Jax_multivariant_synergy_table.HADM_ID AND
+                JAX_textHpoProfile.MAP_TO = ? AND JAX_textHpoProfile.OCCURRANCE > ?) THEN 1 ELSE 0 END
+        """.format(colName), [textHpo, textHpo_threshold_min])
     return var_dict
 
 
@@ -337,14 +489,14 @@ def precompute_mf(variables):
     """
     Compute the mutual information between the joint distribution of all the variables and the medical outcome
     """
-    summary_counts = pd.read_sql_query("""
+    summary_counts = db.read_sql("""
         WITH summary AS (
         SELECT {}, DIAGNOSIS, COUNT(*) AS N
         FROM Jax_multivariant_synergy_table
         GROUP BY {}, DIAGNOSIS)
         SELECT *, SUM(N) OVER (PARTITION BY {}) AS V, SUM(N) OVER (PARTITION BY DIAGNOSIS) AS D
         FROM summary
-    """.format(','.join(variables), ','.join(variables), ','.join(variables)), mydb)
+    """.format(','.join(variables), ','.join(variables), ','.join(variables)))
     total = np.sum(summary_counts.N)
     p = summary_counts.N / total
     p_V = summary_counts.V / total
@@ -353,6 +505,7 @@ def precompute_mf(variables):
     return mf, summary_counts
 
 
+@metrics.timed()
 def precompute_mf_dict(var_ids):
     var_subsets = synergy_tree.subsets(var_ids, include_self=True)
     mf_dict = {}
@@ -375,74 +528,85 @@ def precompute_mf_dict(var_ids):
 
 def batch_query_lab_text(start_index, end_index, textHpo_occurrance_min, labHpo_occurrance_min, textHpo_min,
                          textHpo_max, labHpo_min, labHpo_max):
-    textHpo_flat = pd.read_sql_query('''
+    textHpo_flat = db.prepare('''
         WITH encounters AS (
                 SELECT *
                 FROM JAX_encounterOfInterest
-                WHERE ROW_ID BETWEEN {} AND {}),
+                WHERE ROW_ID BETWEEN ? AND ?),
             phenotypes AS (
-                SELECT MAP_TO
+                SELECT MAP_TO, HPO_ID, N
                 FROM JAX_textHpoFrequencyRank
-                WHERE N BETWEEN {} AND {}
+                WHERE N BETWEEN ? AND ?
             ), 
             temp AS (
                 SELECT * 
                 FROM encounters 
-                JOIN phenotypes)
+                CROSS JOIN phenotypes)
 
-            SELECT L.SUBJECT_ID, L.HADM_ID, L.MAP_TO AS PHEN_TEXT, IF(R.dummy IS NULL, 0, 1) AS PHEN_TEXT_VALUE
+            SELECT L.HPO_ID AS PHEN_TEXT,
+                CASE WHEN R.dummy IS NULL THEN 0 ELSE 1 END AS PHEN_TEXT_VALUE
             FROM temp AS L
             LEFT JOIN 
-                (SELECT * FROM JAX_textHpoProfile WHERE OCCURRANCE >= {}) AS R
+                (SELECT * FROM JAX_textHpoProfile WHERE OCCURRANCE >= ?) AS R
             ON L.SUBJECT_ID = R.SUBJECT_ID AND L.HADM_ID = R.HADM_ID AND L.MAP_TO = R.MAP_TO
-        '''.format(start_index, end_index, textHpo_min, textHpo_max, textHpo_occurrance_min), mydb)
+        ORDER BY L.N DESC, L.HPO_ID, L.ROW_ID
+        ''').read([start_index, end_index, textHpo_min, textHpo_max, textHpo_occurrance_min])
 
-    labHpo_flat = pd.read_sql_query('''
+    labHpo_flat = db.prepare('''
         WITH encounters AS (
                 SELECT *
                 FROM JAX_encounterOfInterest
-                WHERE ROW_ID BETWEEN {} AND {}),
+                WHERE ROW_ID BETWEEN ? AND ?),
             phenotypes AS (
-                SELECT MAP_TO
+                SELECT MAP_TO, HPO_ID, N
                 FROM JAX_labHpoFrequencyRank
-                WHERE N BETWEEN {} AND {}
+                WHERE N BETWEEN ? AND ?
             ), 
             temp AS (
                 SELECT * 
                 FROM encounters 
-                JOIN phenotypes)
+                CROSS JOIN phenotypes)
 
-            SELECT L.SUBJECT_ID, L.HADM_ID, L.MAP_TO AS PHEN_LAB, IF(R.dummy IS NULL, 0, 1) AS PHEN_LAB_VALUE
+            SELECT L.HPO_ID AS PHEN_LAB,
+                CASE WHEN R.dummy IS NULL THEN 0 ELSE 1 END AS PHEN_LAB_VALUE
             FROM temp AS L
             LEFT JOIN 
-                (SELECT * FROM JAX_labHpoProfile WHERE OCCURRANCE >= {}) AS R
+                (SELECT * FROM JAX_labHpoProfile WHERE OCCURRANCE >= ?) AS R
             ON L.SUBJECT_ID = R.SUBJECT_ID AND L.HADM_ID = R.HADM_ID AND L.MAP_TO = R.MAP_TO
-        '''.format(start_index, end_index, labHpo_min, labHpo_max, labHpo_occurrance_min), mydb)
+        ORDER BY L.N DESC, L.HPO_ID, L.ROW_ID
+        ''').read([start_index, end_index, labHpo_min, labHpo_max, labHpo_occurrance_min])
 
     return textHpo_flat, labHpo_flat
 
 
 def summary_textHpo_labHpo(batch_size, textHpo_occurrance_min, labHpo_occurrance_min, textHpo_threshold_min,
-                           textHpo_threshold_max, labHpo_threshold_min, labHpo_threshold_max):
-    textHpoOfInterest = pd.read_sql_query(
-        "SELECT * FROM JAX_textHpoFrequencyRank WHERE N BETWEEN {} AND {}".format(textHpo_threshold_min,
-                                                                                  textHpo_threshold_max),
-        mydb).MAP_TO.values
-    labHpoOfInterest = pd.read_sql_query(
-        "SELECT * FROM JAX_labHpoFrequencyRank WHERE N BETWEEN {} AND {}".format(labHpo_threshold_min,
-                                                                                 labHpo_threshold_max),
-        mydb).MAP_TO.values
+                           textHpo_threshold_max, labHpo_threshold_min, labHpo_threshold_max, dedup_profiles=False,
+                           shard=None, vectors=None):
+    """
+    Count the joint distribution of textHpo and labHpo pairs over all encounters of interest, regardless of diagnosis.
+    @param shard: a tuple (k, n) to count only the k-th of n contiguous ROW_ID ranges of encounters
+    @param vectors: a delta.EncounterVectors to keep the row of every encounter in, under the key 'all'
+    """
+    textHpoCodes, textHpoOfInterest = encoding.panel('JAX_textHpoFrequencyRank', textHpo_threshold_min,
+                                                     textHpo_threshold_max)
+    labHpoCodes, labHpoOfInterest = encoding.panel('JAX_labHpoFrequencyRank', labHpo_threshold_min,
+                                                   labHpo_threshold_max)
     M1 = len(textHpoOfInterest)
     M2 = len(labHpoOfInterest)
 
     summary_rad_lab = mf.SummaryXY(textHpoOfInterest, labHpoOfInterest)
     summary_rad_rad = mf.SummaryXY(textHpoOfInterest, textHpoOfInterest)
     summary_lab_lab = mf.SummaryXY(labHpoOfInterest, labHpoOfInterest)
+    if dedup_profiles:
+        profiles = dedup.ProfileCounter(M1, M2)
 
     ## find the start and end ROW_ID for patient*encounter
 
     ADM_ID_START, ADM_ID_END = \
-    pd.read_sql_query('SELECT MIN(ROW_ID) AS min, MAX(ROW_ID) AS max FROM JAX_encounterOfInterest', mydb).iloc[0]
+        db.read_sql('SELECT MIN(ROW_ID) AS min, MAX(ROW_ID) AS max FROM JAX_encounterOfInterest').iloc[0]
+    if shard is not None:
+        ADM_ID_START, ADM_ID_END = partials.shard_range(ADM_ID_START, ADM_ID_END, shard)
+        print('shard {}/{}: ROW_ID {} to {}'.format(shard[0], shard[1], ADM_ID_START, ADM_ID_END))
     batch_N = ADM_ID_END - ADM_ID_START + 1
     TOTAL_BATCH = math.ceil(batch_N / batch_size)  # total number of batches
 
@@ -450,21 +614,40 @@ def summary_textHpo_labHpo(batch_size, textHpo_occurrance_min, labHpo_occurrance
     pbar = tqdm(total=TOTAL_BATCH)
     for i in np.arange(TOTAL_BATCH):
         start_index = i * batch_size + ADM_ID_START
-        if i < TOTAL_BATCH - 1:
-            end_index = start_index + batch_size - 1
-        else:
-            end_index = batch_N
+        end_index = min(start_index + batch_size - 1, ADM_ID_END)
         actual_batch_size = end_index - start_index + 1
-        textHpo, labHpo = batch_query_lab_text(start_index, end_index, textHpo_occurrance_min, labHpo_occurrance_min,
-                                               textHpo_threshold_min, textHpo_threshold_max, labHpo_threshold_min,
-                                               labHpo_threshold_max)
-        textHpo_matrix = textHpo.PHEN_TEXT_VALUE.values.astype(int).reshape([actual_batch_size, M1], order='F')
-        labHpo_matrix = labHpo.PHEN_LAB_VALUE.values.astype(int).reshape([actual_batch_size, M2], order='F')
-        summary_rad_lab.add_batch(textHpo_matrix, labHpo_matrix)
-        summary_rad_rad.add_batch(textHpo_matrix, textHpo_matrix)
-        summary_lab_lab.add_batch(labHpo_matrix, labHpo_matrix)
+        with metrics.timer('batch_query') as event:
+            textHpo, labHpo = batch_query_lab_text(start_index, end_index, textHpo_occurrance_min,
+                                                   labHpo_occurrance_min, textHpo_threshold_min, textHpo_threshold_max,
+                                                   labHpo_threshold_min, labHpo_threshold_max)
+            event['rows'] = actual_batch_size
+        with metrics.timer('reshape') as event:
+            textHpo_matrix = textHpo.PHEN_TEXT_VALUE.values.astype(int).reshape([actual_batch_size, M1], order='F')
+            labHpo_matrix = labHpo.PHEN_LAB_VALUE.values.astype(int).reshape([actual_batch_size, M2], order='F')
+            encoding.check_panel(textHpoCodes, textHpo.PHEN_TEXT.values, actual_batch_size)
+            encoding.check_panel(labHpoCodes, labHpo.PHEN_LAB.values, actual_batch_size)
+            event['rows'] = actual_batch_size
+        with metrics.timer('add_batch') as event:
+            if dedup_profiles:
+                profiles.add_batch(textHpo_matrix, labHpo_matrix)
+            else:
+                summary_rad_lab.add_batch(textHpo_matrix, labHpo_matrix)
+                summary_rad_rad.add_batch(textHpo_matrix, textHpo_matrix)
+                summary_lab_lab.add_batch(labHpo_matrix, labHpo_matrix)
+            event['rows'] = actual_batch_size
+        if vectors is not None:
+            hadm_ids = db.prepare('SELECT HADM_ID FROM JAX_encounterOfInterest WHERE ROW_ID BETWEEN ? AND ? '
+                                  'ORDER BY ROW_ID').read([start_index, end_index]).HADM_ID.values
+            vectors.add('all', hadm_ids, textHpo_matrix, labHpo_matrix)
         pbar.update(1)
 
     pbar.close()
 
+    if dedup_profiles:
+        _, textHpo_matrix, labHpo_matrix, weights = profiles.profiles()
+        print('{} encounters compressed into {} unique profiles'.format(profiles.N, len(weights)))
+        dedup.add_weighted(summary_rad_lab, textHpo_matrix, labHpo_matrix, None, weights)
+        dedup.add_weighted(summary_rad_rad, textHpo_matrix, textHpo_matrix, None, weights)
+        dedup.add_weighted(summary_lab_lab, labHpo_matrix, labHpo_matrix, None, weights)
+
     return summary_rad_lab, summary_rad_rad, summary_lab_lab
\ No newline at end of file
@@ -0,0 +1,84 @@
+import numpy as np
+import math
+import mimic_mf_analysis.simulation as simulation
+
+# degrees of freedom of 2 * N * ln(2) * statistic under the simulation null, i.e. phenotypes and diagnosis are
+# mutually independent
+DEGREES_OF_FREEDOM = {'mf_Xz': 1,
+                      'mf_Yz': 1,
+                      'mf_XY_omit_z': 1,
+                      # XY has 4 levels, z has 2
+                      'mf_XY_z': 3,
+                      # one degree of freedom per diagnosis stratum
+                      'mf_XY_given_z': 2,
+                      # synergy = I(Y;z|X) - I(Y;z): the heterogeneity of the Y-z association across the two strata
+                      # of X, which is asymptotically chi-square with 1 degree of freedom under independence
+                      'synergy': 1}
+
+_erfc = np.vectorize(math.erfc, otypes=[float])
+
+
+def chi2_sf(x, df):
+    """
+    Survival function of the chi-square distribution with 1, 2 or 3 degrees of freedom, in closed form.
+    """
+    x = np.maximum(np.asarray(x, dtype=float), 0)
+    if df == 1:
+        return _erfc(np.sqrt(x / 2))
+    elif df == 2:
+        return np.exp(-x / 2)
+    elif df == 3:
+        return _erfc(np.sqrt(x / 2)) + np.sqrt(2 * x / np.pi) * np.exp(-x / 2)
+    else:
+        raise ValueError('unsupported degrees of freedom: {}'.format(df))
+
+
+def min_expected_counts(summary):
+    """
+    Smallest expected cell count under independence, for each phenotype and each phenotype pair.
+    @param summary: an instance of SummaryXYz
+    :return: a dictionary with the smallest expected count of the x*z tables ('set1', size M1), the y*z tables
+    ('set2', size M2) and the x*y*z tables ('pair', M1 x M2)
+    """
+    N = summary.case_N + summary.control_N
+    p_z = summary.case_N / N
+    p_x = np.sum(summary.m1['set1'][:, 0:2], axis=1) / N
+    p_y = np.sum(summary.m1['set2'][:, 0:2], axis=1) / N
+    smaller_z = min(p_z, 1 - p_z)
+    smaller_x = np.minimum(p_x, 1 - p_x)
+    smaller_y = np.minimum(p_y, 1 - p_y)
+    return {'set1': N * smaller_x * smaller_z,
+            'set2': N * smaller_y * smaller_z,
+            'pair': N * np.outer(smaller_x, smaller_y) * smaller_z}
+
+
+def analytic_p_values(summary, min_expected=5, alpha=0.05, margin=5):
+    """
+    Approximate p values of all statistics directly from the summary counts, without simulations. For mutual
+    information in bits, G = 2 * N * ln(2) * I is the likelihood ratio (G-test) statistic and is asymptotically
+    chi-square distributed under independence (see DEGREES_OF_FREEDOM), which is the null model of the simulations,
+    so the p values approximate right-tailed simulation p values. Synergy can be negative in finite samples; its
+    magnitude is compared against the chi-square distribution.
+    The approximation is unreliable when an expected cell count is small (Cochran's rule), and such pairs, together
+    with pairs whose approximate p value is within a factor of margin of alpha, are flagged for simulation.
+    @param summary: an instance of SummaryXYz
+    @param min_expected: smallest expected cell count for the approximation to be trusted
+    @param alpha: significance threshold
+    @param margin: p values in [alpha / margin, alpha * margin] are borderline
+    :return: a dictionary from statistic name to p values, like MutualInfoRandomizer.p_values(), plus
+    'reliable' (M1 x M2, the approximation can be trusted for the pair) and 'needs_simulation' (M1 x M2, unreliable
+    or borderline synergy)
+    """
+    N = summary.case_N + summary.control_N
+    observed = simulation.observed_statistics(summary)
+    p = dict()
+    for key, value in observed.items():
+        G = 2 * N * np.log(2) * np.asarray(value)
+        p[key] = chi2_sf(np.abs(G), DEGREES_OF_FREEDOM[key])
+
+    expected = min_expected_counts(summary)
+    reliable = expected['pair'] >= min_expected
+    borderline = (p['synergy'] >= alpha / margin) & (p['synergy'] <= alpha * margin)
+    p['reliable'] = reliable
+    p['needs_simulation'] = ~reliable | borderline
+    return p
@@ -1,28 +1,38 @@
 import click
-import numpy as np
-import pandas as pd
-from mutual_information.mf_random import MutualInfoRandomizer
-
-from mimic_mf_analysis import mydb
-import mimic_mf_analysis.analysis as analysis
 import logging
-from mutual_information.synergy_tree import SynergyTree
 import pathlib
-import yaml
-import pickle
 import os
-import glob
+import sys
+# the CLI imports what a command needs when the command runs, so that short invocations (e.g. --help, estimate or
+# array jobs of simulate) do not pay for numpy, pandas, mutual_information, the ontology or the database driver
+import mimic_mf_analysis.metrics as metrics
+import mimic_mf_analysis.diagnostics as diagnostics
 
 
 logger = logging.getLogger(__name__)
 
 
 @click.group()
-def cli():
-    pass
+@click.option("--metrics_jsonl", default=None, help="append the timing, row and byte counts of every stage and query "
+                                                    "to this JSON lines file")
+@click.option("--metrics_prom", default=None, help="write metric totals to this Prometheus textfile (*.prom) when the "
+                                                   "command finishes")
+@click.option("--explain_report", default=None, help="diagnostics mode: capture the plan of every distinct query "
+                                                     "template and write a JSON report of slow queries to this path")
+@click.option("--slow_query_seconds", default=1.0, help="in diagnostics mode, queries that take at least this many "
+                                                        "seconds are reported as slow")
+@click.pass_context
+def cli(ctx, metrics_jsonl, metrics_prom, explain_report, slow_query_seconds):
+    metrics.configure(metrics_jsonl, metrics_prom)
+    if metrics_prom:
+        ctx.call_on_close(metrics.write_prometheus)
+    diagnostics.configure(explain_report, slow_query_seconds)
+    if explain_report:
+        ctx.call_on_close(diagnostics.write_report)
 
 
 def parse_yaml(analysis_config_yaml_path):
+    import yaml
     if not analysis_config_yaml_path:
         analysis_config_yaml_path = pathlib.Path(__name__).parent.joinpath("resource", "analysisConfig.yaml")
     with open(analysis_config_yaml_path, 'r') as f:
@@ -31,15 +41,76 @@ def parse_yaml(analysis_config_yaml_path):
     return analysis_config
 
 
+def parse_shard_option(ctx, param, value):
+    import mimic_mf_analysis.partials as partials
+    if value is None:
+        return None
+    try:
+        return partials.parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def read_encounters(path):
+    """
+    Read HADM_IDs, one per line, or return None without a path.
+    """
+    import numpy as np
+    if path is None:
+        return None
+    return np.loadtxt(path, dtype=np.int64, ndmin=1).tolist()
+
+
+def save_results(results, out_dir, name, format, compact=False):
+    """
+    Save results either as a pickle file {out_dir}/{name}.obj or as group {name} of a result store at {out_dir}.
+    @param results: a summary object, or a dictionary from disease to summary objects or to dictionaries of arrays
+    @param compact: save summaries with minimal count dtypes and without the cells that follow from the marginals
+    (see result_store.compact_arrays); they are rebuilt when loaded
+    """
+    import mimic_mf_analysis.result_store as result_store
+    import pickle
+    with metrics.timer('save', name=name, format=format):
+        if format == 'pickle':
+            with open(pathlib.Path(out_dir).joinpath(name + '.obj'), 'wb') as f:
+                pickle.dump(result_store.compact(results) if compact else results, f, protocol=2)
+            return
+        store = result_store.ResultStore(out_dir, create=True)
+        if isinstance(results, dict):
+            for key, value in results.items():
+                if isinstance(value, dict):
+                    store.write_arrays(name, key, value)
+                else:
+                    store.write_summary(name, key, value, compact=compact)
+        else:
+            store.write_summary(name, 'all', results, compact=compact)
+
+
 @click.command()
 @click.option("--analysis_config_yaml_path", help="analysis configuration file")
 @click.option("--debug", is_flag=True, help="run in debug mode")
 @click.option("--out", help="output directory")
-def regardless_diagnosis(analysis_config_yaml_path, debug, out):
+@click.option("--format", type=click.Choice(['pickle', 'store']), default='pickle',
+              help="pickle: one pickle file per result; store: a memory-mappable result store in the output directory")
+@click.option("--dedup", is_flag=True, help="count unique encounter profiles once, weighted by their multiplicity")
+@click.option("--compact", is_flag=True, help="save counts in the smallest unsigned dtype and only the cells that the "
+                                              "marginals do not determine, sparsely if few phenotype pairs co-occur")
+@click.option("--shard", default=None, callback=parse_shard_option,
+              help="k/n: count only the k-th of n contiguous encounter ranges and save partial summaries, to be "
+                   "combined with merge-shards")
+@click.option("--since", default=None, help="output directory of an earlier run: update its summaries with only the "
+                                            "encounters added or changed since, keeping its phenotype panels")
+@click.option("--changed_encounters", default=None, help="with --since, a file of HADM_IDs (one per line) to count "
+                                                         "again in any case, e.g. of notes that were mapped again")
+def regardless_diagnosis(analysis_config_yaml_path, debug, out, format, dedup, compact, shard, since,
+                         changed_encounters):
     """
     Generate the joint distribution of HPO pairs regardless of diseases.
     Terms of HPO pairs can be 1) one from rad and one from lab 2) both from rad or 3) both from lab
     """
+    import mimic_mf_analysis.analysis as analysis
+    import mimic_mf_analysis.partials as partials
+    import mimic_mf_analysis.delta as delta
     # how to run this
     analysis_config = parse_yaml(analysis_config_yaml_path=analysis_config_yaml_path)
 
@@ -57,19 +128,25 @@ def regardless_diagnosis(analysis_config_yaml_path, debug, out):
     labHpo_threshold_min, labHpo_threshold_max = analysis_params['labHpo_threshold_min'], analysis_params[
         'labHpo_threshold_max']
 
+    if since and shard:
+        raise click.UsageError('--since updates a complete run and cannot be combined with --shard')
+
     analysis.initTables(debug=debug)
-    analysis.rankHpoFromText('', hpo_min_occurrence_per_encounter=textHpo_occurrance_min)
-    analysis.rankHpoFromLab('', hpo_min_occurrence_per_encounter=labHpo_occurrance_min)
 
     batch_size = 11 if debug else 100
 
-    summary_rad_lab, summary_rad_rad, summary_lab_lab = analysis.summary_textHpo_labHpo(batch_size,
-                                                                               textHpo_occurrance_min,
-                                                                               labHpo_occurrance_min,
-                                                                               textHpo_threshold_min,
-                                                                               textHpo_threshold_max,
-                                                                               labHpo_threshold_min,
-                                                                               labHpo_threshold_max)
+    if since:
+        (summary_rad_lab, summary_rad_rad, summary_lab_lab), vectors, watermarks = delta.update_regardless_diagnosis(
+            since, dict(analysis_params, debug=debug), read_encounters(changed_encounters), batch_size)
+    else:
+        # watermarks are taken before counting, so rows that arrive during the run are counted by the next delta run
+        watermarks = delta.current_watermarks()
+        vectors = None if shard else delta.EncounterVectors()
+        analysis.rankHpoFromText('', hpo_min_occurrence_per_encounter=textHpo_occurrance_min)
+        analysis.rankHpoFromLab('', hpo_min_occurrence_per_encounter=labHpo_occurrance_min)
+        summary_rad_lab, summary_rad_rad, summary_lab_lab = analysis.summary_textHpo_labHpo(
+            batch_size, textHpo_occurrance_min, labHpo_occurrance_min, textHpo_threshold_min, textHpo_threshold_max,
+            labHpo_threshold_min, labHpo_threshold_max, dedup, shard, vectors)
 
     if out:
         out_dir = pathlib.Path(out)
@@ -79,23 +156,43 @@ def regardless_diagnosis(analysis_config_yaml_path, debug, out):
         if not out_dir.exists():
             out_dir.mkdir()
 
-    with open(out_dir.joinpath("summary_rad_lab.obj"), 'wb') as f:
-        pickle.dump(summary_rad_lab, f, protocol=2)
-    with open(out_dir.joinpath("summary_rad_rad.obj"), 'wb') as f:
-        pickle.dump(summary_rad_rad, f, protocol=2)
-    with open(out_dir.joinpath("summary_lab_lab.obj"), 'wb') as f:
-        pickle.dump(summary_lab_lab, f, protocol=2)
+    save_results(summary_rad_lab, out_dir, "summary_rad_lab", format, compact)
+    save_results(summary_rad_rad, out_dir, "summary_rad_rad", format, compact)
+    save_results(summary_lab_lab, out_dir, "summary_lab_lab", format, compact)
+    if shard:
+        partials.write_manifest(out_dir, shard, ["summary_rad_lab", "summary_rad_rad", "summary_lab_lab"],
+                                dict(analysis_params, debug=debug))
+    if vectors is not None:
+        vectors.save(out_dir)
+        delta.write_state(out_dir, 'regardless_diagnosis', ["summary_rad_lab", "summary_rad_rad", "summary_lab_lab"],
+                          dict(analysis_params, debug=debug), watermarks)
 
 
 @click.command()
 @click.option("--analysis_config_yaml_path", help="analysis configuration file")
 @click.option("--debug", is_flag=True, help="run in debug mode")
 @click.option("--out", help="output directory")
-def regarding_diagnosis(analysis_config_yaml_path, debug, out):
+@click.option("--format", type=click.Choice(['pickle', 'store']), default='pickle',
+              help="pickle: one pickle file per result; store: a memory-mappable result store in the output directory")
+@click.option("--dedup", is_flag=True, help="count unique encounter profiles once, weighted by their multiplicity")
+@click.option("--compact", is_flag=True, help="save counts in the smallest unsigned dtype and only the cells that the "
+                                              "marginals do not determine, sparsely if few phenotype pairs co-occur")
+@click.option("--shard", default=None, callback=parse_shard_option,
+              help="k/n: count only the k-th of n contiguous encounter ranges and save partial summaries, to be "
+                   "combined with merge-shards")
+@click.option("--since", default=None, help="output directory of an earlier run: update its summaries with only the "
+                                            "encounters added or changed since, keeping its phenotype panels")
+@click.option("--changed_encounters", default=None, help="with --since, a file of HADM_IDs (one per line) to count "
+                                                         "again in any case, e.g. of notes that were mapped again")
+def regarding_diagnosis(analysis_config_yaml_path, debug, out, format, dedup, compact, shard, since,
+                        changed_encounters):
     """
     Count the joint distribution of HPO pairs conditioned on a disease.
     Terms in the HPO pair could be 1) one from rad and one from lab, 2) both from rad or 3) both from lab.
     """
+    import mimic_mf_analysis.analysis as analysis
+    import mimic_mf_analysis.partials as partials
+    import mimic_mf_analysis.delta as delta
     # how to run this
     analysis_config = parse_yaml(analysis_config_yaml_path=analysis_config_yaml_path)
 
@@ -115,13 +212,80 @@ def regarding_diagnosis(analysis_config_yaml_path, debug, out):
 
     # 1. build the temp tables for Lab converted HPO, Text convert HPO
     # Read the comments within the method!
+    if since and shard:
+        raise click.UsageError('--since updates a complete run and cannot be combined with --shard')
     analysis.initTables(debug=debug)
 
     # 2. iterate throw the dataset
-    summaries_diag_textHpo_labHpo, summaries_diag_textHpo_textHpo, summaries_diag_labHpo_labHpo = analysis.summarize_diagnosis_textHpo_labHpo(
-        primary_diagnosis_only, textHpo_occurrance_min, labHpo_occurrance_min, diagnosis_threshold_min,
-        textHpo_threshold_min, textHpo_threshold_max, labHpo_threshold_min, labHpo_threshold_max, disease_of_interest,
-        logger)
+    if since:
+        # only encounters added or changed since the earlier run are counted, for its diagnoses and phenotypes
+        (summaries_diag_textHpo_labHpo, summaries_diag_textHpo_textHpo, summaries_diag_labHpo_labHpo), vectors, \
+            watermarks = delta.update_regarding_diagnosis(since, dict(analysis_params, debug=debug),
+                                                          read_encounters(changed_encounters))
+    else:
+        watermarks = delta.current_watermarks()
+        vectors = None if shard else delta.EncounterVectors()
+        summaries_diag_textHpo_labHpo, summaries_diag_textHpo_textHpo, summaries_diag_labHpo_labHpo = \
+            analysis.summarize_diagnosis_textHpo_labHpo(
+                primary_diagnosis_only, textHpo_occurrance_min, labHpo_occurrance_min, diagnosis_threshold_min,
+                textHpo_threshold_min, textHpo_threshold_max, labHpo_threshold_min, labHpo_threshold_max,
+                disease_of_interest, logger, dedup, shard, vectors)
+
+    if out:
+        out_dir = pathlib.Path(out)
+    else:
+        print("out directory not specified. default to mimic_analysis in home directory")
+        out_dir = pathlib.Path().home().joinpath('mimic_analysis')
+        if not out_dir.exists():
+            out_dir.mkdir()
+
+    print("write summaries_diag_rad_lab")
+    save_results(summaries_diag_textHpo_labHpo, out_dir, "summaries_diag_rad_lab", format, compact)
+    save_results(summaries_diag_textHpo_textHpo, out_dir, "summaries_diag_rad_rad", format, compact)
+    save_results(summaries_diag_labHpo_labHpo, out_dir, "summaries_diag_lab_lab", format, compact)
+    if shard:
+        partials.write_manifest(out_dir, shard, ["summaries_diag_rad_lab", "summaries_diag_rad_rad",
+                                                 "summaries_diag_lab_lab"], dict(analysis_params, debug=debug))
+    if vectors is not None:
+        vectors.save(out_dir)
+        delta.write_state(out_dir, 'regarding_diagnosis',
+                          ["summaries_diag_rad_lab", "summaries_diag_rad_rad", "summaries_diag_lab_lab"],
+                          dict(analysis_params, debug=debug), watermarks)
+
+
+@click.command()
+@click.option("--analysis_config_yaml_path", help="analysis configuration file")
+@click.option("--debug", is_flag=True, help="run in debug mode")
+@click.option("--out", help="output directory")
+@click.option("--min_support", type=int, help="keep phenotype pairs that co-occur in at least this many encounters. "
+                                              "Default to min_support in the configuration")
+@click.option("--format", type=click.Choice(['pickle', 'store']), default='store',
+              help="pickle: one pickle file per result; store: a result store in the output directory")
+def regarding_diagnosis_sparse(analysis_config_yaml_path, debug, out, min_support, format):
+    """
+    Like regarding_diagnosis, but for large phenotype panels. Co-occurrences are counted with sparse matrix products
+    and only phenotype pairs with a minimum support are kept, so thresholds can be lowered to include rare phenotypes
+    without dense M1 x M2 x 8 count tensors.
+    """
+    import mimic_mf_analysis.analysis as analysis
+    analysis_config = parse_yaml(analysis_config_yaml_path=analysis_config_yaml_path)
+
+    if debug:
+        analysis_params = analysis_config['analysis-test']['regarding_diagnosis_sparse']
+        logger.warning("running in debug mode")
+    else:
+        analysis_params = analysis_config['analysis-prod']['regarding_diagnosis_sparse']
+        logger.info("running in prod mode")
+
+    if min_support is None:
+        min_support = analysis_params['min_support']
+
+    analysis.initTables(debug=debug)
+    summaries_rad_lab, summaries_rad_rad, summaries_lab_lab = analysis.summarize_diagnosis_sparse(
+        analysis_params['primary_diagnosis_only'], analysis_params['textHpo_occurrance_min'],
+        analysis_params['labHpo_occurrance_min'], analysis_params['textHpo_threshold_min'],
+        analysis_params['textHpo_threshold_max'], analysis_params['labHpo_threshold_min'],
+        analysis_params['labHpo_threshold_max'], analysis_params['disease_of_interest'], min_support, logger)
 
     if out:
         out_dir = pathlib.Path(out)
@@ -131,20 +295,54 @@ def regarding_diagnosis(analysis_config_yaml_path, debug, out):
         if not out_dir.exists():
             out_dir.mkdir()
 
-    with open(out_dir.joinpath("summaries_diag_rad_lab.obj"), 'wb') as f:
-        print("write summaries_diag_rad_lab.obj ")
-        pickle.dump(summaries_diag_textHpo_labHpo, f, protocol=2)
-    with open(out_dir.joinpath("summaries_diag_rad_rad.obj"), 'wb') as f:
-        pickle.dump(summaries_diag_textHpo_textHpo, f, protocol=2)
-    with open(out_dir.joinpath("summaries_diag_lab_lab.obj"), 'wb') as f:
-        pickle.dump(summaries_diag_labHpo_labHpo, f, protocol=2)
+    save_results(summaries_rad_lab, out_dir, "sparse_summaries_diag_rad_lab", format)
+    save_results(summaries_rad_rad, out_dir, "sparse_summaries_diag_rad_rad", format)
+    save_results(summaries_lab_lab, out_dir, "sparse_summaries_diag_lab_lab", format)
+
+
+def selection_summaries(selection, rad_rad_path, lab_lab_path):
+    """
+    Criterion and summaries of the --selection options of the synergy tree commands, see
+    synergy_trees.select_phenotypes().
+    :return: criterion (None for mi), textHpo * textHpo and labHpo * labHpo summaries
+    """
+    import mimic_mf_analysis.result_store as result_store
+    if selection == 'mi':
+        return None, None, None
+    if rad_rad_path is None or lab_lab_path is None:
+        raise click.UsageError('--selection {} needs --rad_rad_path and --lab_lab_path'.format(selection))
+    return selection, result_store.load_results(rad_rad_path), result_store.load_results(lab_lab_path)
 
 
 @click.command()
 @click.option("--analysis_config_yaml_path", help="analysis configuration file")
 @click.option("--debug", is_flag=True, help="run in debug mode")
 @click.option("--out", help="output directory")
-def build_synergy_tree(analysis_config_yaml_path, debug, out):
+@click.option("--joint_distributions_path", default=None, help="textHpo * labHpo summaries of the diseases to select "
+                                                               "the phenotypes from, e.g. summaries_diag_rad_lab.obj. "
+                                                               "Default to the most frequent phenotypes in the "
+                                                               "database")
+@click.option("--top_text", default=5, help="number of textHpo terms in the tree")
+@click.option("--top_lab", default=3, help="number of labHpo terms in the tree")
+@click.option("--selection", type=click.Choice(['mi', 'mrmr', 'cife']), default='mi',
+              help="how to select phenotypes from the summaries, see build-synergy-trees")
+@click.option("--rad_rad_path", default=None, help="textHpo * textHpo summaries, e.g. summaries_diag_rad_rad.obj")
+@click.option("--lab_lab_path", default=None, help="labHpo * labHpo summaries, e.g. summaries_diag_lab_lab.obj")
+def build_synergy_tree(analysis_config_yaml_path, debug, out, joint_distributions_path, top_text, top_lab, selection,
+                       rad_rad_path, lab_lab_path):
+    """
+    Build and show the synergy tree of the disease_of_interest of the configuration. Its phenotypes are selected from
+    the summaries with --joint_distributions_path (see build-synergy-trees), otherwise the top_text and top_lab most
+    frequent phenotypes within the thresholds of the configuration are used.
+    """
+    if selection != 'mi' and joint_distributions_path is None:
+        raise click.UsageError('--selection {} needs --joint_distributions_path'.format(selection))
+    criterion, rad_rad, lab_lab = selection_summaries(selection, rad_rad_path, lab_lab_path)
+    from mimic_mf_analysis import db
+    import mimic_mf_analysis.analysis as analysis
+    import mimic_mf_analysis.result_store as result_store
+    import mimic_mf_analysis.synergy_trees as synergy_trees
+    from mutual_information.synergy_tree import SynergyTree
     # how to run this
     analysis_config = parse_yaml(analysis_config_yaml_path=analysis_config_yaml_path)
 
@@ -168,43 +366,95 @@ def build_synergy_tree(analysis_config_yaml_path, debug, out):
 
     analysis.initTables(debug=debug)
 
-    analysis.rankHpoFromText(diagnosis, textHpo_occurrance_min)
-    analysis.rankHpoFromLab(diagnosis, labHpo_occurrance_min)
-    # logger.info("..............diagnosis values found")
-
-    textHpoOfInterest = pd.read_sql_query(
-        "SELECT * FROM JAX_textHpoFrequencyRank WHERE N BETWEEN {} AND {}".format(textHpo_threshold_min,
-                                                                                  textHpo_threshold_max),
-        mydb).MAP_TO.values
-    labHpoOfInterest = pd.read_sql_query(
-        "SELECT * FROM JAX_labHpoFrequencyRank WHERE N BETWEEN {} AND {}".format(labHpo_threshold_min,
-                                                                                 labHpo_threshold_max),
-        mydb).MAP_TO.values
-    # manually trim phenotypes TODO: further filter them
-    # there is probably not a good way to automate this
-    print(labHpoOfInterest)
-    print(textHpoOfInterest)
-    textHpoOfInterest = ['HP:0001877', 'HP:0020058', 'HP:0010927', 'HP:0001871', 'HP:0010929']
-    labHpoOfInterest = ['HP:0002202', 'HP:0011032', 'HP:0100750']
-    print("filtered phenotypes:")
-    print(labHpoOfInterest)
-    print(textHpoOfInterest)
-
-    mydb.cursor().execute("""drop table if exists Jax_multivariant_synergy_table""")
+    if joint_distributions_path is None:
+        analysis.rankHpoFromText(diagnosis, textHpo_occurrance_min)
+        analysis.rankHpoFromLab(diagnosis, labHpo_occurrance_min)
+        textHpoOfInterest = list(db.read_sql(
+            "SELECT * FROM JAX_textHpoFrequencyRank WHERE N BETWEEN {} AND {} ORDER BY N DESC, MAP_TO".format(
+                textHpo_threshold_min, textHpo_threshold_max)).MAP_TO.values[:top_text])
+        labHpoOfInterest = list(db.read_sql(
+            "SELECT * FROM JAX_labHpoFrequencyRank WHERE N BETWEEN {} AND {} ORDER BY N DESC, MAP_TO".format(
+                labHpo_threshold_min, labHpo_threshold_max)).MAP_TO.values[:top_lab])
+    else:
+        summaries = result_store.load_results(joint_distributions_path)
+        if diagnosis not in summaries:
+            raise click.UsageError('disease_of_interest {} is not in {}'.format(diagnosis, joint_distributions_path))
+        textHpoOfInterest, labHpoOfInterest = synergy_trees.select_phenotypes(diagnosis, summaries, top_text, top_lab,
+                                                                              criterion, rad_rad, lab_lab)
+    logger.info('{}: textHpo {}, labHpo {}'.format(diagnosis, textHpoOfInterest, labHpoOfInterest))
+
+    db.drop_temp_table('Jax_multivariant_synergy_table')
 
     analysis.add_diag_columns(diagnosis, primary_diagnosis_only)
-    var_dict = analysis.add_phenotype_columns(labHpos=labHpoOfInterest, \
-                                     textHpos=textHpoOfInterest, \
-                                     labHpo_threshold_min=labHpo_occurrance_min, \
-                                     textHpo_threshold_min=textHpo_occurrance_min)
+    var_dict = analysis.add_phenotype_columns(labHpos=labHpoOfInterest,
+                                              textHpos=textHpoOfInterest,
+                                              labHpo_threshold_min=labHpo_occurrance_min,
+                                              textHpo_threshold_min=textHpo_occurrance_min)
     mf_dict, summary_dict = analysis.precompute_mf_dict(var_dict.keys())
-    syntree_038 = SynergyTree(var_dict.keys(), var_dict, mf_dict)
-    syntree_038.synergy_tree().show()
+    syntree = SynergyTree(var_dict.keys(), var_dict, mf_dict)
+    syntree.synergy_tree().show()
     print(var_dict)
 
 
 @click.command()
-@click.option("--joint_distributions_path", help="HPO pair * disease joint distributions (output from running previous command)")
+@click.option("--analysis_config_yaml_path", help="analysis configuration file")
+@click.option("--debug", is_flag=True, help="run in debug mode")
+@click.option("--joint_distributions_path", required=True, help="textHpo * labHpo summaries of the diseases, e.g. "
+              "summaries_diag_rad_lab.obj or its group directory of a result store")
+@click.option("--disease_of_interest", default=None, help="comma separated diseases. Default to all in the summaries")
+@click.option("--top_text", default=5, help="number of textHpo terms per disease, by mutual information with it")
+@click.option("--top_lab", default=3, help="number of labHpo terms per disease, by mutual information with it")
+@click.option("--out_dir", required=True, help="output directory of the synergy_tree_{disease}.json files")
+@click.option("--cpu", default=None, type=int, help="number of trees to build in parallel. Default to all CPUs")
+@click.option("--selection", type=click.Choice(['mi', 'mrmr', 'cife']), default='mi',
+              help="mi: the top phenotypes of each kind by mutual information with the disease; mrmr, cife: "
+                   "top_text + top_lab phenotypes of either kind by greedy forward selection, which penalizes "
+                   "phenotypes redundant with those selected before (needs --rad_rad_path and --lab_lab_path)")
+@click.option("--rad_rad_path", default=None, help="textHpo * textHpo summaries, e.g. summaries_diag_rad_rad.obj")
+@click.option("--lab_lab_path", default=None, help="labHpo * labHpo summaries, e.g. summaries_diag_lab_lab.obj")
+def build_synergy_trees(analysis_config_yaml_path, debug, joint_distributions_path, disease_of_interest, top_text,
+                        top_lab, out_dir, cpu, selection, rad_rad_path, lab_lab_path):
+    """
+    Build synergy trees of many diseases, each over its top textHpo and labHpo terms by mutual information with the
+    disease in precomputed summaries (output of regarding-diagnosis), and save them as JSON.
+    """
+    import mimic_mf_analysis.result_store as result_store
+    import mimic_mf_analysis.synergy_trees as synergy_trees
+    analysis_config = parse_yaml(analysis_config_yaml_path=analysis_config_yaml_path)
+    analysis_params = analysis_config['analysis-test' if debug else 'analysis-prod']['synergy_tree']
+
+    summaries = result_store.load_results(joint_distributions_path)
+    criterion, rad_rad, lab_lab = selection_summaries(selection, rad_rad_path, lab_lab_path)
+    if disease_of_interest is None:
+        diseases = list(summaries)
+    else:
+        diseases = disease_of_interest.split(',')
+        unknown = [disease for disease in diseases if disease not in summaries]
+        if unknown:
+            raise click.BadParameter('{} not in {}'.format(', '.join(unknown), joint_distributions_path),
+                                     param_hint='--disease_of_interest')
+
+    # the database connection is only opened once the options are checked
+    import mimic_mf_analysis.analysis as analysis
+    pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+    analysis.initTables(debug=debug)
+    written = set()
+    for disease, tree in synergy_trees.build_trees(summaries, diseases, top_text, top_lab,
+                                                   analysis_params['primary_diagnosis_only'],
+                                                   analysis_params['textHpo_occurrance_min'],
+                                                   analysis_params['labHpo_occurrance_min'], cpu, criterion,
+                                                   rad_rad, lab_lab):
+        print('synergy tree of {} written to {}'.format(disease, synergy_trees.save_tree(tree, out_dir)))
+        written.add(disease)
+    missing = [disease for disease in diseases if disease not in written]
+    if missing:
+        raise RuntimeError('no synergy trees of {} (see the log)'.format(', '.join(missing)))
+
+
+@click.command()
+@click.option("--joint_distributions_path", help="HPO pair * disease joint distributions (output from running previous "
+                                                 "command). Either a pickle file or a group directory of a result "
+                                                 "store")
 @click.option("--disease_of_interest", required=True, help="specify a disease to run simulations for")
 @click.option("--out_dir", help="specify output directory")
 @click.option("--verbose", is_flag=True, help="print more log info in verbose mode")
@@ -212,13 +462,34 @@ def build_synergy_tree(analysis_config_yaml_path, debug, out):
 @click.option("--simulations", default=500, help="how many simulations to repeat")
 @click.option("--cpu", default=8, help="number of CPU to use")
 @click.option("--job_id", default=1, help="pass job id")
-def simulate(joint_distributions_path, disease_of_interest, out_dir, verbose, per_simulation, simulations, cpu, job_id):
+@click.option("--mode", type=click.Choice(['distribution', 'counts', 'sequential']), default='distribution',
+              help="distribution: save every simulated value; counts: only save per-pair counts of simulated values "
+                   "against observed ones (constant memory); sequential: like counts, but stop simulating pairs "
+                   "once their p values are clearly above or below alpha (--simulations is the maximum per pair)")
+@click.option("--reservoir_size", default=0, help="in counts mode, also keep this many simulated values per pair")
+@click.option("--alpha", default=0.05, help="in sequential mode, significance threshold")
+@click.option("--stop_after", default=10, help="in sequential mode, stop a pair after this many simulations at least "
+                                               "as extreme as observed")
+@click.option("--batch_size", default=100, help="in sequential mode, simulations per round")
+@click.option("--format", type=click.Choice(['pickle', 'store']), default='pickle',
+              help="in distribution mode, pickle: save {disease}_{job_id}_distribution.obj; store: save the arrays in "
+                   "{disease}_{job_id}_distribution.npz")
+@click.option("--dedup", is_flag=True, help="in counts and sequential modes, count each simulated sample as unique "
+                                            "profiles with multiplicities")
+def simulate(joint_distributions_path, disease_of_interest, out_dir, verbose, per_simulation, simulations, cpu, job_id,
+             mode, reservoir_size, alpha, stop_after, batch_size, format, dedup):
     """
     Provide the joint distributions of disease*HPO_pair, and run simulations
     """
-    with open(joint_distributions_path, 'rb') as in_file:
-        joint_distributions = pickle.load(in_file)
-        logger.info('number of diseases in input file for joint distributions {}'.format(len(joint_distributions)))
+    import numpy as np
+    from mutual_information.mf_random import MutualInfoRandomizer
+    import mimic_mf_analysis.simulation as simulation
+    import mimic_mf_analysis.result_store as result_store
+    import mimic_mf_analysis.shards as shards
+    import pickle
+    # a result store only loads the disease of interest
+    joint_distributions = result_store.load_results(joint_distributions_path)
+    logger.info('number of diseases in input file for joint distributions {}'.format(len(joint_distributions)))
 
     if out_dir is None:
         out_dir = pathlib.Path(joint_distributions_path).parent
@@ -231,78 +502,373 @@ def simulate(joint_distributions_path, disease_of_interest, out_dir, verbose, pe
     joint_distribution = joint_distributions.get(disease_of_interest)
     if joint_distribution is None:
         raise RuntimeError("specified disease not included in the joint_distribution file. exit without simulation.")
+    elif mode in ['counts', 'sequential']:
+        if verbose:
+            print('start counting simulations for {}'.format(disease_of_interest))
+        if mode == 'counts':
+            counter = simulation.simulate_counts(joint_distribution, per_simulation, simulations, cpu, job_id,
+                                                 reservoir_size, dedup)
+        else:
+            counter = simulation.simulate_sequential(joint_distribution, per_simulation, simulations, batch_size, cpu,
+                                                     job_id, alpha=alpha, stop_after=stop_after,
+                                                     reservoir_size=reservoir_size, dedup=dedup)
+            n = counter.n['synergy']
+            logger.info('simulations per pair: min {}, median {}, max {}, total {}'.format(
+                np.min(n), np.median(n), np.max(n), np.sum(n)))
+        counts_file_path = os.path.join(out_dir, disease_of_interest + job_suffix + '_counts.obj')
+        with open(counts_file_path, 'wb') as f2:
+            pickle.dump(counter, file=f2, protocol=2)
+        # a sequential shard draws simulations until its last undecided pair stops, and that pair has seen all of them
+        drawn = int(np.max(counter.n['synergy'])) if mode == 'sequential' else simulations
+        shards.record_shard(out_dir, disease_of_interest, job_id, counts_file_path, 'counts', job_id * simulations,
+                            drawn, counter)
+
+        if verbose:
+            print('saved current batch of simulation counts {} for {}'.format(job_id, disease_of_interest))
     else:
         randmizer = MutualInfoRandomizer(joint_distribution)
         if verbose:
             print('start calculating p values for {}'.format(disease_of_interest))
         randmizer.simulate(per_simulation, simulations, cpu, job_id)
 
-        distribution_file_path = os.path.join(out_dir, disease_of_interest + job_suffix + '_distribution.obj')
-        with open(distribution_file_path, 'wb') as f2:
-            pickle.dump(randmizer.empirical_distribution, file=f2, protocol=2)
+        if format == 'store':
+            # npz keeps plain arrays without pickling; shards are independent files, so array jobs can write
+            # concurrently
+            distribution_file_path = os.path.join(out_dir, disease_of_interest + job_suffix + '_distribution.npz')
+            np.savez(distribution_file_path, **randmizer.empirical_distribution)
+        else:
+            distribution_file_path = os.path.join(out_dir, disease_of_interest + job_suffix + '_distribution.obj')
+            with open(distribution_file_path, 'wb') as f2:
+                pickle.dump(randmizer.empirical_distribution, file=f2, protocol=2)
+        shards.record_shard(out_dir, disease_of_interest, job_id, distribution_file_path, 'distribution',
+                            job_id * simulations, simulations, randmizer.empirical_distribution)
 
         if verbose:
             print('saved current batch of simulations {} for {}'.format(job_id, disease_of_interest))
 
 
+@click.command()
+@click.option("--joint_distributions_path", required=True, help="HPO pair * disease joint distributions (output from "
+                                                                "running previous command). Either a pickle file or a "
+                                                                "group directory of a result store")
+@click.option("--disease_of_interest", required=True, help="specify a disease to run simulations for")
+@click.option("--out_dir", help="specify output directory")
+@click.option("--per_simulation", default=None, type=int, help="for every simulation, how many encounters to simulate. "
+                                                               "Default to observed encounters")
+@click.option("--simulations", default=10000, help="total number of simulations")
+@click.option("--shard_size", default=500, help="number of simulations per shard")
+@click.option("--seed", default=None, type=int, help="root entropy of the seed streams. Default to the entropy of an "
+                                                     "existing plan in out_dir, or fresh entropy")
+@click.option("--mode", type=click.Choice(['distribution', 'counts']), default='distribution',
+              help="what each shard saves (see simulate)")
+@click.option("--cpu", default=None, type=int, help="number of shards to run in parallel")
+@click.option("--retries", default=2, help="number of times failed shards are retried")
+@click.option("--emit_jobs", default=None, help="write a job manifest to this path instead of running shards locally")
+@click.option("--only_shard", default=None, type=int, help="run only this shard of an existing plan (e.g. one cluster "
+                                                           "job)")
+def simulate_sharded(joint_distributions_path, disease_of_interest, out_dir, per_simulation, simulations, shard_size,
+                     seed, mode, cpu, retries, emit_jobs, only_shard):
+    """
+    Split the simulations of a disease into shards with independent, reproducible seed streams and run them on a local
+    process pool, retrying failed shards. Completed shards are recorded in the manifest and skipped on rerun.
+    """
+    import mimic_mf_analysis.result_store as result_store
+    import mimic_mf_analysis.scheduler as scheduler
+    joint_distributions = result_store.load_results(joint_distributions_path)
+    joint_distribution = joint_distributions.get(disease_of_interest)
+    if joint_distribution is None:
+        raise RuntimeError("specified disease not included in the joint_distribution file. exit without simulation.")
+    if out_dir is None:
+        out_dir = pathlib.Path(joint_distributions_path).parent
+
+    plan = scheduler.load_plan(out_dir, disease_of_interest)
+    if plan is None or (seed is not None and plan['entropy'] != seed) or \
+            plan['total_simulations'] != simulations or \
+            any(shard['simulations'] > shard_size for shard in plan['shards']):
+        if only_shard is not None:
+            raise RuntimeError("--only_shard requires the plan of an earlier simulate-sharded call")
+        # keep the seed streams of an existing plan unless another seed is given
+        if seed is None and plan is not None:
+            seed = plan['entropy']
+        plan = scheduler.plan_shards(simulations, shard_size, seed)
+        scheduler.save_plan(plan, out_dir, disease_of_interest)
+        scheduler.discard_stale_shards(plan, out_dir, disease_of_interest)
+    logger.info('shard plan of {}: {} shards, entropy {}'.format(disease_of_interest, len(plan['shards']),
+                                                                 plan['entropy']))
+
+    if emit_jobs is not None:
+        command = 'python -m mimic_mf_analysis.app simulate-sharded --joint_distributions_path {} ' \
+                  '--disease_of_interest {} --out_dir {} --simulations {} --shard_size {} --seed {} --mode {}'.format(
+                      joint_distributions_path, disease_of_interest, out_dir, simulations, shard_size, plan['entropy'],
+                      mode)
+        if per_simulation is not None:
+            command = command + ' --per_simulation {}'.format(per_simulation)
+        jobs = scheduler.emit_jobs(plan, disease_of_interest, emit_jobs, command)
+        print('wrote {} jobs to {}'.format(len(jobs), emit_jobs))
+        return
+
+    if only_shard is not None:
+        scheduler.run_shard(joint_distribution, disease_of_interest, plan, plan['shards'][only_shard], out_dir,
+                            per_simulation, mode)
+        return
+
+    failed = scheduler.run_shards(joint_distribution, disease_of_interest, plan, out_dir, per_simulation, mode, cpu,
+                                  retries)
+    if failed:
+        raise RuntimeError('shards {} of {} failed after {} retries'.format(failed, disease_of_interest, retries))
+    print('all {} shards of {} completed'.format(len(plan['shards']), disease_of_interest))
+
+
 @click.command()
 @click.option("--joint_distributions_path", help="HPO pair * disease joint distributions (output from running previous command)")
 @click.option("--dist_path", help="directory path for simulation results")
-@click.option("--out_path", help="output path, return a binary file of Python map")
-@click.option("--disease_of_interest", help="specify a disease name")
-def estimate(joint_distributions_path, dist_path, out_path, disease_of_interest):
-    with open(joint_distributions_path, 'rb') as in_file:
-        joint_distributions = pickle.load(in_file)
-        logger.info('number of diseases in input file for joint distributions {}'.format(len(joint_distributions)))
-
-    for disease, summary_statistics in joint_distributions.items():
-        if disease_of_interest is not None and disease not in disease_of_interest:
-            continue
-        randmizer = MutualInfoRandomizer(summary_statistics)
-        empirical_distribution = load_distribution(dist_path, disease)
-        # serialize_empirical_distributions(empirical_distribution['synergy'],
-        #      os.path.join(out_path, disease +
-        #                   '_empirical_distribution_subset.obj'))
-        randmizer.empirical_distribution = empirical_distribution
-        p = randmizer.p_values()
-
-    with open(out_path, 'wb') as f:
-        pickle.dump(p, f, protocol=2)
+@click.option("--out_path", help="output path, return a binary file of Python map from disease to p values")
+@click.option("--disease_of_interest", help="specify a disease name, or several separated by commas. Default to all")
+@click.option("--mode", type=click.Choice(['distribution', 'counts', 'analytic']), default='distribution',
+              help="which kind of simulation output to estimate p values from (see simulate). Use counts for "
+                   "output of sequential simulations. Two-sided p values of counts are twice the smaller tail, those "
+                   "of distribution reflect the observed value around the mean of the simulations, so the two differ "
+                   "for skewed null distributions. analytic: chi-square approximations from the summary counts "
+                   "without simulations, with a needs_simulation flag for unreliable or borderline pairs")
+@click.option("--format", type=click.Choice(['pickle', 'store']), default='pickle',
+              help="pickle: write a pickle file to out_path; store: write group p_values of a result store at out_path")
+@click.option("--cpu", default=None, type=int, help="number of diseases to estimate in parallel. Default to all CPUs")
+@click.option("--allow_partial", is_flag=True, help="estimate from the simulation shards that could be loaded when "
+                                                    "shards in the manifest are missing or corrupt, instead of failing")
+def estimate(joint_distributions_path, dist_path, out_path, disease_of_interest, mode, format, cpu, allow_partial):
+    """
+    Estimate p values from simulations. Diseases are estimated in parallel, and with --format store, each
+    disease's p values are written as soon as it finishes.
+    """
+    import mimic_mf_analysis.result_store as result_store
+    import mimic_mf_analysis.estimation as estimation
+    import mimic_mf_analysis.shards as shards
+    import pickle
+    joint_distributions = result_store.load_results(joint_distributions_path)
+    logger.info('number of diseases in input file for joint distributions {}'.format(len(joint_distributions)))
+
+    # iterate over keys, so that a result store only loads the diseases of interest
+    if disease_of_interest is None:
+        diseases = list(joint_distributions)
+    else:
+        diseases = [disease for disease in disease_of_interest.split(',') if disease in joint_distributions]
+
+    if format == 'store':
+        store = result_store.ResultStore(out_path, create=True)
+
+    p = dict()
+    for disease, p_disease in estimation.estimate_diseases(joint_distributions, diseases, dist_path, mode,
+                                                           shards.load_distribution, cpu, not allow_partial):
+        if format == 'store':
+            store.write_arrays('p_values', disease, p_disease)
+        else:
+            p[disease] = p_disease
+
+    if format == 'pickle':
+        with open(out_path, 'wb') as f:
+            pickle.dump(p, f, protocol=2)
     return p
 
 
-def load_distribution(dir, disease_prefix):
+@click.command()
+@click.option("--joint_distributions_path", required=True, help="HPO pair * disease joint distributions, a pickle file "
+                                                                "or a group directory of a result store")
+@click.option("--out_path", required=True, help="output path, a pickle file of a map from disease to confidence "
+                                                "intervals, or a result store with --format store")
+@click.option("--disease_of_interest", default=None, help="specify a disease name, or several separated by commas. "
+                                                          "Default to all")
+@click.option("--resamples", default=1000, help="number of bootstrap replicates")
+@click.option("--alpha", default=0.05, help="1 - confidence level of the percentile intervals")
+@click.option("--method", type=click.Choice(['poisson', 'multinomial']), default='poisson',
+              help="poisson: draw each cell of a contingency table from Poisson(count); multinomial: draw N "
+                   "encounters into the cells of each table")
+@click.option("--seed", default=None, type=int, help="seed of the random numbers")
+@click.option("--chunk_size", default=None, type=int, help="number of contingency tables resampled at a time. "
+                                                           "Default to about 128 MB of counts")
+@click.option("--format", type=click.Choice(['pickle', 'store']), default='pickle',
+              help="pickle: write a pickle file to out_path; store: write group confidence_intervals of a result "
+                   "store at out_path")
+def bootstrap(joint_distributions_path, out_path, disease_of_interest, resamples, alpha, method, seed, chunk_size,
+              format):
     """
-    Collect individual distribution profiles
+    Bootstrap confidence intervals of the mutual information and synergy of every phenotype pair, resampling the
+    stored contingency tables of the summaries without querying the database. Also works on summaries regardless of
+    diagnosis (mutual information of pairs).
     """
-    simulations = []
-    filename_pattern = f'{dir}/{disease_prefix}_*_distribution.obj'
-    for path in glob.glob(filename_pattern):
-        with open(path, 'rb') as f:
-            try:
-                simulation = pickle.load(f)
-                simulations.append(simulation)
-            except:
-                pass
+    import mimic_mf_analysis.result_store as result_store
+    import mimic_mf_analysis.bootstrap as bootstrap_intervals
+    import pickle
+    joint_distributions = result_store.load_results(joint_distributions_path)
+    if hasattr(joint_distributions, 'vars_labels'):
+        # a summary regardless of diagnosis
+        joint_distributions = {'all': joint_distributions}
+    if disease_of_interest is None:
+        diseases = list(joint_distributions)
+    else:
+        diseases = [disease for disease in disease_of_interest.split(',') if disease in joint_distributions]
+
+    if format == 'store':
+        store = result_store.ResultStore(out_path, create=True)
+    intervals = dict()
+    for disease in diseases:
+        with metrics.timer('bootstrap', diagnosis=disease):
+            intervals_disease = bootstrap_intervals.confidence_intervals(joint_distributions[disease], resamples, alpha,
+                                                                         method, seed, chunk_size)
+        logger.info('confidence intervals of {} computed'.format(disease))
+        if format == 'store':
+            store.write_arrays('confidence_intervals', disease, intervals_disease,
+                               attrs={'resamples': resamples, 'alpha': alpha, 'method': method})
+        else:
+            intervals[disease] = intervals_disease
+
+    if format == 'pickle':
+        with open(out_path, 'wb') as f:
+            pickle.dump(intervals, f, protocol=2)
 
-    empirical_distributions = dict()
-    empirical_distributions['mf_XY_omit_z'] = \
-        np.concatenate([res['mf_XY_omit_z'] for res in simulations], axis=-1)
-    empirical_distributions['mf_Xz'] = \
-        np.concatenate([res['mf_Xz'] for res in simulations], axis=-1)
-    empirical_distributions['mf_Yz'] = \
-        np.concatenate([res['mf_Yz'] for res in simulations], axis=-1)
-    empirical_distributions['mf_XY_z'] = \
-        np.concatenate([res['mf_XY_z'] for res in simulations], axis=-1)
-    empirical_distributions['mf_XY_given_z'] = \
-        np.concatenate([res['mf_XY_given_z'] for res in simulations], axis=-1)
-    empirical_distributions['synergy'] = \
-        np.concatenate([res['synergy'] for res in simulations], axis=-1)
 
-    return empirical_distributions
+@click.command()
+@click.option("--pickle_path", required=True, help="a pickled result, e.g. summaries_diag_rad_lab.obj")
+@click.option("--store_path", required=True, help="directory of the result store, created if it does not exist")
+@click.option("--group", help="group name in the store, default to the pickle file name")
+@click.option("--compress", is_flag=True, help="save compressed npz files instead of memory-mappable npy files")
+def convert_pickle(pickle_path, store_path, group, compress):
+    """
+    Convert a pickled result (protocol 2) into a group of a result store
+    """
+    import mimic_mf_analysis.result_store as result_store
+    group = result_store.convert_pickle(pickle_path, store_path, group, compress)
+    print('converted {} into group {} of {}'.format(pickle_path, group, store_path))
+
+
+@click.command()
+@click.option("--encounters", default=10000, help="number of synthetic encounters, e.g. 1000 to 500000")
+@click.option("--stages", default=None, help="comma separated stages, default to the in-memory stages summarize,"
+                                             "summarize_dedup,summarize_sparse,simulate. Database stages batch_query,"
+                                             "summarize_diagnosis_textHpo_labHpo,precompute_mf_dict load synthetic "
+                                             "data into temporary tables that shadow the real ones")
+@click.option("--seed", default=0, help="seed of the synthetic data")
+@click.option("--panel_size", default=30, help="number of phenotypes of each kind")
+@click.option("--simulations", default=5, help="number of simulations in the simulate stage")
+@click.option("--out", default=None, help="write the report to this JSON file")
+@click.option("--baseline", default=None, help="compare against this baseline report")
+@click.option("--update_baseline", is_flag=True, help="write the report to --baseline instead of comparing")
+@click.option("--tolerance", default=0.2, help="relative slowdown or memory growth that counts as a regression")
+def run_benchmark(encounters, stages, seed, panel_size, simulations, out, baseline, update_baseline, tolerance):
+    """
+    Benchmark the main stages on synthetic MIMIC-shaped data: wall time, rows per second and peak memory.
+    Exit with status 1 if a stage regressed against the baseline.
+    """
+    import mimic_mf_analysis.benchmark as benchmark
+    report = benchmark.run_benchmarks(encounters, stages.split(',') if stages else None, seed,
+                                      panel_size=panel_size, simulations=simulations)
+    for result in report['results']:
+        print('{:<40}{:>10.3f}s{:>14.0f} rows/s{:>10.1f} MB'.format(result['stage'], result['wall_time'],
+                                                                    result['rows_per_second'] or 0,
+                                                                    result['peak_memory'] / 2 ** 20))
+    if out:
+        benchmark.save_report(report, out)
+    if baseline and update_baseline:
+        benchmark.save_report(report, baseline)
+    elif baseline and os.path.exists(baseline):
+        comparison = benchmark.compare(report, benchmark.load_report(baseline), tolerance)
+        print(benchmark.format_comparison(comparison))
+        if any(row['regression'] for row in comparison):
+            sys.exit(1)
+
+
+@click.command()
+@click.option("--tables", default=None, help="comma separated profile tables, default to all: "
+                                             "JAX_textHpoProfile,JAX_labHpoProfile")
+@click.option("--exclude_inferred", is_flag=True, help="only aggregate directly mapped phenotypes")
+@click.option("--rebuild", is_flag=True, help="drop the tables and aggregate all source rows")
+def refresh_profiles(tables, exclude_inferred, rebuild):
+    """
+    Create or incrementally update the persistent phenotype profile tables: aggregate the phenotype rows added since the
+    last refresh and add their occurrences to the tables.
+    """
+    import mimic_mf_analysis.profiles as profiles
+    tables = tables.split(',') if tables else None
+    for table, ranges in profiles.refresh_profiles(tables, not exclude_inferred, rebuild).items():
+        for source, (low, high) in ranges.items():
+            print('{}: {} ROW_ID {} -> {}'.format(table, source, low, high))
+
+
+@click.command()
+@click.option("--mimic_dir", required=True, help="directory of the MIMIC-III exports ADMISSIONS, DIAGNOSES_ICD, "
+                                                 "NOTEEVENTS and LABEVENTS (.csv.gz or .csv)")
+@click.option("--hpo_dir", default=None, help="directory of the HPO mapping exports, e.g. NoteHpoClinPhen.csv.gz and "
+                                              "LabHpo.csv.gz. Default to mimic_dir")
+@click.option("--exclude_inferred", is_flag=True, help="only aggregate directly mapped phenotypes")
+@click.option("--chunk_size", default=1000000, help="rows read from an export at a time")
+def ingest_exports(mimic_dir, hpo_dir, exclude_inferred, chunk_size):
+    """
+    Build the tables of the analysis in the configured database straight from CSV exports, streaming them in chunks:
+    admissions, DIAGNOSES_ICD and the phenotype profile tables.
+    """
+    import mimic_mf_analysis.ingest as ingest
+    for table, sources in ingest.ingest(mimic_dir, hpo_dir, not exclude_inferred, chunk_size).items():
+        print('{}: {}'.format(table, ', '.join(sources) or 'no sources'))
+
+
+@click.command()
+@click.argument("shard_dirs", nargs=-1, required=True)
+@click.option("--out", required=True, help="output directory of the merged summaries")
+@click.option("--format", type=click.Choice(['pickle', 'store']), default='pickle',
+              help="pickle: one pickle file per result; store: a memory-mappable result store in the output directory")
+@click.option("--compact", is_flag=True, help="save counts in the smallest unsigned dtype and only the cells that the "
+                                              "marginals do not determine, sparsely if few phenotype pairs co-occur")
+def merge_shards(shard_dirs, out, format, compact):
+    """
+    Add up the partial summaries of all shards of a --shard run, e.g. merge-shards --out merged shard1 ... shard8.
+    The shards have to be complete and run with the same parameters, and their phenotype labels have to match.
+    """
+    import mimic_mf_analysis.partials as partials
+    out_dir = pathlib.Path(out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for name, merged in partials.merge_shards(list(shard_dirs)).items():
+        save_results(merged, out_dir, name, format, compact)
+
+
+@click.command()
+@click.option("--summaries_path", required=True, help="summaries of the diseases, e.g. summaries_diag_rad_lab.obj, or "
+                                                      "a group of a result store")
+@click.option("--pairs", type=click.Choice(['rad_lab', 'rad_rad', 'lab_lab']), default='rad_lab',
+              help="kind of the summaries: textHpo * labHpo, textHpo * textHpo or labHpo * labHpo")
+@click.option("--p_values_path", default=None, help="p values from estimate, a pickle file or the p_values group of a "
+                                                    "result store")
+@click.option("--statistic", default='synergy', help="statistic of the exported p values")
+@click.option("--disease_of_interest", default=None, help="comma separated diseases. Default to all in the summaries")
+@click.option("--out", default=None, help="output file: .parquet (needs pyarrow), or else CSV, compressed if it ends "
+                                          "with .gz")
+@click.option("--table", default=None, help="instead of --out, replace this table of the configured database, loaded "
+                                            "in bulk (LOAD DATA LOCAL INFILE on MySQL)")
+@click.option("--chunk_rows", default=1000000, help="rows written or loaded at a time")
+def export(summaries_path, pairs, p_values_path, statistic, disease_of_interest, out, table, chunk_rows):
+    """
+    Export the mutual information, synergy and p values of all phenotype pairs of the diseases as one long table with
+    columns disease, term1, source1, term2, source2, mi, synergy and p.
+    """
+    if (out is None) == (table is None):
+        raise click.UsageError('give exactly one of --out and --table')
+    import mimic_mf_analysis.result_store as result_store
+    import mimic_mf_analysis.export as export_results
+    summaries = result_store.load_results(summaries_path)
+    p_values = result_store.load_results(p_values_path) if p_values_path else None
+    diseases = None if disease_of_interest is None else \
+        [disease for disease in disease_of_interest.split(',') if disease in summaries]
+    tables = export_results.pair_tables(summaries, pairs, p_values, diseases, statistic, chunk_rows)
+    if table is not None:
+        from mimic_mf_analysis import db
+        n = export_results.load_table(tables, table, db)
+        print('loaded {} phenotype pairs into table {}'.format(n, table))
+    else:
+        n = export_results.write_file(tables, out)
+        print('wrote {} phenotype pairs to {}'.format(n, out))
 
 
 def serialize_empirical_distributions(distribution, path):
+    import numpy as np
+    import pickle
     M1 = distribution.shape[0]
     M2 = distribution.shape[1]
     N = distribution.shape[2]
@@ -322,9 +888,19 @@ def serialize_empirical_distributions(distribution, path):
 
 cli.add_command(regardless_diagnosis)
 cli.add_command(regarding_diagnosis)
+cli.add_command(regarding_diagnosis_sparse)
 cli.add_command(build_synergy_tree)
+cli.add_command(build_synergy_trees)
 cli.add_command(simulate)
+cli.add_command(simulate_sharded)
 cli.add_command(estimate)
+cli.add_command(bootstrap)
+cli.add_command(convert_pickle)
+cli.add_command(run_benchmark)
+cli.add_command(refresh_profiles)
+cli.add_command(ingest_exports)
+cli.add_command(merge_shards)
+cli.add_command(export)
 
 
 if __name__=='__main__':
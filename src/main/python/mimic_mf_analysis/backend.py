@@ -0,0 +1,484 @@
+import os
+import pathlib
+import tempfile
+import numpy as np
+import pandas as pd
+import json
+import time
+import logging
+import mimic_mf_analysis.metrics as metrics
+import mimic_mf_analysis.diagnostics as diagnostics
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ['mysql', 'duckdb', 'sqlite']
+
+
+class Backend:
+    """
+    A database connection and the few statements whose syntax differs between database engines: session temporary
+    tables, auto-increment row ids, indexes and bulk loading. Queries in preparation.py and analysis.py are
+    otherwise portable SQL (CASE WHEN instead of IF(), CROSS JOIN instead of JOIN without ON, SUBSTR).
+    """
+    name = None
+    # keyword of session temporary tables
+    temporary = 'TEMP'
+    # placeholder of query parameters
+    placeholder = '?'
+    # whether executing a prepared statement again skips parsing and planning
+    reuses_plans = True
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = {}
+
+    def _bind(self, sql, params):
+        """
+        Statements are written with ? placeholders; translate them to the placeholder of the driver, and numpy scalars,
+        e.g. ROW_IDs from a data frame, to Python values.
+        """
+        if params is None:
+            return sql, None
+        params = [value.item() if isinstance(value, np.generic) else value for value in params]
+        if self.placeholder != '?':
+            sql = sql.replace('?', self.placeholder)
+        return sql, params
+
+    def execute(self, sql, params=None):
+        """
+        Execute a statement. Each statement is timed as stage 'statement' of the metrics.
+        @param params: values of the ? placeholders of the statement
+        """
+        diagnostics.registry.prepare(self, sql, params)
+        start = time.perf_counter()
+        result = self._execute(*self._bind(sql, params))
+        self._observe('statement', sql, time.perf_counter() - start)
+        return result
+
+    def _execute(self, sql, params=None):
+        if params is None:
+            return self.connection.execute(sql)
+        return self.connection.execute(sql, params)
+
+    def executemany(self, sql, rows):
+        return self.connection.executemany(sql, rows)
+
+    def read_sql(self, sql, params=None):
+        """
+        Run a query and return the result as a data frame. Each query is timed, with the rows and bytes it fetched,
+        as stage 'query' of the metrics.
+        @param params: values of the ? placeholders of the query
+        """
+        diagnostics.registry.prepare(self, sql, params)
+        start = time.perf_counter()
+        frame = self._read_sql(*self._bind(sql, params))
+        self._observe('query', sql, time.perf_counter() - start, frame)
+        return frame
+
+    def _read_sql(self, sql, params=None):
+        return pd.read_sql_query(sql, self.connection, params=params)
+
+    def prepare(self, sql):
+        """
+        A prepared statement of a query with ? placeholders. Statements are kept by their text, so preparing the same
+        query in every iteration of a loop returns the statement prepared in the first iteration.
+        :return: an instance of PreparedQuery
+        """
+        statement = self.statements.get(sql)
+        if statement is None:
+            statement = self.statements[sql] = PreparedQuery(self, sql)
+        return statement
+
+    def _prepare(self, sql):
+        # sqlite3 keeps compiled statements in a cache by their text; nothing to hold on to
+        return None
+
+    def _read_prepared(self, handle, sql, params):
+        return self._read_sql(sql, params)
+
+    def _close_prepared(self, handle):
+        pass
+
+    def _plan_seconds(self, sql, params):
+        """
+        An estimate of the time to parse and plan a query: the time of EXPLAIN, which parses and plans it without
+        executing it.
+        """
+        start = time.perf_counter()
+        try:
+            self.explain(sql, params)
+        except Exception as e:
+            logger.debug('cannot explain {}: {}'.format(sql, e))
+            return 0.0
+        return time.perf_counter() - start
+
+    def _observe(self, stage, sql, seconds, frame=None):
+        fields = {}
+        bytes = 0
+        if metrics.registry.enabled:
+            fields['sql'] = ' '.join(sql.split())
+            if frame is not None:
+                bytes = frame.memory_usage(deep=True).sum()
+        metrics.record(stage, seconds, rows=0 if frame is None else len(frame), bytes=bytes,
+                       labels={'backend': self.name}, **fields)
+        diagnostics.registry.observe(sql, seconds)
+
+    def explain(self, sql, params=None):
+        """
+        The plan of a query, in a form that can be serialized to JSON.
+        """
+        raise NotImplementedError
+
+    def full_scans(self, plan):
+        """
+        Tables that a plan from explain() reads in full, rather than through an index.
+        """
+        return []
+
+    def commit(self):
+        self.connection.commit()
+
+    def table_exists(self, name):
+        """
+        Whether a table, permanent or temporary, exists.
+        """
+        # not through pandas, which rolls back the transaction when a query fails
+        try:
+            self._execute('SELECT * FROM {} WHERE 1 = 0'.format(name))
+            return True
+        except Exception:
+            return False
+
+    def drop_temp_table(self, name):
+        self.execute('DROP TABLE IF EXISTS temp.{}'.format(name))
+
+    def create_temp_table_as(self, name, select, row_id=False, params=None, order_by=None):
+        """
+        Create a session temporary table from a query. A temporary table hides a permanent table of the same name.
+        @param name: table name
+        @param select: a SELECT statement, which may start with WITH
+        @param row_id: add a ROW_ID column numbering the rows from 1
+        @param params: values of the ? placeholders of the query
+        @param order_by: columns of the query that ROW_IDs are numbered by. The query should be ordered by them too.
+        """
+        if row_id:
+            select = 'SELECT ROW_NUMBER() OVER ({}) AS ROW_ID, q.* FROM ({}) AS q'.format(
+                'ORDER BY ' + order_by if order_by else '', select)
+        self.execute('CREATE {} TABLE {} AS {}'.format(self.temporary, name, select), params)
+
+    def add_row_id(self, table):
+        """
+        Add a ROW_ID column numbering the rows of a table from 1.
+        """
+        self.execute('ALTER TABLE {} ADD COLUMN ROW_ID INTEGER'.format(table))
+        self.execute('UPDATE {} SET ROW_ID = rowid'.format(table))
+
+    def create_index(self, name, table, columns):
+        self.execute('CREATE INDEX {} ON {} ({})'.format(name, table, columns))
+
+    def upsert_counts(self, table, select, key_columns, count_column):
+        """
+        Insert the rows of a query into a table with a unique key on key_columns. Where a key exists already, add the
+        count of the new row to the existing count instead.
+        @param select: a query with the columns of the table, in order, and at most one row per key
+        """
+        # WHERE true keeps ON CONFLICT from being parsed as a join constraint in SQLite
+        self.execute('INSERT INTO {} SELECT * FROM ({}) AS delta WHERE true ON CONFLICT ({}) DO UPDATE SET {} = {}.{} '
+                     '+ excluded.{}'.format(table, select, ', '.join(key_columns), count_column, table, count_column,
+                                            count_column))
+
+    def load_frame(self, name, frame, temporary=False, chunk_size=10000):
+        """
+        Create a table from a data frame, replacing a table of the same name.
+        @param temporary: create a session temporary table, which hides a permanent table of the same name
+        """
+        self.create_table(name, frame.dtypes, temporary)
+        self.append_frame(name, frame, chunk_size)
+        self.commit()
+
+    def create_table(self, name, dtypes, temporary=False):
+        """
+        Create an empty table, replacing a table of the same name.
+        @param dtypes: a series from column name to pandas dtype, e.g. frame.dtypes
+        @param temporary: create a session temporary table, which hides a permanent table of the same name
+        """
+        columns = ', '.join('{} {}'.format(column, _sql_type(dtype)) for column, dtype in dtypes.items())
+        if temporary:
+            self.drop_temp_table(name)
+        else:
+            self.execute('DROP TABLE IF EXISTS {}'.format(name))
+        self.execute('CREATE {}TABLE {} ({})'.format(self.temporary + ' ' if temporary else '', name, columns))
+
+    def append_frame(self, name, frame, chunk_size=10000):
+        """
+        Insert the rows of a data frame into an existing table that has its columns.
+        """
+        insert = 'INSERT INTO {} ({}) VALUES ({})'.format(name, ', '.join(frame.columns),
+                                                          ', '.join([self.placeholder] * len(frame.columns)))
+        rows = frame.astype(object).where(frame.notna(), None).values.tolist()
+        for start in range(0, len(rows), chunk_size):
+            self.executemany(insert, rows[start:start + chunk_size])
+
+    def bulk_append(self, name, frame):
+        """
+        Insert a large data frame into an existing table that has its columns, with the fastest bulk path of the
+        engine. Missing values are inserted as NULL.
+        """
+        self.append_frame(name, frame)
+
+    def load_file(self, name, path, chunk_size=100000, columns=None, dtype=None):
+        """
+        Load a table from a local CSV (optionally gzipped, e.g. the MIMIC-III distribution files) or Parquet file.
+        CSV files are read in chunks of chunk_size rows.
+        @param columns: load only these columns
+        @param dtype: a dictionary from column to type, e.g. {'ICD9_CODE': str} to keep leading zeros
+        """
+        if str(path).endswith('.parquet'):
+            self.load_frame(name, pd.read_parquet(path, columns=columns))
+            return
+        for i, chunk in enumerate(pd.read_csv(path, chunksize=chunk_size, usecols=columns, dtype=dtype)):
+            if i == 0:
+                self.load_frame(name, chunk)
+            else:
+                self.append_frame(name, chunk)
+        self.commit()
+
+
+class PreparedQuery:
+    """
+    A query with ? placeholders that is prepared once and executed with different values, e.g. for the ROW_ID range
+    of each batch. Values are bound rather than formatted into the SQL text, so the engine does not parse and plan the
+    query again for every batch, and string values need no quoting.
+    While metrics are enabled, the parse and plan time of the query is estimated once, and every further execution on
+    an engine that reuses plans records it as stage 'prepare_saved'.
+    """
+    def __init__(self, backend, sql):
+        self.backend = backend
+        self.sql = sql
+        self.handle = backend._prepare(sql)
+        self.executions = 0
+        self.plan_seconds = None
+
+    def read(self, params):
+        """
+        Execute the query.
+        @param params: values of the ? placeholders
+        :return: the result as a data frame
+        """
+        backend = self.backend
+        sql, params = backend._bind(self.sql, params)
+        diagnostics.registry.prepare(backend, self.sql, params)
+        if self.plan_seconds is None and metrics.registry.enabled:
+            self.plan_seconds = backend._plan_seconds(self.sql, params)
+        start = time.perf_counter()
+        frame = backend._read_prepared(self.handle, sql, params)
+        backend._observe('query', self.sql, time.perf_counter() - start, frame)
+        self.executions += 1
+        if self.executions > 1 and backend.reuses_plans and self.plan_seconds:
+            metrics.record('prepare_saved', self.plan_seconds, labels={'backend': backend.name})
+        return frame
+
+    def close(self):
+        self.backend._close_prepared(self.handle)
+
+
+class MySQLBackend(Backend):
+    name = 'mysql'
+    temporary = 'TEMPORARY'
+    placeholder = '%s'
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        self.cursor = connection.cursor(buffered=True)
+
+    def _execute(self, sql, params=None):
+        self.cursor.execute(sql, params)
+        return self.cursor
+
+    def executemany(self, sql, rows):
+        self.cursor.executemany(sql, rows)
+        return self.cursor
+
+    def drop_temp_table(self, name):
+        self.execute('DROP TEMPORARY TABLE IF EXISTS {}'.format(name))
+
+    def create_temp_table_as(self, name, select, row_id=False, params=None, order_by=None):
+        # AUTO_INCREMENT numbers rows in the order of the query
+        if row_id:
+            self.execute('CREATE TEMPORARY TABLE {}(ROW_ID MEDIUMINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY) '
+                         '{}'.format(name, select), params)
+        else:
+            self.execute('CREATE TEMPORARY TABLE {} {}'.format(name, select), params)
+
+    def _prepare(self, sql):
+        # a server-side prepared statement per query: the cursor re-prepares whenever its statement text changes
+        return self.connection.cursor(prepared=True)
+
+    def _read_prepared(self, handle, sql, params):
+        handle.execute(sql, params)
+        return pd.DataFrame(handle.fetchall(), columns=list(handle.column_names))
+
+    def _close_prepared(self, handle):
+        handle.close()
+
+    def add_row_id(self, table):
+        self.execute('ALTER TABLE {} ADD COLUMN ROW_ID INT AUTO_INCREMENT PRIMARY KEY'.format(table))
+
+    def bulk_append(self, name, frame):
+        # LOAD DATA LOCAL INFILE parses a client-side CSV file in one statement, much faster than batched INSERTs
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            frame.to_csv(f, index=False, header=False, na_rep='\\N', lineterminator='\n')
+        try:
+            self.execute("LOAD DATA LOCAL INFILE '{}' INTO TABLE {} FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY "
+                         "'\"' LINES TERMINATED BY '\\n' ({})".format(pathlib.Path(f.name).as_posix(), name,
+                                                                      ', '.join(frame.columns)))
+        finally:
+            os.remove(f.name)
+
+    def upsert_counts(self, table, select, key_columns, count_column):
+        self.execute('INSERT INTO {} SELECT * FROM ({}) AS delta ON DUPLICATE KEY UPDATE {} = {} + VALUES({})'.format(
+            table, select, count_column, count_column, count_column))
+
+    def explain(self, sql, params=None):
+        self.cursor.execute(*self._bind('EXPLAIN FORMAT=JSON ' + sql, params))
+        return json.loads(self.cursor.fetchone()[0])
+
+    def full_scans(self, plan):
+        # access_type ALL is a full table scan
+        scans = []
+        if isinstance(plan, dict):
+            if plan.get('access_type') == 'ALL' and 'table_name' in plan:
+                scans.append(plan['table_name'])
+            plan = list(plan.values())
+        if isinstance(plan, list):
+            for value in plan:
+                scans.extend(self.full_scans(value))
+        return scans
+
+
+class DuckDBBackend(Backend):
+    """
+    DuckDB, an embedded columnar engine. GROUP BY and join heavy queries run in parallel over columnar data, and
+    tables can be loaded directly from local CSV and Parquet files.
+    """
+    name = 'duckdb'
+    # the Python API prepares a statement with parameters again on every execution
+    reuses_plans = False
+
+    def _read_sql(self, sql, params=None):
+        return self.connection.execute(sql, params).df()
+
+    def table_exists(self, name):
+        # a failed statement would abort an open transaction
+        return self.connection.execute('SELECT COUNT(*) FROM duckdb_tables() WHERE lower(table_name) = lower(?)',
+                                       [name]).fetchone()[0] > 0
+
+    def explain(self, sql, params=None):
+        return json.loads(self.connection.execute('EXPLAIN (FORMAT json) ' + sql, params).fetchall()[0][1])
+
+    def full_scans(self, plan):
+        # DuckDB has no secondary indexes for joins, so every table is scanned sequentially; scans are still listed
+        scans = []
+        for node in plan:
+            if node.get('name') == 'SEQ_SCAN':
+                scans.append(node.get('extra_info', {}).get('Table', '').split('.')[-1])
+            scans.extend(self.full_scans(node.get('children', [])))
+        return scans
+
+    def add_row_id(self, table):
+        # rowid is a 0-based pseudo column of DuckDB tables
+        self.execute('ALTER TABLE {} ADD COLUMN ROW_ID BIGINT'.format(table))
+        self.execute('UPDATE {} SET ROW_ID = rowid + 1'.format(table))
+
+    def create_index(self, name, table, columns):
+        # DuckDB joins with hash joins; ART indexes only help point lookups and would block ALTER TABLE
+        logger.debug('index {} on {} skipped on duckdb'.format(name, table))
+
+    def load_frame(self, name, frame, temporary=False, chunk_size=None):
+        if temporary:
+            self.drop_temp_table(name)
+        else:
+            self.execute('DROP TABLE IF EXISTS {}'.format(name))
+        self.connection.register('load_frame_view', frame)
+        try:
+            self.execute('CREATE {}TABLE {} AS SELECT * FROM load_frame_view'.format(
+                'TEMP ' if temporary else '', name))
+        finally:
+            self.connection.unregister('load_frame_view')
+
+    def append_frame(self, name, frame, chunk_size=None):
+        self.connection.register('append_frame_view', frame)
+        try:
+            self.execute('INSERT INTO {} ({}) SELECT {} FROM append_frame_view'.format(
+                name, ', '.join(frame.columns), ', '.join(frame.columns)))
+        finally:
+            self.connection.unregister('append_frame_view')
+
+    def load_file(self, name, path, chunk_size=None, columns=None, dtype=None):
+        # DuckDB reads the file in parallel and in a streaming fashion itself
+        if str(path).endswith('.parquet'):
+            reader = "read_parquet('{}')".format(path)
+        elif dtype:
+            reader = "read_csv_auto('{}', types={{{}}})".format(path, ', '.join(
+                "'{}': '{}'".format(column, _sql_type(pd.api.types.pandas_dtype(type)).split('(')[0])
+                for column, type in dtype.items()))
+        else:
+            reader = "read_csv_auto('{}')".format(path)
+        self.execute('DROP TABLE IF EXISTS {}'.format(name))
+        self.execute('CREATE TABLE {} AS SELECT {} FROM {}'.format(name, ', '.join(columns) if columns else '*',
+                                                                   reader))
+
+
+class SQLiteBackend(Backend):
+    name = 'sqlite'
+
+    def explain(self, sql, params=None):
+        return [row[-1] for row in self.connection.execute('EXPLAIN QUERY PLAN ' + sql, params or ()).fetchall()]
+
+    def full_scans(self, plan):
+        # e.g. SCAN JAX_textHpoProfile, as opposed to SEARCH JAX_textHpoProfile USING INDEX ...
+        return [detail.split()[1] for detail in plan if detail.startswith('SCAN ') and 'INDEX' not in detail]
+
+
+def _sql_type(dtype):
+    if pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype):
+        return 'BIGINT'
+    elif pd.api.types.is_float_dtype(dtype):
+        return 'DOUBLE'
+    else:
+        return 'VARCHAR(255)'
+
+
+def connect(config):
+    """
+    Connect to the database configured in the database section of analysisConfig.yaml.
+    backend: mysql (default), duckdb or sqlite
+    mysql: host, user, password, database
+    duckdb, sqlite: path of the database file (default to an in-memory database), and optionally tables, a mapping from
+    table name to a local CSV or Parquet file that is loaded if the table does not exist yet
+    :return: an instance of Backend
+    """
+    backend = config.get('backend') or 'mysql'
+    if backend == 'mysql':
+        import mysql.connector
+        db = MySQLBackend(mysql.connector.connect(host=config['host'],
+                                                  user=config['user'],
+                                                  passwd=config['password'],
+                                                  database=config['database'],
+                                                  auth_plugin='mysql_native_password',
+                                                  # for bulk_append (LOAD DATA LOCAL INFILE)
+                                                  allow_local_infile=True))
+    elif backend == 'duckdb':
+        import duckdb
+        db = DuckDBBackend(duckdb.connect(config.get('path') or ':memory:'))
+    elif backend == 'sqlite':
+        import sqlite3
+        db = SQLiteBackend(sqlite3.connect(config.get('path') or ':memory:'))
+    else:
+        raise ValueError('unknown database backend {}, use one of {}'.format(backend, BACKENDS))
+
+    for name, path in (config.get('tables') or {}).items():
+        if not db.table_exists(name):
+            logger.info('loading table {} from {}'.format(name, path))
+            db.load_file(name, path)
+    return db
@@ -0,0 +1,238 @@
+import numpy as np
+import gc
+import json
+import time
+import platform
+import resource
+import tracemalloc
+import logging
+import mutual_information.mf as mf
+from mutual_information.mf_random import synergy_random
+import mimic_mf_analysis.synthetic as synthetic
+import mimic_mf_analysis.simulation as simulation
+import mimic_mf_analysis.dedup as dedup
+import mimic_mf_analysis.sparse_pairs as sparse_pairs
+
+logger = logging.getLogger(__name__)
+
+# stages that run on synthetic data in memory
+MEMORY_STAGES = ['summarize', 'summarize_dedup', 'summarize_sparse', 'simulate']
+# stages that run the database queries against synthetic temporary tables (see synthetic.shadow_tables)
+DB_STAGES = ['batch_query', 'summarize_diagnosis_textHpo_labHpo', 'precompute_mf_dict']
+STAGES = MEMORY_STAGES + DB_STAGES
+
+
+def measure(stage, function, rows):
+    """
+    Run a stage once and record its wall time, throughput and peak memory. Peak memory is the peak of memory
+    allocated through Python and numpy while the stage runs (tracemalloc), and max_rss is the peak resident set
+    size of the process so far.
+    @param stage: stage name
+    @param function: a function without arguments that runs the stage
+    @param rows: number of rows (encounters, or simulated encounters) that the stage processes
+    :return: a dictionary of measurements
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    wall_time = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {'stage': stage,
+              'wall_time': wall_time,
+              'rows': int(rows),
+              'rows_per_second': rows / wall_time if wall_time > 0 else None,
+              'peak_memory': int(peak_memory),
+              # kilobytes on Linux
+              'max_rss': int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) * 1024}
+    logger.info('{}: {:.3f}s, {:.0f} rows/s, peak memory {:.1f} MB'.format(
+        stage, wall_time, result['rows_per_second'] or 0, peak_memory / 2 ** 20))
+    return result
+
+
+def _summarize(d, X, Y, batch_size=100):
+    # the counting loop of summarize_diagnosis_textHpo_labHpo
+    summaries = [mf.SummaryXYz(np.arange(X.shape[1]), np.arange(Y.shape[1]), 'z'),
+                 mf.SummaryXYz(np.arange(X.shape[1]), np.arange(X.shape[1]), 'z'),
+                 mf.SummaryXYz(np.arange(Y.shape[1]), np.arange(Y.shape[1]), 'z')]
+    for start in range(0, len(d), batch_size):
+        batch = slice(start, start + batch_size)
+        summaries[0].add_batch(X[batch], Y[batch], d[batch])
+        summaries[1].add_batch(X[batch], X[batch], d[batch])
+        summaries[2].add_batch(Y[batch], Y[batch], d[batch])
+    return summaries
+
+
+def _summarize_dedup(d, X, Y, batch_size=100):
+    profiles = dedup.ProfileCounter(X.shape[1], Y.shape[1])
+    for start in range(0, len(d), batch_size):
+        batch = slice(start, start + batch_size)
+        profiles.add_batch(X[batch], Y[batch], d[batch])
+    d, X, Y, weights = profiles.profiles()
+    summaries = [mf.SummaryXYz(np.arange(X.shape[1]), np.arange(Y.shape[1]), 'z'),
+                 mf.SummaryXYz(np.arange(X.shape[1]), np.arange(X.shape[1]), 'z'),
+                 mf.SummaryXYz(np.arange(Y.shape[1]), np.arange(Y.shape[1]), 'z')]
+    dedup.add_weighted(summaries[0], X, Y, d, weights)
+    dedup.add_weighted(summaries[1], X, X, d, weights)
+    dedup.add_weighted(summaries[2], Y, Y, d, weights)
+    return summaries
+
+
+def _summarize_sparse(d, X, Y, batch_size=10000):
+    summary = sparse_pairs.SparseSummaryXYz(np.arange(X.shape[1]), np.arange(Y.shape[1]), 'z')
+    for start in range(0, len(d), batch_size):
+        batch = slice(start, start + batch_size)
+        summary.add_batch(X[batch], Y[batch], d[batch])
+    summary.prune(5)
+    return summary
+
+
+def _simulate(summary, simulations):
+    diag_prob, phenotype_prob1, phenotype_prob2, TOTAL = simulation.null_parameters(summary)
+    for seed in range(simulations):
+        synergy_random(diag_prob, phenotype_prob1, phenotype_prob2, TOTAL, seed)
+
+
+def _top_threshold(rank_table, n, db):
+    # frequency threshold that selects about the n most frequent phenotypes of a rank table
+    counts = db.read_sql('SELECT N FROM {} ORDER BY N DESC'.format(rank_table)).N.values
+    return int(counts[min(n, len(counts)) - 1]) if len(counts) > 0 else 1
+
+
+def _db_stages(data, stages, diagnosis, panel_size, batch_size):
+    # analysis opens a cursor on the database when it is imported, so only database stages import it
+    from mimic_mf_analysis import db
+    import mimic_mf_analysis.analysis as analysis
+
+    synthetic.shadow_tables(data, db)
+    analysis.initTables()
+    analysis.createDiagnosisTable(diagnosis, False)
+    analysis.indexDiagnosisTable()
+    analysis.rankHpoFromText(diagnosis, 1)
+    analysis.rankHpoFromLab(diagnosis, 3)
+    textHpo_min = _top_threshold('JAX_textHpoFrequencyRank', panel_size, db)
+    labHpo_min = _top_threshold('JAX_labHpoFrequencyRank', panel_size, db)
+    thresholds = (1, 3, textHpo_min, 10 ** 9, labHpo_min, 10 ** 9)
+    n_encounters = len(data['admissions'])
+
+    results = []
+    if 'batch_query' in stages:
+        start_index, end_index = \
+            db.read_sql('SELECT MIN(ROW_ID) AS min, MAX(ROW_ID) AS max FROM JAX_mf_diag').iloc[0]
+
+        def run():
+            for start in range(start_index, end_index + 1, batch_size):
+                analysis.batch_query(start, min(start + batch_size - 1, end_index), *thresholds)
+        results.append(measure('batch_query', run, n_encounters))
+    if 'summarize_diagnosis_textHpo_labHpo' in stages:
+        def run():
+            analysis.summarize_diagnosis_textHpo_labHpo(False, 1, 3, 0, textHpo_min, 10 ** 9, labHpo_min, 10 ** 9,
+                                                        [diagnosis], logger)
+        results.append(measure('summarize_diagnosis_textHpo_labHpo', run, n_encounters))
+    if 'precompute_mf_dict' in stages:
+        textHpos = db.read_sql('SELECT MAP_TO FROM JAX_textHpoFrequencyRank ORDER BY N DESC LIMIT 3').MAP_TO.values
+        labHpos = db.read_sql('SELECT MAP_TO FROM JAX_labHpoFrequencyRank ORDER BY N DESC LIMIT 3').MAP_TO.values
+        db.drop_temp_table('Jax_multivariant_synergy_table')
+        analysis.add_diag_columns(diagnosis, False)
+        var_dict = analysis.add_phenotype_columns(labHpos, textHpos, 3, 1)
+        results.append(measure('precompute_mf_dict', lambda: analysis.precompute_mf_dict(var_dict.keys()),
+                               n_encounters))
+    return results
+
+
+def run_benchmarks(n_encounters=10000, stages=None, seed=0, diagnosis='428', panel_size=30, simulations=5,
+                   batch_size=100):
+    """
+    Generate synthetic data and run the benchmark stages on it.
+    @param n_encounters: number of synthetic admissions
+    @param stages: stage names, default to all stages that run in memory (MEMORY_STAGES). Database stages (DB_STAGES)
+    load the synthetic data into temporary tables of the configured database.
+    @param seed: seed of the synthetic data
+    @param diagnosis: diagnosis of interest
+    @param panel_size: number of phenotypes of each kind (textHpo, labHpo), the most frequent ones
+    @param simulations: number of simulations in the simulate stage
+    @param batch_size: encounters per batch, as in summarize_diagnosis_textHpo_labHpo
+    :return: a report: a dictionary with the configuration and a list of stage measurements
+    """
+    if stages is None:
+        stages = MEMORY_STAGES
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError('unknown benchmark stages: {}'.format(sorted(unknown)))
+
+    start = time.perf_counter()
+    data = synthetic.generate(n_encounters, seed=seed)
+    logger.info('generated {} synthetic encounters in {:.1f}s'.format(n_encounters, time.perf_counter() - start))
+    textHpos = synthetic.frequent_phenotypes(data, 'JAX_textHpoProfile', panel_size, 1)
+    labHpos = synthetic.frequent_phenotypes(data, 'JAX_labHpoProfile', panel_size, 3)
+    d, X, Y = synthetic.to_matrices(data, diagnosis, textHpos, labHpos)
+
+    results = []
+    if 'summarize' in stages:
+        results.append(measure('summarize', lambda: _summarize(d, X, Y, batch_size), n_encounters))
+    if 'summarize_dedup' in stages:
+        results.append(measure('summarize_dedup', lambda: _summarize_dedup(d, X, Y, batch_size), n_encounters))
+    if 'summarize_sparse' in stages:
+        results.append(measure('summarize_sparse', lambda: _summarize_sparse(d, X, Y), n_encounters))
+    if 'simulate' in stages:
+        summary = _summarize_dedup(d, X, Y)[0]
+        results.append(measure('simulate', lambda: _simulate(summary, simulations), simulations * n_encounters))
+    db_stages = [stage for stage in stages if stage in DB_STAGES]
+    if db_stages:
+        results.extend(_db_stages(data, db_stages, diagnosis, panel_size, batch_size))
+
+    return {'config': {'n_encounters': n_encounters, 'seed': seed, 'diagnosis': diagnosis, 'panel_size': panel_size,
+                       'simulations': simulations, 'batch_size': batch_size},
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'machine': platform.machine(), 'processor': platform.processor()},
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results}
+
+
+def save_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+
+def load_report(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def compare(report, baseline, tolerance=0.2):
+    """
+    Compare a report against a baseline report, stage by stage.
+    @param report: a report from run_benchmarks()
+    @param baseline: an earlier report, run with the same configuration
+    @param tolerance: relative slowdown (wall time) or growth (peak memory) that counts as a regression
+    :return: a list of dictionaries: stage, time_ratio, memory_ratio (current / baseline) and regression
+    """
+    if report['config'] != baseline['config']:
+        logger.warning('benchmark configurations differ, comparison may be meaningless: {} vs {}'.format(
+            report['config'], baseline['config']))
+    baseline_results = {result['stage']: result for result in baseline['results']}
+    comparison = []
+    for result in report['results']:
+        before = baseline_results.get(result['stage'])
+        if before is None:
+            continue
+        time_ratio = result['wall_time'] / before['wall_time'] if before['wall_time'] > 0 else None
+        memory_ratio = result['peak_memory'] / before['peak_memory'] if before['peak_memory'] > 0 else None
+        comparison.append({'stage': result['stage'],
+                           'time_ratio': time_ratio,
+                           'memory_ratio': memory_ratio,
+                           'regression': any(ratio is not None and ratio > 1 + tolerance
+                                             for ratio in [time_ratio, memory_ratio])})
+    return comparison
+
+
+def format_comparison(comparison):
+    lines = ['{:<40}{:>12}{:>12}'.format('stage', 'time', 'memory')]
+    for row in comparison:
+        lines.append('{:<40}{:>12}{:>12}{}'.format(
+            row['stage'],
+            '-' if row['time_ratio'] is None else '{:.2f}x'.format(row['time_ratio']),
+            '-' if row['memory_ratio'] is None else '{:.2f}x'.format(row['memory_ratio']),
+            '  REGRESSION' if row['regression'] else ''))
+    return '\n'.join(lines)
@@ -0,0 +1,188 @@
+import logging
+import itertools
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+METHODS = ('poisson', 'multinomial')
+# random counts drawn at a time, 128 MB of int64
+MAX_DRAWS = 2 ** 24
+
+
+# n * log2(n) of the counts 0, 1, 2, ..., extended as larger counts come up
+_nlogn_table = np.zeros(1)
+
+
+def _nlogn(counts):
+    """
+    n * log2(n) of counts, 0 for n = 0. Integer counts, e.g. bootstrap replicates, are looked up in a table rather
+    than taking a logarithm per cell.
+    """
+    global _nlogn_table
+    counts = np.asarray(counts)
+    if np.issubdtype(counts.dtype, np.integer) and counts.size > 0:
+        largest = int(counts.max())
+        if largest >= len(_nlogn_table):
+            n = np.arange(2 * largest + 1, dtype=float)
+            n[0] = 1
+            _nlogn_table = n * np.log2(n)
+        return _nlogn_table[counts]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, counts * np.log2(counts), 0)
+
+
+def _linear_forms(variables, statistics):
+    """
+    Mutual information as linear forms of counts. I(A;B) = (S_AB - S_A - S_B + S) / N, where S_V is the sum of
+    n * log2(n) over the counts n of the marginal table of variables V and S = N * log2(N), and every marginal count is
+    a sum of cells, so all statistics of a table take two matrix products and a lookup.
+    @param variables: names of the binary variables of a table, e.g. 'xyz', cells in the order +..+ to -..-
+    @param statistics: a dictionary from statistic name to the variables (A, B) of I(A;B)
+    :return: a cells x marginal counts matrix, a marginal counts x statistics matrix, the column of N and the names of
+    the statistics
+    """
+    cells = list(itertools.product([0, 1], repeat=len(variables)))
+    marginals = []
+    for A, B in statistics.values():
+        for subset in [''.join(sorted(A + B)), A, B, '']:
+            if subset not in marginals:
+                marginals.append(subset)
+    columns = []
+    for subset in marginals:
+        axes = [variables.index(variable) for variable in subset]
+        for values in itertools.product([0, 1], repeat=len(axes)):
+            columns.append((subset, [all(cell[axis] == value for axis, value in zip(axes, values))
+                                     for cell in cells]))
+    to_counts = np.array([indicator for _, indicator in columns], dtype=float).T
+    to_statistics = np.zeros([len(columns), len(statistics)])
+    for k, (A, B) in enumerate(statistics.values()):
+        for subset, sign in [(''.join(sorted(A + B)), 1), (A, -1), (B, -1), ('', 1)]:
+            to_statistics[[i for i, (name, _) in enumerate(columns) if name == subset], k] += sign
+    return to_counts, to_statistics, [name for name, _ in columns].index(''), list(statistics)
+
+
+_XY = _linear_forms('xy', {'mf_XY': ('x', 'y')})
+_XYZ = _linear_forms('xyz', {'mf_XY_z': ('xy', 'z'), 'mf_Xz': ('x', 'z'), 'mf_Yz': ('y', 'z')})
+
+
+def _mutual_info(cells, forms):
+    to_counts, to_statistics, total_column, names = forms
+    cells = np.asarray(cells)
+    shape = cells.shape[:-1]
+    counts = cells.reshape([-1, cells.shape[-1]]).astype(float) @ to_counts
+    if np.issubdtype(cells.dtype, np.integer):
+        # sums of integer cells are exact in floating point
+        counts = counts.astype(np.int64)
+    total = np.maximum(counts[:, total_column], 1)
+    values = (_nlogn(counts) @ to_statistics) / total[:, np.newaxis]
+    return {name: values[:, k].reshape(shape) for k, name in enumerate(names)}
+
+
+def mutual_info_xy(cells):
+    """
+    Mutual information I(x;y) in bits of tables of counts (..., 4) in the order ++, +-, -+, -- of (x, y), e.g. the
+    cells of SummaryXY.m or of SummaryXYz.m1 with the diagnosis as y.
+    """
+    return _mutual_info(cells, _XY)['mf_XY']
+
+
+def mutual_info_xyz(cells):
+    """
+    Mutual information of pairs with the diagnosis, from tables of counts (..., 8) in the order of SummaryXYz.m2:
+    +++, ++-, +-+, +--, -++, -+-, --+, --- of (x, y, z). Every statistic of a pair only depends on its 8 cells.
+    :return: a dictionary of I(x,y;z) (mf_XY_z), I(x;z) (mf_Xz), I(y;z) (mf_Yz) and synergy
+    """
+    statistics = _mutual_info(cells, _XYZ)
+    statistics['synergy'] = statistics['mf_XY_z'] - statistics['mf_Xz'] - statistics['mf_Yz']
+    return statistics
+
+
+def resample(cells, resamples, rng, method='poisson'):
+    """
+    Draw bootstrap replicates of tables of counts.
+    poisson: every cell is drawn from Poisson(count), as if every encounter had a Poisson(1) weight, so the total
+    varies around N; multinomial: N encounters are drawn with replacement, cell probabilities count / N.
+    @param cells: a K x C matrix of counts
+    @param rng: a numpy Generator
+    :return: a K x resamples x C array of counts
+    """
+    cells = np.asarray(cells, dtype=float)
+    if method == 'poisson':
+        return rng.poisson(cells[:, np.newaxis, :], size=(len(cells), resamples, cells.shape[-1]))
+    elif method == 'multinomial':
+        total = cells.sum(axis=-1)
+        p = cells / np.maximum(total, 1)[:, np.newaxis]
+        return rng.multinomial(total.astype(np.int64)[:, np.newaxis], p[:, np.newaxis, :],
+                               size=(len(cells), resamples))
+    raise ValueError('method has to be one of {}: {}'.format(', '.join(METHODS), method))
+
+
+def _intervals(cells, statistics, resamples, alpha, rng, method, chunk_size):
+    """
+    Percentile intervals of statistics of K tables of counts, resampling chunk_size tables at a time, so that at most
+    chunk_size x resamples x C counts are in memory.
+    @param statistics: a function from tables of counts (..., C) to a dictionary of statistics
+    :return: a dictionary from statistic name to its lower and upper bounds, two vectors of size K
+    """
+    if chunk_size is None:
+        chunk_size = max(1, MAX_DRAWS // (resamples * cells.shape[-1]))
+    bounds = {}
+    for start in range(0, len(cells), chunk_size):
+        replicates = statistics(resample(cells[start:start + chunk_size], resamples, rng, method))
+        for name, values in replicates.items():
+            lower, upper = np.quantile(values, [alpha / 2, 1 - alpha / 2], axis=1)
+            bounds.setdefault(name, ([], []))
+            bounds[name][0].append(lower)
+            bounds[name][1].append(upper)
+    return {name: (np.concatenate(lower), np.concatenate(upper)) for name, (lower, upper) in bounds.items()}
+
+
+def confidence_intervals(summary, resamples=1000, alpha=0.05, method='poisson', seed=None, chunk_size=None):
+    """
+    Bootstrap confidence intervals of the mutual information of all phenotypes and phenotype pairs of a summary,
+    resampling the stored contingency tables instead of encounters: a pair's statistics only depend on its cells,
+    so a replicate of the cells is a replicate of the statistics. Pairs are resampled independently, which is right
+    for the interval of each pair but not for joint statements about several pairs.
+    @param summary: an instance of SummaryXYz (intervals of mf_XY_z and synergy per pair, mf_Xz and mf_Yz per
+    phenotype), SummaryXY (intervals of mf_XY per pair) or sparse_pairs.SparseSummaryXYz (intervals of mf_XY_z and
+    synergy of the stored pairs, as vectors aligned with 'rows' and 'cols')
+    @param resamples: number of bootstrap replicates
+    @param alpha: 1 - confidence level, e.g. 0.05 for 95% percentile intervals
+    @param method: 'poisson' or 'multinomial', see resample()
+    @param seed: seed of the random numbers
+    @param chunk_size: number of tables resampled at a time. Default to as many as fit in MAX_DRAWS counts
+    :return: a dictionary from {statistic}_lower and {statistic}_upper to arrays shaped like the statistic (M1 x M2
+    for pairs, M1 or M2 for single phenotypes)
+    """
+    rng = np.random.default_rng(seed)
+    intervals = {}
+    tables = []
+
+    def pair_statistics(cells):
+        return {name: value for name, value in mutual_info_xyz(cells).items() if name in ['mf_XY_z', 'synergy']}
+
+    if hasattr(summary, 'pairs'):
+        # a sparse summary: the stored pairs only, aligned with their rows and cols
+        rows, cols, cells = summary.m2()
+        tables.append((_intervals(cells, pair_statistics, resamples, alpha, rng, method, chunk_size), [len(rows)]))
+        intervals.update(rows=rows, cols=cols)
+    elif hasattr(summary, 'm2'):
+        M1, M2 = summary.m2.shape[:2]
+        pairs = _intervals(np.asarray(summary.m2).reshape([M1 * M2, 8]), pair_statistics, resamples, alpha, rng,
+                           method, chunk_size)
+        tables.append((pairs, [M1, M2]))
+        for name, key, M in [('mf_Xz', 'set1', M1), ('mf_Yz', 'set2', M2)]:
+            single = _intervals(np.asarray(summary.m1[key]).reshape([M, 4]),
+                                lambda cells: {name: mutual_info_xy(cells)}, resamples, alpha, rng, method,
+                                chunk_size)
+            tables.append((single, [M]))
+    else:
+        M1, M2 = summary.m.shape[:2]
+        pairs = _intervals(np.asarray(summary.m).reshape([M1 * M2, 4]), lambda cells: {'mf_XY': mutual_info_xy(cells)},
+                           resamples, alpha, rng, method, chunk_size)
+        tables.append((pairs, [M1, M2]))
+    for bounds, shape in tables:
+        for name, (lower, upper) in bounds.items():
+            intervals[name + '_lower'] = lower.reshape(shape)
+            intervals[name + '_upper'] = upper.reshape(shape)
+    return intervals
@@ -9,11 +9,18 @@ import pandas as pd
 
 
 def load_mutual_information_pairs(path: str):
+    """
+    Read phenotype pairs and their mutual information from a CSV file with columns P1, P2 and mf, or from the output
+    of the export command (term1, term2 and mi).
+    """
     mutual_information_pairs = []
     with open(path, 'r') as f:
         reader = csv.DictReader(f)
         for line in reader:
-            mutual_information_pairs.append(('P1_' + line['P1'], 'P2_' + line['P2'], float(line['mf'])))
+            if 'term1' in line:
+                mutual_information_pairs.append(('P1_' + line['term1'], 'P2_' + line['term2'], float(line['mi'])))
+            else:
+                mutual_information_pairs.append(('P1_' + line['P1'], 'P2_' + line['P2'], float(line['mf'])))
     return mutual_information_pairs
 
 
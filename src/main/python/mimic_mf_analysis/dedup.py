@@ -0,0 +1,169 @@
+import numpy as np
+import mutual_information.mf as mf
+
+
+def pack_rows(P1, P2, d=None):
+    """
+    Pack each encounter's (diagnosis, phenotypes in X, phenotypes in Y) row into one fixed-width byte string, so that
+    identical rows can be found by hashing or sorting the byte strings.
+    @param P1: a N x M1 binary matrix
+    @param P2: a N x M2 binary matrix
+    @param d: a size N binary vector. Default to all zeros.
+    :return: a size N array of np.void byte strings
+    """
+    N = P1.shape[0]
+    if d is None:
+        d = np.zeros(N, dtype=np.uint8)
+    rows = np.concatenate([np.asarray(d, dtype=np.uint8).reshape([N, 1]),
+                           np.asarray(P1, dtype=np.uint8),
+                           np.asarray(P2, dtype=np.uint8)], axis=1)
+    packed = np.ascontiguousarray(np.packbits(rows, axis=1))
+    return packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+
+
+def unpack_rows(keys, M1, M2):
+    """
+    Reverse of pack_rows().
+    :return: d, P1, P2
+    """
+    packed = keys.view(np.uint8).reshape([len(keys), -1])
+    rows = np.unpackbits(packed, axis=1, count=1 + M1 + M2).astype(int)
+    return rows[:, 0], rows[:, 1:1 + M1], rows[:, 1 + M1:]
+
+
+class ProfileCounter:
+    """
+    Compress encounters into unique (diagnosis, X, Y) profiles and their multiplicities. Many encounters share the same
+    profile over a small phenotype panel, so counting the unique profiles with weights is much cheaper than counting
+    every encounter. Batches are buffered and merged every buffer_size rows.
+    """
+    def __init__(self, M1, M2, buffer_size=100000):
+        self.M1 = M1
+        self.M2 = M2
+        self.buffer_size = buffer_size
+        self.keys = np.empty(0, dtype=np.dtype((np.void, int(np.ceil((1 + M1 + M2) / 8)))))
+        self.weights = np.empty(0, dtype=np.int64)
+        self.N = 0
+        self._pending_keys = []
+        self._pending_weights = []
+        self._pending = 0
+
+    def add_batch(self, P1, P2, d=None, weights=None):
+        """
+        Add a batch of encounters, optionally with their multiplicities.
+        """
+        keys = pack_rows(P1, P2, d)
+        if weights is None:
+            weights = np.ones(len(keys), dtype=np.int64)
+        self._pending_keys.append(keys)
+        self._pending_weights.append(np.asarray(weights, dtype=np.int64))
+        self._pending += len(keys)
+        self.N += int(np.sum(weights))
+        if self._pending >= self.buffer_size:
+            self._compact()
+
+    def _compact(self):
+        if self._pending == 0:
+            return
+        keys = np.concatenate([self.keys] + self._pending_keys)
+        weights = np.concatenate([self.weights] + self._pending_weights)
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.weights = np.bincount(inverse.ravel(), weights=weights, minlength=len(self.keys)).astype(np.int64)
+        self._pending_keys, self._pending_weights, self._pending = [], [], 0
+
+    def profiles(self):
+        """
+        Unique profiles and their multiplicities.
+        :return: d, P1, P2 and weights, with one row per unique profile
+        """
+        self._compact()
+        d, P1, P2 = unpack_rows(self.keys, self.M1, self.M2)
+        return d, P1, P2, self.weights
+
+    def compression(self):
+        """
+        Ratio of encounters to unique profiles.
+        """
+        self._compact()
+        return self.N / max(len(self.keys), 1)
+
+
+def summarize_weighted(P1, P2, d, weights, current=None):
+    """
+    Weighted version of mutual_information.mf.summarize(): row i counts as weights[i] encounters.
+    @param P1: a N x M1 binary matrix
+    @param P2: a N x M2 binary matrix
+    @param d: a size N binary vector
+    @param weights: a size N vector of multiplicities
+    @param current: a list of summary statistics that new summary statistics will be added to
+    :return: a list of summary statistics [m1, m2, case_N, control_N], as in mf.summarize()
+    """
+    P1 = np.asarray(P1, dtype=np.int64)
+    P2 = np.asarray(P2, dtype=np.int64)
+    d = np.asarray(d, dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.int64)
+    if current is None:
+        current = [{'set1': np.zeros([P1.shape[1], 4]), 'set2': np.zeros([P2.shape[1], 4])},
+                   np.zeros([P1.shape[1], P2.shape[1], 8]), 0, 0]
+    m1, m2, case_N, control_N = current
+
+    # weight of each row in the case (z = 1) and control (z = 0) groups
+    z_weights = [weights * d, weights * (1 - d)]
+    m1 = {'set1': m1['set1'] + np.stack([X.T @ w for X in [P1, 1 - P1] for w in z_weights], axis=-1),
+          'set2': m1['set2'] + np.stack([Y.T @ w for Y in [P2, 1 - P2] for w in z_weights], axis=-1)}
+    # order of the last axis: +++, ++-, +-+, +--, -++, -+-, --+, ---
+    m2 = m2 + np.stack([(X * w[:, np.newaxis]).T @ Y for X in [P1, 1 - P1] for Y in [P2, 1 - P2]
+                        for w in z_weights], axis=-1)
+    return [m1, m2, case_N + int(np.sum(z_weights[0])), control_N + int(np.sum(z_weights[1]))]
+
+
+def add_weighted(summary, P1, P2, d, weights):
+    """
+    Add weighted rows to an instance of SummaryXYz, or of SummaryXY (d is ignored).
+    """
+    if isinstance(summary, mf.SummaryXYz):
+        summary.m1, summary.m2, summary.case_N, summary.control_N = summarize_weighted(
+            P1, P2, d, weights, current=[summary.m1, summary.m2, summary.case_N, summary.control_N])
+    elif isinstance(summary, mf.SummaryXY):
+        P1 = np.asarray(P1, dtype=np.int64)
+        P2 = np.asarray(P2, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.int64)
+        # order of the last axis: ++, +-, -+, --
+        summary.m = summary.m + np.stack([(X * weights[:, np.newaxis]).T @ Y for X in [P1, 1 - P1]
+                                          for Y in [P2, 1 - P2]], axis=-1)
+        summary.N = summary.N + int(np.sum(weights))
+    else:
+        raise ValueError('unsupported summary type: {}'.format(type(summary)))
+
+
+def synergy_random_dedup(disease_prevalence, phenotype_prob1, phenotype_prob2, sample_size, seed=None,
+                         chunk_size=10000):
+    """
+    Drop-in replacement of mutual_information.mf_random.synergy_random() that compresses each simulated sample into
+    unique profiles before counting, so the pairwise counting cost scales with the number of unique profiles rather
+    than sample_size. The statistics follow the same distribution as synergy_random(), but the random streams
+    differ, so results for a seed are not identical.
+    :return: a dictionary from statistic name to simulated values, as synergy_random()
+    """
+    if seed is not None:
+        np.random.seed(seed)
+    M1 = len(phenotype_prob1)
+    M2 = len(phenotype_prob2)
+    counter = ProfileCounter(M1, M2)
+    for start in range(0, sample_size, chunk_size):
+        n = min(chunk_size, sample_size - start)
+        d = (np.random.uniform(0, 1, n) < disease_prevalence).astype(int)
+        P1 = (np.random.uniform(0, 1, [n, M1]) < np.reshape(phenotype_prob1, [1, M1])).astype(int)
+        P2 = (np.random.uniform(0, 1, [n, M2]) < np.reshape(phenotype_prob2, [1, M2])).astype(int)
+        counter.add_batch(P1, P2, d)
+
+    mocked_XYz = mf.SummaryXYz(X_names=np.arange(M1), Y_names=np.arange(M2), z_name='mocked')
+    d, P1, P2, weights = counter.profiles()
+    add_weighted(mocked_XYz, P1, P2, d, weights)
+    mutualInfoXYz = mf.MutualInfoXYz(mocked_XYz)
+    return {'mf_XY_omit_z': mutualInfoXYz.mutual_info_XY_omit_z(),
+            'mf_Xz': mutualInfoXYz.mutual_info_Xz(),
+            'mf_Yz': mutualInfoXYz.mutual_info_Yz(),
+            'mf_XY_z': mutualInfoXYz.mutual_info_XY_z(),
+            'mf_XY_given_z': mutualInfoXYz.mutual_info_XY_given_z(),
+            'synergy': mutualInfoXYz.synergy_XY2z()}
@@ -0,0 +1,356 @@
+import os
+import json
+import pathlib
+import logging
+import numpy as np
+import pandas as pd
+import mimic_mf_analysis.dedup as dedup
+import mimic_mf_analysis.encoding as encoding
+import mimic_mf_analysis.metrics as metrics
+import mimic_mf_analysis.partials as partials
+import mimic_mf_analysis.profiles as profiles
+
+logger = logging.getLogger(__name__)
+
+# written next to the summaries of a run that a later run can update with --since
+STATE_FILE = 'delta.json'
+# directory of the per-encounter rows of a run
+VECTORS_DIR = 'encounters'
+
+# tables whose new rows (by ROW_ID) mark the encounters they belong to as changed; the phenotype sources are added
+# from profiles.PROFILE_SOURCES
+DIAGNOSIS_SOURCE = {'source': 'DIAGNOSES_ICD',
+                    'watermark': 'DIAGNOSES_ICD.ROW_ID',
+                    'select': 'SELECT SUBJECT_ID, HADM_ID FROM DIAGNOSES_ICD WHERE 1 = 1'}
+
+
+class EncounterVectors:
+    """
+    The (diagnosis, textHpo, labHpo) row that each encounter contributed to the summaries of a run, packed into bits
+    with dedup.pack_rows() and kept by HADM_ID, per diagnosis (or 'all' regardless of diagnosis). A later run
+    subtracts the stored row of an encounter that changed before it adds the new one.
+    """
+    def __init__(self):
+        self.rows = {}
+        self._pending = {}
+
+    def add(self, key, hadm_ids, P1, P2, d=None):
+        packed = dedup.pack_rows(P1, P2, d)
+        self._pending.setdefault(key, []).append((np.asarray(hadm_ids, dtype=np.int64),
+                                                  packed.view(np.uint8).reshape([len(packed), -1])))
+
+    def get(self, key):
+        """
+        :return: HADM_IDs in ascending order and their packed rows, a uint8 matrix
+        """
+        pending = self._pending.pop(key, [])
+        if pending:
+            parts = ([self.rows[key]] if key in self.rows else []) + pending
+            hadm_ids = np.concatenate([ids for ids, _ in parts])
+            packed = np.concatenate([rows for _, rows in parts])
+            order = np.argsort(hadm_ids, kind='stable')
+            self.rows[key] = hadm_ids[order], packed[order]
+        return self.rows.get(key, (np.empty(0, dtype=np.int64), np.empty([0, 0], dtype=np.uint8)))
+
+    def set(self, key, hadm_ids, packed):
+        self._pending.pop(key, None)
+        self.rows[key] = hadm_ids, packed
+
+    def keys(self):
+        return sorted(set(self.rows) | set(self._pending))
+
+    def save(self, out_dir):
+        dir = pathlib.Path(out_dir).joinpath(VECTORS_DIR)
+        dir.mkdir(parents=True, exist_ok=True)
+        for key in self.keys():
+            hadm_ids, packed = self.get(key)
+            np.savez(dir.joinpath('{}.npz'.format(key)), hadm_ids=hadm_ids, packed=packed)
+
+    @classmethod
+    def load(cls, out_dir):
+        vectors = cls()
+        dir = pathlib.Path(out_dir).joinpath(VECTORS_DIR)
+        if not dir.exists():
+            raise FileNotFoundError('no per-encounter rows under {}; run without --since first'.format(out_dir))
+        for path in sorted(dir.glob('*.npz')):
+            with np.load(path, allow_pickle=False) as arrays:
+                vectors.rows[path.stem] = arrays['hadm_ids'], arrays['packed']
+        return vectors
+
+
+def _sources():
+    return [DIAGNOSIS_SOURCE] + [source for sources in profiles.PROFILE_SOURCES.values() for source in sources]
+
+
+def current_watermarks():
+    """
+    The largest ROW_ID of each table that marks encounters as changed. Tables that are not in the database, or have
+    no ROW_ID (e.g. DIAGNOSES_ICD loaded without it), are left out.
+    """
+    from mimic_mf_analysis import db
+    watermarks = {}
+    for source in _sources():
+        if not db.table_exists(source['source']):
+            continue
+        try:
+            high = db.read_sql('SELECT MAX({}) AS high FROM {}'.format(source['watermark'], source['source'])).high[0]
+        except Exception as e:
+            logger.debug('no watermark of {}: {}'.format(source['source'], e))
+            continue
+        watermarks[source['source']] = 0 if pd.isna(high) else int(high)
+    return watermarks
+
+
+def changed_encounters(since, until):
+    """
+    Encounters with rows above the watermarks of an earlier run, e.g. new diagnosis codes or newly mapped notes.
+    Rows of existing events that are mapped again keep their event ROW_ID and are not found; pass their encounters
+    explicitly.
+    @param since: watermarks of the earlier run
+    @param until: current watermarks
+    :return: a set of HADM_IDs
+    """
+    from mimic_mf_analysis import db
+    hadm_ids = set()
+    for source in _sources():
+        name = source['source']
+        if name not in since or name not in until or until[name] <= since[name]:
+            continue
+        frame = db.read_sql('SELECT DISTINCT HADM_ID FROM ({} AND {} > ? AND {} <= ?) AS changed'.format(
+            source['select'], source['watermark'], source['watermark']), [since[name], until[name]])
+        found = set(frame.HADM_ID.dropna().astype(np.int64))
+        logger.info('{}: {} encounters with rows in ROW_ID {} to {}'.format(name, len(found), since[name] + 1,
+                                                                            until[name]))
+        hadm_ids |= found
+    return hadm_ids
+
+
+def restrict_encounters(hadm_ids):
+    """
+    Keep only the given encounters in JAX_encounterOfInterest (renumbering ROW_IDs from 1) and rebuild
+    JAX_diagnosisProfile for them.
+    """
+    from mimic_mf_analysis import db
+    from mimic_mf_analysis.preparation import indexEncounterOfInterest, diagnosisProfile
+    db.load_frame('JAX_deltaEncounters', pd.DataFrame({'HADM_ID': sorted(hadm_ids)}, dtype=np.int64), temporary=True)
+    db.drop_temp_table('JAX_encounterSubset')
+    db.create_temp_table_as('JAX_encounterSubset', '''
+                SELECT e.SUBJECT_ID, e.HADM_ID
+                FROM JAX_encounterOfInterest AS e
+                JOIN JAX_deltaEncounters AS d ON e.HADM_ID = d.HADM_ID
+                ORDER BY e.SUBJECT_ID, e.HADM_ID''', row_id=True, order_by='SUBJECT_ID, HADM_ID')
+    db.drop_temp_table('JAX_encounterOfInterest')
+    db.create_temp_table_as('JAX_encounterOfInterest', 'SELECT * FROM JAX_encounterSubset ORDER BY ROW_ID')
+    db.drop_temp_table('JAX_encounterSubset')
+    db.drop_temp_table('JAX_deltaEncounters')
+    indexEncounterOfInterest()
+    diagnosisProfile()
+
+
+def pin_panel(rank_table, labels, hpo_dictionary=None):
+    """
+    Replace a frequency rank table with the phenotypes of an earlier run, ranked so that the batch queries return
+    them in the same order (N from len(labels) down to 1). Counts of a delta run have to line up with the stored
+    summaries, so the phenotype panel is not ranked again.
+    @param hpo_dictionary: an encoding.HpoDictionary for the codes of the phenotypes. Default to JAX_hpoDictionary.
+    """
+    from mimic_mf_analysis import db
+    if hpo_dictionary is None:
+        hpo_dictionary = encoding.HpoDictionary.load()
+    db.load_frame(rank_table, pd.DataFrame({'MAP_TO': [str(label) for label in labels],
+                                            'N': np.arange(len(labels), 0, -1, dtype=np.int64),
+                                            'PHENOTYPE': np.ones(len(labels), dtype=np.int64),
+                                            'HPO_ID': hpo_dictionary.encode(labels)}), temporary=True)
+
+
+def _batches(table, batch_size):
+    from mimic_mf_analysis import db
+    start, end = db.read_sql('SELECT MIN(ROW_ID) AS min, MAX(ROW_ID) AS max FROM {}'.format(table)).iloc[0]
+    if pd.isna(start):
+        return
+    for start_index in range(int(start), int(end) + 1, batch_size):
+        yield start_index, min(start_index + batch_size - 1, int(end))
+
+
+def encounter_ids(table, start_index, end_index):
+    """
+    HADM_IDs of a ROW_ID range of an encounter table, in ROW_ID order.
+    """
+    from mimic_mf_analysis import db
+    return db.prepare('SELECT HADM_ID FROM {} WHERE ROW_ID BETWEEN ? AND ? ORDER BY ROW_ID'.format(table)).read(
+        [start_index, end_index]).HADM_ID.values
+
+
+def diagnosis_rows(diagnosis, textHpos, labHpos, parameters, vectors, batch_size=100):
+    """
+    Query the rows of the encounters in JAX_encounterOfInterest for a diagnosis and a fixed phenotype panel.
+    """
+    import mimic_mf_analysis.analysis as analysis
+    analysis.createDiagnosisTable(diagnosis, parameters['primary_diagnosis_only'])
+    analysis.indexDiagnosisTable()
+    pin_panel('JAX_textHpoFrequencyRank', textHpos)
+    pin_panel('JAX_labHpoFrequencyRank', labHpos)
+    for start_index, end_index in _batches('JAX_mf_diag', batch_size):
+        diagnosisFlat, textHpoFlat, labHpoFlat = analysis.batch_query(
+            start_index, end_index, parameters['textHpo_occurrance_min'], parameters['labHpo_occurrance_min'], 1,
+            len(textHpos), 1, len(labHpos))
+        n = len(diagnosisFlat)
+        if n == 0:
+            continue
+        vectors.add(diagnosis, diagnosisFlat.HADM_ID.values,
+                    textHpoFlat.VALUE.values.astype(int).reshape([n, len(textHpos)], order='F'),
+                    labHpoFlat.VALUE.values.astype(int).reshape([n, len(labHpos)], order='F'),
+                    diagnosisFlat.DIAGNOSIS.values.astype(int))
+
+
+def encounter_rows(textHpos, labHpos, parameters, vectors, batch_size=100):
+    """
+    Query the rows of the encounters in JAX_encounterOfInterest for a fixed phenotype panel, regardless of diagnosis.
+    """
+    import mimic_mf_analysis.analysis as analysis
+    pin_panel('JAX_textHpoFrequencyRank', textHpos)
+    pin_panel('JAX_labHpoFrequencyRank', labHpos)
+    for start_index, end_index in _batches('JAX_encounterOfInterest', batch_size):
+        n = end_index - start_index + 1
+        textHpo, labHpo = analysis.batch_query_lab_text(
+            start_index, end_index, parameters['textHpo_occurrance_min'], parameters['labHpo_occurrance_min'], 1,
+            len(textHpos), 1, len(labHpos))
+        vectors.add('all', encounter_ids('JAX_encounterOfInterest', start_index, end_index),
+                    textHpo.PHEN_TEXT_VALUE.values.astype(int).reshape([n, len(textHpos)], order='F'),
+                    labHpo.PHEN_LAB_VALUE.values.astype(int).reshape([n, len(labHpos)], order='F'))
+
+
+def add_rows(summaries, packed, weight, M1, M2):
+    """
+    Add packed rows to the textHpo * labHpo, textHpo * textHpo and labHpo * labHpo summaries, each weight times
+    (weight -1 takes them out again).
+    """
+    if len(packed) == 0:
+        return
+    d, P1, P2 = dedup.unpack_rows(np.ascontiguousarray(packed).view(np.dtype((np.void, packed.shape[1]))).ravel(),
+                                  M1, M2)
+    weights = np.full(len(d), weight, dtype=np.int64)
+    rad_lab, rad_rad, lab_lab = summaries
+    dedup.add_weighted(rad_lab, P1, P2, d, weights)
+    dedup.add_weighted(rad_rad, P1, P1, d, weights)
+    dedup.add_weighted(lab_lab, P2, P2, d, weights)
+
+
+def apply_delta(summaries, stored, fresh, encounters, M1, M2):
+    """
+    Update summaries with the encounters of a delta run: rows that changed are taken out and added again with their
+    new values, new encounters are added and encounters that are no longer of interest are taken out.
+    @param stored: HADM_IDs and packed rows of the earlier run, HADM_IDs ascending
+    @param fresh: HADM_IDs and packed rows of the changed encounters, HADM_IDs ascending
+    @param encounters: all HADM_IDs of interest now
+    :return: HADM_IDs and packed rows after the update, and the number of encounters added, changed and removed
+    """
+    stored_ids, stored_rows = stored
+    fresh_ids, fresh_rows = fresh
+    if len(stored_rows) and len(fresh_rows) and stored_rows.shape[1] != fresh_rows.shape[1]:
+        raise ValueError('rows of the earlier run have another phenotype panel')
+    known = np.isin(fresh_ids, stored_ids)
+    position = np.searchsorted(stored_ids, fresh_ids[known])
+    changed = np.any(stored_rows[position] != fresh_rows[known], axis=1) if known.any() else np.zeros(0, dtype=bool)
+    removed = ~np.isin(stored_ids, np.asarray(sorted(encounters), dtype=np.int64))
+
+    add_rows(summaries, stored_rows[position[changed]], -1, M1, M2)
+    add_rows(summaries, stored_rows[removed], -1, M1, M2)
+    add_rows(summaries, fresh_rows[known][changed], 1, M1, M2)
+    add_rows(summaries, fresh_rows[~known], 1, M1, M2)
+
+    rows = stored_rows.copy()
+    rows[position[changed]] = fresh_rows[known][changed]
+    keep = ~removed
+    hadm_ids = np.concatenate([stored_ids[keep], fresh_ids[~known]])
+    rows = np.concatenate([rows[keep], fresh_rows[~known]]) if len(rows) else fresh_rows[~known]
+    order = np.argsort(hadm_ids, kind='stable')
+    return (hadm_ids[order], rows[order]), (int((~known).sum()), int(changed.sum()), int(removed.sum()))
+
+
+def write_state(out_dir, command, results, parameters, watermarks):
+    state = {'command': command, 'results': list(results), 'parameters': parameters, 'watermarks': watermarks}
+    with open(os.path.join(out_dir, STATE_FILE), 'w') as f:
+        json.dump(state, f, indent=1, default=str)
+
+
+def read_state(dir, command, parameters):
+    path = os.path.join(dir, STATE_FILE)
+    if not os.path.exists(path):
+        raise FileNotFoundError('{} not found; --since needs the output of an earlier run'.format(path))
+    with open(path) as f:
+        state = json.load(f)
+    if state['command'] != command:
+        raise ValueError('{} is the output of {}, not of {}'.format(dir, state['command'], command))
+    if json.loads(json.dumps(parameters, default=str)) != state['parameters']:
+        raise ValueError('parameters differ from the earlier run in {}; run without --since'.format(dir))
+    return state
+
+
+def _encounters_to_count(state, stored_ids, extra_encounters):
+    """
+    Restrict JAX_encounterOfInterest to the encounters that are new or changed since the earlier run.
+    :return: all HADM_IDs of interest, and the current watermarks
+    """
+    from mimic_mf_analysis import db
+    watermarks = current_watermarks()
+    encounters = set(db.read_sql('SELECT HADM_ID FROM JAX_encounterOfInterest').HADM_ID.astype(np.int64))
+    candidates = (encounters - set(stored_ids.tolist())) | changed_encounters(state['watermarks'], watermarks)
+    candidates |= set(int(hadm_id) for hadm_id in (extra_encounters or []))
+    candidates &= encounters
+    logger.info('{} of {} encounters to count again'.format(len(candidates), len(encounters)))
+    restrict_encounters(candidates)
+    return encounters, watermarks
+
+
+@metrics.timed()
+def update_regarding_diagnosis(since, parameters, extra_encounters=None, batch_size=100):
+    """
+    Update the summaries of an earlier regarding_diagnosis run with the encounters that were added or changed since.
+    The diagnoses and phenotype panels of the earlier run are kept. Call after analysis.initTables().
+    @param since: output directory of the earlier run
+    @param parameters: analysis parameters, which have to be the ones of the earlier run
+    @param extra_encounters: HADM_IDs to count again in any case, e.g. of notes that were mapped again
+    :return: the three dictionaries of updated summaries (rad_lab, rad_rad, lab_lab), the updated EncounterVectors and
+    the current watermarks
+    """
+    state = read_state(since, 'regarding_diagnosis', parameters)
+    results = [partials.load_partial(since, name) for name in state['results']]
+    results = [{key: partials.merge_summaries([summary]) for key, summary in result.items()} for result in results]
+    vectors = EncounterVectors.load(since)
+    stored_ids = np.unique(np.concatenate([vectors.get(key)[0] for key in results[0]] or [np.empty(0)]))
+    encounters, watermarks = _encounters_to_count(state, stored_ids.astype(np.int64), extra_encounters)
+
+    fresh = EncounterVectors()
+    for diagnosis, summary in results[0].items():
+        textHpos, labHpos = summary.vars_labels['set1'], summary.vars_labels['set2']
+        diagnosis_rows(diagnosis, textHpos, labHpos, parameters, fresh, batch_size)
+        updated, (added, changed, removed) = apply_delta([result[diagnosis] for result in results],
+                                                         vectors.get(diagnosis), fresh.get(diagnosis), encounters,
+                                                         len(textHpos), len(labHpos))
+        vectors.set(diagnosis, *updated)
+        logger.info('{}: {} encounters added, {} changed, {} removed'.format(diagnosis, added, changed, removed))
+    return results, vectors, watermarks
+
+
+@metrics.timed()
+def update_regardless_diagnosis(since, parameters, extra_encounters=None, batch_size=100):
+    """
+    Update the summaries of an earlier regardless_diagnosis run with the encounters that were added or changed since.
+    The phenotype panels of the earlier run are kept. Call after analysis.initTables().
+    :return: the three updated summaries (rad_lab, rad_rad, lab_lab), the updated EncounterVectors and the current
+    watermarks
+    """
+    state = read_state(since, 'regardless_diagnosis', parameters)
+    results = [partials.merge_summaries([partials.load_partial(since, name)]) for name in state['results']]
+    vectors = EncounterVectors.load(since)
+    encounters, watermarks = _encounters_to_count(state, vectors.get('all')[0], extra_encounters)
+
+    textHpos, labHpos = results[0].X_names, results[0].Y_names
+    fresh = EncounterVectors()
+    encounter_rows(textHpos, labHpos, parameters, fresh, batch_size)
+    updated, (added, changed, removed) = apply_delta(results, vectors.get('all'), fresh.get('all'), encounters,
+                                                     len(textHpos), len(labHpos))
+    vectors.set('all', *updated)
+    logger.info('{} encounters added, {} changed, {} removed'.format(added, changed, removed))
+    return results, vectors, watermarks
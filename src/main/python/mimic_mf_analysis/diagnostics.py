@@ -0,0 +1,141 @@
+import re
+import json
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# statements that can be explained as they are
+EXPLAINABLE = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')
+
+
+def normalize(sql):
+    """
+    Reduce a statement to its template: literals are replaced with ?, lists of them with (?) and whitespace is
+    collapsed, so statements that str.format() builds from the same template with different diagnoses, phenotypes or
+    ROW_ID ranges share one template.
+    """
+    template = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    template = re.sub(r'\b\d+(?:\.\d+)?\b', '?', template)
+    template = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', template)
+    return ' '.join(template.split())
+
+
+def explainable(sql):
+    """
+    The part of a statement that EXPLAIN accepts: the statement itself for queries and updates, the SELECT of a
+    CREATE TABLE ... AS SELECT, and None for other DDL (DROP, ALTER, CREATE INDEX).
+    """
+    statement = sql.strip()
+    keyword = statement.split(None, 1)[0].upper() if statement else ''
+    if keyword in EXPLAINABLE:
+        return statement
+    if keyword == 'CREATE' and not re.match(r'CREATE\s+(UNIQUE\s+)?INDEX', statement, re.IGNORECASE):
+        select = re.search(r'\b(SELECT|WITH)\b', statement, re.IGNORECASE)
+        if select:
+            return statement[select.start():]
+    return None
+
+
+class QueryDiagnostics:
+    """
+    Diagnostics mode for generated SQL: the first time a statement template executes, its plan is captured with
+    EXPLAIN (FORMAT=JSON on MySQL), and every execution is timed. Executions that take at least threshold seconds
+    are kept as slow queries, with the plan of their template and the tables the plan scans in full, so a query that
+    stops using the JAX_*Profile indexes shows up as a full scan in the report.
+    """
+    def __init__(self):
+        self.report_path = None
+        self.threshold = 1.0
+        self.templates = {}
+        self.slow = []
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.report_path is not None
+
+    def configure(self, report_path=None, threshold=1.0):
+        """
+        @param report_path: path of the JSON report. Diagnostics are disabled if it is None.
+        @param threshold: minimum execution time in seconds of a slow query
+        """
+        self.report_path = report_path
+        self.threshold = threshold
+
+    def prepare(self, backend, sql, params=None):
+        """
+        Capture the plan of a statement the first time its template is seen. Called before the statement executes.
+        @param params: values of the ? placeholders of the statement
+        """
+        if not self.enabled:
+            return
+        template = normalize(sql)
+        with self._lock:
+            if template in self.templates:
+                return
+            stats = self.templates[template] = {'template': template, 'backend': backend.name, 'calls': 0,
+                                                'total_seconds': 0.0, 'max_seconds': 0.0, 'plan': None,
+                                                'full_scans': [], 'explain_error': None}
+        target = explainable(sql)
+        if target is None:
+            return
+        try:
+            stats['plan'] = backend.explain(target, params)
+            stats['full_scans'] = backend.full_scans(stats['plan'])
+        except Exception as e:
+            stats['explain_error'] = str(e)
+            logger.debug('cannot explain {}: {}'.format(template, e))
+
+    def observe(self, sql, seconds):
+        """
+        Record the execution time of a statement.
+        """
+        if not self.enabled:
+            return
+        template = normalize(sql)
+        with self._lock:
+            stats = self.templates.get(template)
+            if stats is None:
+                return
+            stats['calls'] += 1
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            if seconds >= self.threshold:
+                self.slow.append({'seconds': seconds, 'time': time.time(), 'template': template,
+                                  'sql': ' '.join(sql.split())})
+                logger.warning('slow query ({:.1f}s): {}'.format(seconds, template[:200]))
+
+    def report(self):
+        """
+        :return: a dictionary: the threshold, all templates by total execution time, and the slow queries, slowest
+        first, each with the plan and full scans of its template
+        """
+        with self._lock:
+            templates = sorted(self.templates.values(), key=lambda stats: -stats['total_seconds'])
+            slow = sorted(self.slow, key=lambda query: -query['seconds'])
+            slow = [dict(query, plan=self.templates[query['template']]['plan'],
+                         full_scans=self.templates[query['template']]['full_scans']) for query in slow]
+        return {'threshold': self.threshold, 'templates': templates, 'slow_queries': slow}
+
+    def reset(self):
+        with self._lock:
+            self.templates = {}
+            self.slow = []
+
+    def write_report(self, path=None):
+        path = path or self.report_path
+        if path is None:
+            return
+        report = self.report()
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1, default=str)
+        logger.info('{} query templates, {} slow queries written to {}'.format(
+            len(report['templates']), len(report['slow_queries']), path))
+
+
+# diagnostics of this process
+registry = QueryDiagnostics()
+configure = registry.configure
+write_report = registry.write_report
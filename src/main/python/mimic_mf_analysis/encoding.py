@@ -0,0 +1,87 @@
+"""
+Integer codes of HPO terms and encounters.
+
+HPO terms are numbered once per run in table JAX_hpoDictionary (see preparation.hpoDictionary) and encounters are
+numbered by the ROW_ID of JAX_encounterOfInterest, in (SUBJECT_ID, HADM_ID) order. Batch queries return these codes
+rather than strings, so the N x M rows of a batch hold no Python objects, and terms are decoded into labels only for
+the phenotype panels of the summaries.
+"""
+import numpy as np
+
+HPO_DICTIONARY = 'JAX_hpoDictionary'
+CODE_DTYPE = np.int32
+# the code of a term that is not in the dictionary
+UNKNOWN = 0
+
+
+class HpoDictionary:
+    """
+    The HPO terms of JAX_hpoDictionary, indexed by their codes.
+    """
+    def __init__(self, codes, labels):
+        codes = np.asarray(codes, dtype=CODE_DTYPE)
+        size = int(codes.max()) + 1 if len(codes) > 0 else 1
+        self.labels = np.full(size, '', dtype=object)
+        self.labels[codes] = [str(label) for label in labels]
+        self.index = {label: code for code, label in zip(codes.tolist(), self.labels[codes])}
+
+    @classmethod
+    def load(cls):
+        from mimic_mf_analysis import db
+        frame = db.read_sql('SELECT HPO_ID, MAP_TO FROM {}'.format(HPO_DICTIONARY))
+        return cls(frame.HPO_ID.values, frame.MAP_TO.values)
+
+    def __len__(self):
+        return len(self.index)
+
+    def encode(self, labels):
+        """
+        :return: the codes of HPO terms, UNKNOWN for terms that are not in the dictionary
+        """
+        return np.array([self.index.get(str(label), UNKNOWN) for label in labels], dtype=CODE_DTYPE)
+
+    def decode(self, codes):
+        """
+        :return: the HPO terms of codes
+        """
+        return self.labels[np.asarray(codes, dtype=CODE_DTYPE)]
+
+
+def panel(rank_table, threshold_min, threshold_max):
+    """
+    The phenotypes of a frequency rank table (JAX_textHpoFrequencyRank or JAX_labHpoFrequencyRank) seen in
+    threshold_min to threshold_max encounters, in the order that batch queries return them (N DESC, MAP_TO).
+    :return: a vector of codes and a vector of HPO terms
+    """
+    from mimic_mf_analysis import db
+    frame = db.read_sql('SELECT HPO_ID, MAP_TO FROM {} WHERE N BETWEEN ? AND ? ORDER BY N DESC, MAP_TO'.format(
+        rank_table), [threshold_min, threshold_max])
+    return frame.HPO_ID.values.astype(CODE_DTYPE), frame.MAP_TO.values
+
+
+def column_index(codes):
+    """
+    A lookup vector from code to the column of a phenotype panel, -1 for codes outside the panel, to map the codes of
+    a query result to matrix columns with one indexing operation.
+    """
+    codes = np.asarray(codes, dtype=CODE_DTYPE)
+    lookup = np.full(int(codes.max()) + 1 if len(codes) > 0 else 1, -1, dtype=np.int64)
+    lookup[codes] = np.arange(len(codes))
+    return lookup
+
+
+def columns_of(lookup, codes):
+    """
+    Columns of the codes of a query result, -1 for codes outside the panel, see column_index().
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    inside = (codes >= 0) & (codes < len(lookup))
+    return np.where(inside, lookup[np.where(inside, codes, 0)], -1)
+
+
+def check_panel(codes, flat, batch_size):
+    """
+    Check that the flat rows of a batch query, phenotype by phenotype and encounter by encounter within a phenotype,
+    follow the order of the phenotype panel: the first encounter of every phenotype has the code of that column.
+    """
+    assert (np.asarray(flat, dtype=CODE_DTYPE)[::batch_size] == codes).all()
@@ -0,0 +1,59 @@
+import multiprocessing
+import logging
+from mutual_information.mf_random import MutualInfoRandomizer
+import mimic_mf_analysis.simulation as simulation
+import mimic_mf_analysis.analytic as analytic
+
+logger = logging.getLogger(__name__)
+
+
+def p_values(summary, dist_path, disease, mode='distribution', load_distribution=None, strict=True):
+    """
+    Estimate the p values of one disease from its simulation output.
+    @param summary: observed summary statistics of the disease, an instance of SummaryXYz
+    @param dist_path: directory of simulation output
+    @param disease: disease code
+    @param mode: 'distribution' for empirical distributions, 'counts' for exceedance counters, 'analytic' for
+    chi-square approximations that need no simulations (see analytic.analytic_p_values)
+    @param load_distribution: function (dist_path, disease, strict) -> empirical distributions, used in distribution
+    mode
+    @param strict: fail if simulation shards are missing or corrupt, instead of using the ones that could be loaded
+    :return: a dictionary from statistic name to p values
+    """
+    if mode == 'analytic':
+        return analytic.analytic_p_values(summary)
+    if mode == 'counts':
+        return simulation.load_counts(dist_path, disease, strict).p_values()
+    randmizer = MutualInfoRandomizer(summary)
+    randmizer.empirical_distribution = load_distribution(dist_path, disease, strict)
+    return randmizer.p_values()
+
+
+def _estimate_one(task):
+    disease, summary, dist_path, mode, load_distribution, strict = task
+    logger.info('start estimating p values for {}'.format(disease))
+    return disease, p_values(summary, dist_path, disease, mode, load_distribution, strict)
+
+
+def estimate_diseases(joint_distributions, diseases, dist_path, mode='distribution', load_distribution=None, cpu=None,
+                      strict=True):
+    """
+    Estimate p values of many diseases in a process pool. Each worker loads the simulation output of one disease at a
+    time, so peak memory is one disease's distributions per worker.
+    @param joint_distributions: a dictionary from disease to summary statistics (a lazy result store group works)
+    @param diseases: diseases to estimate
+    @param dist_path: directory of simulation output
+    @param mode: 'distribution', 'counts' or 'analytic'
+    @param load_distribution: function (dist_path, disease, strict) -> empirical distributions. It has to be defined
+    at module level so that it can be sent to workers.
+    @param cpu: number of processes
+    @param strict: fail if simulation shards are missing or corrupt
+    :return: a generator of (disease, p values), in the order diseases finish
+    """
+    tasks = ((disease, joint_distributions[disease], dist_path, mode, load_distribution, strict)
+             for disease in diseases)
+    # a fresh worker per disease returns the memory of the previous disease's distributions
+    with multiprocessing.Pool(cpu, maxtasksperchild=1) as workers:
+        for disease, p in workers.imap_unordered(_estimate_one, tasks):
+            logger.info('p values estimated for {}'.format(disease))
+            yield disease, p
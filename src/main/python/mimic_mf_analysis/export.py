@@ -0,0 +1,136 @@
+import logging
+import numpy as np
+import pandas as pd
+import mutual_information.mf as mf
+from mimic_mf_analysis.selection import TEXT, LAB
+
+logger = logging.getLogger(__name__)
+
+# columns of the long table of phenotype pairs
+COLUMNS = ['disease', 'term1', 'source1', 'term2', 'source2', 'mi', 'synergy', 'p']
+# sources of the phenotypes of each kind of summaries
+PAIR_SOURCES = {'rad_lab': (TEXT, LAB), 'rad_rad': (TEXT, TEXT), 'lab_lab': (LAB, LAB)}
+
+
+def pair_table(disease, summary, source1, source2, p_values=None, statistic='synergy'):
+    """
+    Turn the summary of a disease into a long table with one row per phenotype pair: the mutual information I(x,y;z)
+    of the pair with the disease, its synergy and, if p values are given, the p value of a statistic. Values are
+    computed over the whole M1 x M2 pair matrices and indexed into the rows; pairs of a phenotype with itself and the
+    mirror image of a pair are left out when both phenotypes come from the same set.
+    @param summary: an instance of SummaryXYz, or of sparse_pairs.SparseSummaryXYz for the stored pairs only
+    @param source1, source2: sources of the phenotypes in set1 and set2, TextHpo or LabHpo
+    @param p_values: a dictionary from statistic name to p values (M1 x M2), e.g. the output of estimate for the
+    disease
+    :return: a data frame with COLUMNS
+    """
+    labels1 = np.asarray(summary.vars_labels['set1'], dtype=object)
+    labels2 = np.asarray(summary.vars_labels['set2'], dtype=object)
+    if hasattr(summary, 'pairs'):
+        # a sparse summary has the statistics of its stored pairs only
+        rows, cols, statistics = summary.mutual_info()
+        mi, synergy = statistics['mf_XY_z'], statistics['synergy']
+        if source1 == source2:
+            upper = rows < cols
+            rows, cols, mi, synergy = rows[upper], cols[upper], mi[upper], synergy[upper]
+    else:
+        M1, M2 = len(labels1), len(labels2)
+        if source1 == source2:
+            rows, cols = np.triu_indices(M1, k=1)
+        else:
+            rows, cols = np.divmod(np.arange(M1 * M2), M2)
+        mutual_info = mf.MutualInfoXYz(summary)
+        mi = np.asarray(mutual_info.mutual_info_XY_z())[rows, cols]
+        synergy = np.asarray(mutual_info.synergy_XY2z())[rows, cols]
+    if p_values is not None:
+        p = np.asarray(p_values[statistic], dtype=float)[rows, cols]
+    else:
+        p = np.full(len(rows), np.nan)
+    return pd.DataFrame({'disease': np.full(len(rows), str(disease), dtype=object),
+                         'term1': labels1[rows],
+                         'source1': np.full(len(rows), source1, dtype=object),
+                         'term2': labels2[cols],
+                         'source2': np.full(len(rows), source2, dtype=object),
+                         'mi': np.asarray(mi, dtype=float),
+                         'synergy': np.asarray(synergy, dtype=float),
+                         'p': p}, columns=COLUMNS)
+
+
+def pair_tables(summaries, pairs='rad_lab', p_values=None, diseases=None, statistic='synergy', chunk_rows=1000000):
+    """
+    Long tables of the phenotype pairs of many diseases, in chunks of at most chunk_rows rows, so that a large panel
+    never has to be formatted or written in one piece.
+    @param summaries: a dictionary from disease to summary statistics (a lazy result store group works)
+    @param pairs: kind of the summaries, a key of PAIR_SOURCES
+    @param p_values: a dictionary from disease to p values (a lazy result store group works). Diseases without p
+    values get NaN.
+    @param diseases: diseases to export, default to all in the summaries
+    :return: a generator of data frames with COLUMNS
+    """
+    source1, source2 = PAIR_SOURCES[pairs]
+    for disease in (list(summaries) if diseases is None else diseases):
+        p_disease = p_values.get(disease) if p_values is not None else None
+        table = pair_table(disease, summaries[disease], source1, source2, p_disease, statistic)
+        logger.info('{}: {} phenotype pairs'.format(disease, len(table)))
+        for start in range(0, len(table), chunk_rows):
+            yield table.iloc[start:start + chunk_rows]
+
+
+def write_csv(tables, path):
+    """
+    Write chunks to a CSV file (compressed if path ends with .gz), one chunk at a time.
+    :return: number of rows
+    """
+    n = 0
+    for i, table in enumerate(tables):
+        table.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+        n += len(table)
+    if n == 0:
+        pd.DataFrame(columns=COLUMNS).to_csv(path, index=False)
+    return n
+
+
+def write_parquet(tables, path):
+    """
+    Write chunks to a Parquet file, one row group per chunk. Needs pyarrow.
+    :return: number of rows
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([(column, pa.float64() if column in ['mi', 'synergy', 'p'] else pa.string())
+                        for column in COLUMNS])
+    n = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for table in tables:
+            writer.write_table(pa.Table.from_pandas(table, schema=schema, preserve_index=False))
+            n += len(table)
+    return n
+
+
+def pair_table_dtypes():
+    return pd.Series({column: np.dtype(float) if column in ['mi', 'synergy', 'p'] else np.dtype(object)
+                      for column in COLUMNS})
+
+
+def load_table(tables, name, db):
+    """
+    Replace a database table with the chunks, bulk loading one chunk at a time (see Backend.bulk_append).
+    :return: number of rows
+    """
+    db.create_table(name, pair_table_dtypes())
+    n = 0
+    for table in tables:
+        db.bulk_append(name, table)
+        n += len(table)
+    db.commit()
+    return n
+
+
+def write_file(tables, path):
+    """
+    Write chunks to a .parquet file, or else a CSV file.
+    :return: number of rows
+    """
+    if str(path).endswith('.parquet'):
+        return write_parquet(tables, path)
+    return write_csv(tables, path)
@@ -0,0 +1,185 @@
+import pathlib
+import logging
+import numpy as np
+import pandas as pd
+import mimic_mf_analysis.metrics as metrics
+import mimic_mf_analysis.profiles as profiles
+
+logger = logging.getLogger(__name__)
+
+# MIMIC-III tables that the analysis reads directly, with the columns that are kept (ROW_ID of DIAGNOSES_ICD marks
+# the encounters that a delta run has to count again)
+ENCOUNTER_TABLES = {
+    'admissions': ('ADMISSIONS', ['SUBJECT_ID', 'HADM_ID'], None),
+    'DIAGNOSES_ICD': ('DIAGNOSES_ICD', ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'SEQ_NUM', 'ICD9_CODE'],
+                      {'ICD9_CODE': str})}
+
+# HPO mapping exports: the event table, the column of the event ROW_ID, the column of the phenotype and a filter
+MAPPING_EXPORTS = {
+    'NoteHpoClinPhen': ('NOTEEVENTS', 'NOTES_ROW_ID', 'MAP_TO', None),
+    'Inferred_NoteHpo': ('NOTEEVENTS', 'NOTEEVENT_ROW_ID', 'INFERRED_TO', None),
+    'LabHpo': ('LABEVENTS', 'ROW_ID', 'MAP_TO', ('NEGATED', 'F')),
+    'INFERRED_LABHPO': ('LABEVENTS', 'LABEVENT_ROW_ID', 'INFERRED_TO', None)}
+
+# file extensions that are looked for, in order
+EXTENSIONS = ['.csv.gz', '.csv']
+
+
+def find_export(directory, table):
+    """
+    Find the CSV export of a table in a directory, e.g. ADMISSIONS.csv.gz. The case of the file name is ignored.
+    :return: the path, or None if there is no export
+    """
+    files = {path.name.lower(): path for path in pathlib.Path(directory).iterdir()}
+    for extension in EXTENSIONS:
+        path = files.get((table + extension).lower())
+        if path is not None:
+            return path
+    return None
+
+
+class EventIndex:
+    """
+    The encounter of each event, kept as two int32 arrays indexed by event ROW_ID, i.e. 8 bytes per event (about
+    220 MB for LABEVENTS) no matter how large the export is. Events without HADM_ID are stored as HADM_ID 0 and left
+    out of the profiles, like in preparation.py.
+    """
+    def __init__(self, size=1 << 20):
+        self.subject = np.zeros(size, dtype=np.int32)
+        self.hadm = np.zeros(size, dtype=np.int32)
+
+    def add(self, row_id, subject_id, hadm_id):
+        end = int(row_id.max()) + 1
+        if end > len(self.subject):
+            size = max(end, 2 * len(self.subject))
+            self.subject = np.concatenate([self.subject, np.zeros(size - len(self.subject), dtype=np.int32)])
+            self.hadm = np.concatenate([self.hadm, np.zeros(size - len(self.hadm), dtype=np.int32)])
+        self.subject[row_id] = subject_id
+        self.hadm[row_id] = hadm_id
+
+    def lookup(self, row_id):
+        """
+        :return: SUBJECT_ID and HADM_ID arrays of events; HADM_ID is 0 for unknown events and events without one
+        """
+        row_id = np.asarray(row_id, dtype=np.int64)
+        known = (row_id >= 0) & (row_id < len(self.hadm))
+        subject = np.zeros(len(row_id), dtype=np.int32)
+        hadm = np.zeros(len(row_id), dtype=np.int32)
+        subject[known] = self.subject[row_id[known]]
+        hadm[known] = self.hadm[row_id[known]]
+        return subject, hadm
+
+
+@metrics.timed()
+def index_events(path, chunk_size=1000000):
+    """
+    Stream an event export (NOTEEVENTS or LABEVENTS) and index the encounter of each event. Only the ROW_ID,
+    SUBJECT_ID and HADM_ID columns are parsed, so the note text is never held in memory.
+    :return: an instance of EventIndex
+    """
+    index = EventIndex()
+    rows = 0
+    for chunk in pd.read_csv(path, usecols=['ROW_ID', 'SUBJECT_ID', 'HADM_ID'], chunksize=chunk_size):
+        index.add(chunk.ROW_ID.values, chunk.SUBJECT_ID.values, chunk.HADM_ID.fillna(0).values.astype(np.int32))
+        rows += len(chunk)
+    logger.info('indexed {} events of {}'.format(rows, path))
+    return index
+
+
+def aggregate_chunk(chunk, index, row_id_column, phenotype_column):
+    """
+    Count the phenotypes of each encounter in a chunk of an HPO mapping export.
+    :return: a data frame of SUBJECT_ID, HADM_ID, MAP_TO, OCCURRANCE, dummy with one row per encounter and phenotype
+    """
+    subject, hadm = index.lookup(chunk[row_id_column].values)
+    frame = pd.DataFrame({'SUBJECT_ID': subject, 'HADM_ID': hadm, 'MAP_TO': chunk[phenotype_column].values})
+    frame = frame[frame.HADM_ID != 0]
+    counts = frame.groupby(['SUBJECT_ID', 'HADM_ID', 'MAP_TO']).size().rename('OCCURRANCE').reset_index()
+    counts['dummy'] = 1
+    return counts
+
+
+@metrics.timed()
+def ingest_mapping(table, source, path, index, chunk_size=1000000):
+    """
+    Stream an HPO mapping export and add its per-encounter phenotype counts to a profile table. Each chunk is
+    counted on its own and upserted, so memory is bounded by the chunk size rather than by the export.
+    @param table: JAX_textHpoProfile or JAX_labHpoProfile, as created by profiles.create_profile_table()
+    @param source: a key of MAPPING_EXPORTS
+    @param index: EventIndex of the event table of the source
+    :return: number of mapping rows read, and the largest event ROW_ID among them
+    """
+    from mimic_mf_analysis import db
+    _, row_id_column, phenotype_column, condition = MAPPING_EXPORTS[source]
+    columns = [row_id_column, phenotype_column] + ([condition[0]] if condition else [])
+    rows = 0
+    high = 0
+    for chunk in pd.read_csv(path, usecols=columns, chunksize=chunk_size, dtype={phenotype_column: str}):
+        rows += len(chunk)
+        high = max(high, int(chunk[row_id_column].max()))
+        if condition:
+            chunk = chunk[chunk[condition[0]] == condition[1]]
+        with metrics.timer('ingest_chunk', source=source) as event:
+            counts = aggregate_chunk(chunk, index, row_id_column, phenotype_column)
+            db.load_frame('JAX_ingestDelta', counts, temporary=True)
+            db.upsert_counts(table, 'SELECT SUBJECT_ID, HADM_ID, MAP_TO, OCCURRANCE, dummy FROM JAX_ingestDelta',
+                             profiles.PROFILE_KEY, 'OCCURRANCE')
+            event['rows'] = len(chunk)
+    db.drop_temp_table('JAX_ingestDelta')
+    db.commit()
+    logger.info('{}: {} rows of {} aggregated'.format(table, rows, source))
+    return rows, high
+
+
+def ingest(mimic_dir, hpo_dir=None, include_inferred=True, chunk_size=1000000):
+    """
+    Build the tables that the analysis reads straight from the MIMIC-III CSV exports and the HPO mapping exports,
+    without loading MIMIC-III into a database first: admissions, DIAGNOSES_ICD and the persistent profile tables
+    JAX_textHpoProfile and JAX_labHpoProfile, which preparation.py then uses as they are. NOTEEVENTS and LABEVENTS
+    are only read to index the encounter of each event. The profile tables are built from scratch, and their
+    watermarks are set to the exports, so profiles.refresh_profile() can add later mapping rows once the sources are
+    in the database.
+    @param mimic_dir: directory of ADMISSIONS.csv.gz, DIAGNOSES_ICD.csv.gz, NOTEEVENTS.csv.gz and LABEVENTS.csv.gz
+    @param hpo_dir: directory of the HPO mapping exports, e.g. NoteHpoClinPhen.csv.gz and LabHpo.csv.gz. Default to
+    mimic_dir.
+    @param include_inferred: also aggregate the inferred phenotypes
+    @param chunk_size: rows per chunk
+    :return: a dictionary from profile table to the sources that were aggregated into it
+    """
+    from mimic_mf_analysis import db
+    hpo_dir = hpo_dir or mimic_dir
+    for name, (export, columns, dtype) in ENCOUNTER_TABLES.items():
+        path = find_export(mimic_dir, export)
+        if path is None:
+            raise FileNotFoundError('no export of {} in {}'.format(export, mimic_dir))
+        with metrics.timer('ingest_table', table=name):
+            db.load_file(name, str(path), chunk_size=chunk_size, columns=columns, dtype=dtype)
+        logger.info('{} loaded from {}'.format(name, path))
+
+    profiles.create_watermark_table()
+    aggregated = {}
+    for table, sources in profiles.PROFILE_SOURCES.items():
+        db.execute('DROP TABLE IF EXISTS {}'.format(table))
+        db.execute("DELETE FROM {} WHERE PROFILE_TABLE = ?".format(profiles.WATERMARK_TABLE), [table])
+        profiles.create_profile_table(table)
+        aggregated[table] = []
+        # the sources of a profile table refer to one event table; its index is freed before the next table
+        indexes = {}
+        for source in sources:
+            if source['inferred'] and not include_inferred:
+                continue
+            path = find_export(hpo_dir, source['source'])
+            if path is None:
+                logger.warning('no export of {} in {}, skipped'.format(source['source'], hpo_dir))
+                continue
+            events = MAPPING_EXPORTS[source['source']][0]
+            if events not in indexes:
+                events_path = find_export(mimic_dir, events)
+                if events_path is None:
+                    raise FileNotFoundError('no export of {} in {}'.format(events, mimic_dir))
+                indexes[events] = index_events(events_path, chunk_size)
+            rows, high = ingest_mapping(table, source['source'], path, indexes[events], chunk_size)
+            profiles.set_watermark(table, source['source'], high)
+            aggregated[table].append(source['source'])
+        db.commit()
+    return aggregated
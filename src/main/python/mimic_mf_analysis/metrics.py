@@ -0,0 +1,159 @@
+import json
+import os
+import time
+import socket
+import functools
+import threading
+import contextlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# prefix of Prometheus metric names
+PREFIX = 'mimic_mf'
+
+
+class Metrics:
+    """
+    Timings, row counts and byte counts of pipeline stages and queries. Every event is added to a running total per
+    stage and labels (e.g. stage batch_query for diagnosis 428), which can be written as a Prometheus textfile, and,
+    once a JSON lines file is configured, also appended to it as one line per event.
+    """
+    def __init__(self):
+        self.totals = {}
+        self.jsonl_path = None
+        self.prometheus_path = None
+        self.run_id = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), int(time.time()))
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """
+        Whether metrics are exported. Measurements that cost time themselves, such as the deep memory size of query
+        results, are only taken when enabled.
+        """
+        return self.jsonl_path is not None or self.prometheus_path is not None
+
+    def configure(self, jsonl_path=None, prometheus_path=None):
+        """
+        @param jsonl_path: append one JSON line per event to this file
+        @param prometheus_path: path of the Prometheus textfile that write_prometheus() writes by default, e.g. in the
+        textfile directory of node_exporter. The file name must end with .prom.
+        """
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+
+    def record(self, stage, seconds, rows=0, bytes=0, labels=None, **fields):
+        """
+        Record one event of a stage.
+        @param seconds: wall time
+        @param rows: rows fetched or processed
+        @param bytes: bytes fetched
+        @param labels: a dictionary of labels that the totals are kept by, e.g. {'diagnosis': '428'}. Keep the number
+        of distinct values small.
+        @param fields: extra fields of the JSON line only, e.g. the query text
+        """
+        labels = {key: str(value) for key, value in (labels or {}).items()}
+        key = (stage, tuple(sorted(labels.items())))
+        with self._lock:
+            total = self.totals.setdefault(key, {'calls': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0})
+            total['calls'] += 1
+            total['seconds'] += seconds
+            total['rows'] += int(rows)
+            total['bytes'] += int(bytes)
+            if self.jsonl_path is not None:
+                event = {'run_id': self.run_id, 'time': time.time(), 'stage': stage, 'labels': labels,
+                         'seconds': seconds, 'rows': int(rows), 'bytes': int(bytes),
+                         'rows_per_second': rows / seconds if seconds > 0 else None}
+                event.update(fields)
+                with open(self.jsonl_path, 'a') as f:
+                    f.write(json.dumps(event, default=str) + '\n')
+
+    @contextlib.contextmanager
+    def timer(self, stage, **labels):
+        """
+        Time a block of code. The block may set 'rows' and 'bytes' (and extra JSON fields) on the yielded dictionary:
+
+            with metrics.timer('batch_query', diagnosis=diagnosis) as event:
+                ...
+                event['rows'] = len(frame)
+        """
+        event = {'rows': 0, 'bytes': 0}
+        start = time.perf_counter()
+        try:
+            yield event
+        finally:
+            seconds = time.perf_counter() - start
+            rows, bytes = event.pop('rows'), event.pop('bytes')
+            self.record(stage, seconds, rows, bytes, labels, **event)
+
+    def timed(self, stage=None):
+        """
+        Decorator that times every call of a function, as stage `stage` (default to the function name).
+        """
+        def decorator(function):
+            name = stage or function.__name__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """
+        Totals per stage and labels.
+        :return: a list of dictionaries: stage, labels, calls, seconds, rows, bytes and rows_per_second
+        """
+        with self._lock:
+            items = sorted(self.totals.items())
+        return [dict(stage=stage, labels=dict(labels), rows_per_second=total['rows'] / total['seconds']
+                     if total['seconds'] > 0 else None, **total) for (stage, labels), total in items]
+
+    def write_prometheus(self, path=None):
+        """
+        Write the totals in the Prometheus text exposition format. The file is written next to its destination and
+        renamed, so a scraper never reads a partial file.
+        """
+        path = path or self.prometheus_path
+        if path is None:
+            return
+        metrics = [('stage_calls_total', 'counter', 'Number of times a stage ran', 'calls'),
+                   ('stage_seconds_total', 'counter', 'Wall time spent in a stage', 'seconds'),
+                   ('stage_rows_total', 'counter', 'Rows fetched or processed by a stage', 'rows'),
+                   ('stage_bytes_total', 'counter', 'Bytes fetched by a stage', 'bytes'),
+                   ('stage_rows_per_second', 'gauge', 'Average throughput of a stage', 'rows_per_second')]
+        totals = self.summary()
+        lines = []
+        for name, type, help, field in metrics:
+            lines.append('# HELP {}_{} {}'.format(PREFIX, name, help))
+            lines.append('# TYPE {}_{} {}'.format(PREFIX, name, type))
+            for total in totals:
+                if total[field] is None:
+                    continue
+                labels = dict(stage=total['stage'], **total['labels'])
+                lines.append('{}_{}{{{}}} {}'.format(PREFIX, name, ','.join(
+                    '{}="{}"'.format(key, _escape(value)) for key, value in labels.items()), total[field]))
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
+
+    def reset(self):
+        with self._lock:
+            self.totals = {}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# metrics of this process
+registry = Metrics()
+configure = registry.configure
+record = registry.record
+timer = registry.timer
+timed = registry.timed
+summary = registry.summary
+write_prometheus = registry.write_prometheus
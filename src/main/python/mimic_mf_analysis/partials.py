@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import pathlib
+import logging
+import numpy as np
+import mimic_mf_analysis.result_store as result_store
+
+logger = logging.getLogger(__name__)
+
+# written next to the partial summaries of a shard
+MANIFEST_FILE = 'shard.json'
+
+# summary types whose counts add up across disjoint sets of encounters
+MERGEABLE_KINDS = ('SummaryXY', 'SummaryXYz')
+
+
+def parse_shard(text):
+    """
+    Parse a shard specification k/n, e.g. 2/8 for the second of eight shards.
+    :return: a tuple (k, n)
+    """
+    match = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', str(text))
+    if match is None:
+        raise ValueError('shard has to be k/n, e.g. 2/8: {}'.format(text))
+    k, n = int(match.group(1)), int(match.group(2))
+    if not 1 <= k <= n:
+        raise ValueError('shard {} out of range 1/{} to {}/{}'.format(text, n, n, n))
+    return k, n
+
+
+def shard_range(start, end, shard):
+    """
+    The contiguous ROW_ID range of a shard. The n shards split [start, end] into ranges that differ in size by at most
+    one ROW_ID, so together they cover every encounter exactly once.
+    @param shard: a tuple (k, n), 1 <= k <= n
+    :return: the first and last ROW_ID of the shard; last is first - 1 for an empty shard
+    """
+    k, n = shard
+    start, end = int(start), int(end)
+    total = end - start + 1
+    return start + (k - 1) * total // n, start + k * total // n - 1
+
+
+def write_manifest(out_dir, shard, results, parameters):
+    """
+    Record what a shard computed, so that merge_shards() can check that the shards belong together.
+    @param results: names of the saved results
+    @param parameters: analysis parameters of the run, e.g. the thresholds from the configuration
+    """
+    manifest = {'shard': shard[0], 'shards': shard[1], 'results': list(results), 'parameters': parameters}
+    with open(os.path.join(out_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=1, default=str)
+
+
+def read_manifest(dir):
+    path = os.path.join(dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        raise FileNotFoundError('{} is not the output of a shard: {} not found'.format(dir, MANIFEST_FILE))
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_partial(dir, name):
+    """
+    Load a result that a shard saved either as {dir}/{name}.obj or as group {name} of the result store at dir.
+    """
+    path = pathlib.Path(dir).joinpath(name + '.obj')
+    if not path.exists():
+        path = pathlib.Path(dir).joinpath(name)
+    return result_store.load_results(path)
+
+
+def merge_summaries(summaries):
+    """
+    Add up the counts of summaries over disjoint sets of encounters. Every summary has to have the same phenotype
+    labels in the same order (and the same diagnosis), otherwise the counts of different phenotypes would be added.
+    @param summaries: SummaryXY or SummaryXYz objects
+    :return: a new summary object
+    """
+    merged_arrays, merged_labels, merged_attrs, merged_kind = None, None, None, None
+    for i, summary in enumerate(summaries):
+        arrays, labels, attrs, kind = result_store.summary_to_arrays(summary)
+        if kind not in MERGEABLE_KINDS:
+            raise ValueError('{} cannot be merged: only {} are'.format(kind, ', '.join(MERGEABLE_KINDS)))
+        if i == 0:
+            # compact summaries hold counts in small unsigned dtypes, which the sum could overflow
+            merged_arrays = {key: np.asarray(value).astype(np.promote_types(np.asarray(value).dtype, np.int64))
+                             for key, value in arrays.items()}
+            merged_labels, merged_attrs, merged_kind = labels, dict(attrs), kind
+            continue
+        if kind != merged_kind:
+            raise ValueError('cannot merge {} into {}'.format(kind, merged_kind))
+        for axis, values in merged_labels.items():
+            if not np.array_equal(np.asarray(values), np.asarray(labels[axis])):
+                raise ValueError('phenotype labels of {} differ between shards'.format(axis))
+        if str(attrs.get('z_name')) != str(merged_attrs.get('z_name')):
+            raise ValueError('cannot merge summaries of {} and {}'.format(merged_attrs['z_name'], attrs['z_name']))
+        for key, value in arrays.items():
+            merged_arrays[key] = merged_arrays[key] + value
+        for key in ['N', 'case_N', 'control_N']:
+            if key in attrs:
+                merged_attrs[key] = merged_attrs[key] + attrs[key]
+    if merged_kind is None:
+        raise ValueError('nothing to merge')
+    return result_store.arrays_to_summary(merged_arrays, merged_labels, merged_attrs, merged_kind)
+
+
+def merge_shards(dirs):
+    """
+    Merge the partial summaries of all shards of a run. The shards have to be complete (1/n to n/n, each once) and
+    have been run with the same parameters.
+    @param dirs: output directories of the shards
+    :return: a dictionary from result name to the merged result: a summary object, or a dictionary from diagnosis to
+    summary objects
+    """
+    manifests = [read_manifest(dir) for dir in dirs]
+    n = manifests[0]['shards']
+    found = sorted(manifest['shard'] for manifest in manifests)
+    if any(manifest['shards'] != n for manifest in manifests) or found != list(range(1, n + 1)):
+        raise ValueError('incomplete shards: found {} of {} shards'.format(
+            ', '.join('{}/{}'.format(manifest['shard'], manifest['shards']) for manifest in manifests), n))
+    for dir, manifest in zip(dirs, manifests):
+        if manifest['parameters'] != manifests[0]['parameters'] or manifest['results'] != manifests[0]['results']:
+            raise ValueError('shard {} ran with other parameters or results than {}'.format(dir, dirs[0]))
+
+    merged = {}
+    for name in manifests[0]['results']:
+        partials = [load_partial(dir, name) for dir in dirs]
+        if isinstance(partials[0], result_store.SUMMARY_TYPES):
+            merged[name] = merge_summaries(partials)
+        else:
+            keys = list(partials[0])
+            if any(sorted(partial) != sorted(keys) for partial in partials):
+                raise ValueError('diagnoses of {} differ between shards'.format(name))
+            merged[name] = {key: merge_summaries([partial[key] for partial in partials]) for key in keys}
+        logger.info('{} merged from {} shards'.format(name, n))
+    return merged
@@ -1,45 +1,46 @@
-from mimic_mf_analysis import mydb
-
-cursor = mydb.cursor(buffered=True)
+from mimic_mf_analysis import db
+import mimic_mf_analysis.metrics as metrics
 
 
+@metrics.timed()
 def encounterOfInterest(debug=False, N=100):
     """
     Define encounters of interest. The method is not finalized yet. Currently, it will use all encounters in our database.
     @param debug: set to True to select a small subset for testing
     @param N: limit the number of encounters when debug is set to True. If debug is set to False, N is ignored.
     """
-    cursor.execute('DROP TEMPORARY TABLE IF EXISTS JAX_encounterOfInterest')
+    db.drop_temp_table('JAX_encounterOfInterest')
     if debug:
         limit = 'LIMIT {}'.format(N)
     else:
         limit = ''
     # This is admissions that we want to analyze, 'LIMIT 100' in debug mode
-    cursor.execute('''
-                CREATE TEMPORARY TABLE IF NOT EXISTS JAX_encounterOfInterest(
-                    ROW_ID MEDIUMINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY)
-
+    # ROW_IDs are numbered in (SUBJECT_ID, HADM_ID) order, so that every database replica numbers encounters the same
+    # way, which sharded runs rely on
+    db.create_temp_table_as('JAX_encounterOfInterest', '''
                 SELECT 
                     DISTINCT SUBJECT_ID, HADM_ID 
                 FROM admissions
+                ORDER BY SUBJECT_ID, HADM_ID
                 {}
-                '''.format(limit))
+                '''.format(limit), row_id=True, order_by='SUBJECT_ID, HADM_ID')
 
 
+@metrics.timed()
 def indexEncounterOfInterest():
     """
     Create index on encounters table.
     """
-    cursor.execute('CREATE INDEX JAX_encounterOfInterest_idx01 ON JAX_encounterOfInterest (SUBJECT_ID, HADM_ID)')
+    db.create_index('JAX_encounterOfInterest_idx01', 'JAX_encounterOfInterest', 'SUBJECT_ID, HADM_ID')
 
 
+@metrics.timed()
 def diagnosisProfile():
     """
     For encounters of interest, find all of their diagnosis codes
     """
-    cursor.execute('DROP TEMPORARY TABLE IF EXISTS JAX_diagnosisProfile')
-    cursor.execute('''
-                CREATE TEMPORARY TABLE IF NOT EXISTS JAX_diagnosisProfile
+    db.drop_temp_table('JAX_diagnosisProfile')
+    db.create_temp_table_as('JAX_diagnosisProfile', '''
                 SELECT 
                     DIAGNOSES_ICD.SUBJECT_ID, DIAGNOSES_ICD.HADM_ID, DIAGNOSES_ICD.ICD9_CODE, DIAGNOSES_ICD.SEQ_NUM
                 FROM
@@ -53,14 +54,16 @@ def diagnosisProfile():
                 ''')
 
 
+@metrics.timed()
 def textHpoProfile(include_inferred=True):
     """
     Set up a table for patient phenotypes from text mining. By default, merge directly mapped HPO terms and inferred terms.
     It is currently defined as a temporary table. But in reality, it is created as a perminent table as it takes a long time to init, and it is going to be used multiple times.
     """
+    if db.table_exists('JAX_textHpoProfile'):
+        return
     if include_inferred:
-        cursor.execute('''
-                    CREATE TEMPORARY TABLE IF NOT EXISTS JAX_textHpoProfile
+        db.create_temp_table_as('JAX_textHpoProfile', '''
                     WITH abnorm AS (
                         SELECT
                             NOTEEVENTS.SUBJECT_ID, NOTEEVENTS.HADM_ID, NoteHpoClinPhen.MAP_TO
@@ -82,40 +85,43 @@ def textHpoProfile(include_inferred=True):
                 ''')
 
     else:
-        cursor.execute('''
-                    CREATE TEMPORARY TABLE IF NOT EXISTS JAX_p_text
+        db.create_temp_table_as('JAX_textHpoProfile', '''
                     WITH abnorm AS (
                         SELECT
                             NOTEEVENTS.SUBJECT_ID, NOTEEVENTS.HADM_ID, NoteHpoClinPhen.MAP_TO
                         FROM 
                             NOTEEVENTS 
                         JOIN NoteHpoClinPhen on NOTEEVENTS.ROW_ID = NoteHpoClinPhen.NOTES_ROW_ID)
-                    SELECT SUBJECT_ID, HADM_ID, MAP_TO
+                    SELECT SUBJECT_ID, HADM_ID, MAP_TO, COUNT(*) AS OCCURRANCE, 1 AS dummy
                     FROM abnorm 
-                    GROUP BY SUBJECT_ID, HADM_ID, MAP_TO, COUNT(*) AS OCCURRANCE, 1 AS dummy
+                    GROUP BY SUBJECT_ID, HADM_ID, MAP_TO
                 ''')
 
 
+@metrics.timed()
 def indexTextHpoProfile():
     """
     Create indeces to speed up query
     """
     # _idx01 is unnecessary if _idx3 exists
-    # cursor.execute('CREATE INDEX JAX_textHpoProfile_idx01 ON JAX_textHpoProfile (SUBJECT_ID, HADM_ID)')
-    cursor.execute('CREATE INDEX JAX_textHpoProfile_idx02 ON JAX_textHpoProfile (MAP_TO);')
-    cursor.execute('CREATE INDEX JAX_textHpoProfile_idx03 ON JAX_textHpoProfile (SUBJECT_ID, HADM_ID, MAP_TO)')
-    cursor.execute('CREATE INDEX JAX_textHpoProfile_idx04 ON JAX_textHpoProfile (OCCURRANCE)')
+    # db.create_index('JAX_textHpoProfile_idx01', 'JAX_textHpoProfile', 'SUBJECT_ID, HADM_ID')
+    db.create_index('JAX_textHpoProfile_idx02', 'JAX_textHpoProfile', 'MAP_TO')
+    db.create_index('JAX_textHpoProfile_idx03', 'JAX_textHpoProfile', 'SUBJECT_ID, HADM_ID, MAP_TO')
+    db.create_index('JAX_textHpoProfile_idx04', 'JAX_textHpoProfile', 'OCCURRANCE')
 
 
+@metrics.timed()
 def labHpoProfile(include_inferred=True):
     """
     Set up a table for lab tests-derived phenotypes. By default, also include phenotypes that are inferred from direct mapping.
     Similar to textHpoProfile, this could be created as a perminent table.
     """
-    cursor.execute('''DROP TEMPORARY TABLE IF EXISTS JAX_labHpoProfile''')
+    db.drop_temp_table('JAX_labHpoProfile')
+    # a persistent table maintained by profiles.refresh_profiles()
+    if db.table_exists('JAX_labHpoProfile'):
+        return
     if include_inferred:
-        cursor.execute('''
-                    CREATE TEMPORARY TABLE IF NOT EXISTS JAX_labHpoProfile
+        db.create_temp_table_as('JAX_labHpoProfile', '''
                     WITH abnorm AS (
                         SELECT
                             LABEVENTS.SUBJECT_ID, LABEVENTS.HADM_ID, LabHpo.MAP_TO
@@ -138,8 +144,7 @@ def labHpoProfile(include_inferred=True):
                     GROUP BY SUBJECT_ID, HADM_ID, MAP_TO
                 ''')
     else:
-        cursor.execute('''
-                    CREATE TEMPORARY TABLE IF NOT EXISTS JAX_labHpoProfile
+        db.create_temp_table_as('JAX_labHpoProfile', '''
                     WITH abnorm AS (
                         SELECT
                             LABEVENTS.SUBJECT_ID, LABEVENTS.HADM_ID, LabHpo.MAP_TO
@@ -153,28 +158,48 @@ def labHpoProfile(include_inferred=True):
                 ''')
 
 
+@metrics.timed()
 def indexLabHpoProfile():
     # _idx01 is not necessary if _idx3 exists
-    # cursor.execute('CREATE INDEX JAX_labHpoProfile_idx01 ON JAX_labHpoProfile (SUBJECT_ID, HADM_ID)')
-    cursor.execute('CREATE INDEX JAX_labHpoProfile_idx02 ON JAX_labHpoProfile (MAP_TO);')
-    cursor.execute('CREATE INDEX JAX_labHpoProfile_idx03 ON JAX_labHpoProfile (SUBJECT_ID, HADM_ID, MAP_TO)')
-    cursor.execute('CREATE INDEX JAX_labHpoProfile_idx04 ON JAX_labHpoProfile (OCCURRANCE)')
+    # db.create_index('JAX_labHpoProfile_idx01', 'JAX_labHpoProfile', 'SUBJECT_ID, HADM_ID')
+    db.create_index('JAX_labHpoProfile_idx02', 'JAX_labHpoProfile', 'MAP_TO')
+    db.create_index('JAX_labHpoProfile_idx03', 'JAX_labHpoProfile', 'SUBJECT_ID, HADM_ID, MAP_TO')
+    db.create_index('JAX_labHpoProfile_idx04', 'JAX_labHpoProfile', 'OCCURRANCE')
+
+
+@metrics.timed()
+def hpoDictionary():
+    """
+    Number the HPO terms of the textHpo and labHpo profiles from 1 in MAP_TO order, as table JAX_hpoDictionary(HPO_ID,
+    MAP_TO). Frequency rank tables carry the HPO_ID of their terms, so that batch queries return integer codes instead
+    of a string for every encounter * phenotype row (see encoding.py). Run once per run, after the profiles are set up.
+    """
+    db.drop_temp_table('JAX_hpoDictionary')
+    db.create_temp_table_as('JAX_hpoDictionary', '''
+                SELECT
+                    ROW_NUMBER() OVER (ORDER BY MAP_TO) AS HPO_ID, MAP_TO
+                FROM (
+                    SELECT MAP_TO FROM JAX_textHpoProfile
+                    UNION
+                    SELECT MAP_TO FROM JAX_labHpoProfile) AS terms
+                ''')
+    db.create_index('JAX_hpoDictionary_idx01', 'JAX_hpoDictionary', 'MAP_TO')
 
 
+@metrics.timed()
 def rankICD():
     """
     Rank frequently seen ICD-9 codes (first three or four digits) among encounters of interest.
     """
-    cursor.execute('DROP TEMPORARY TABLE IF EXISTS JAX_diagFrequencyRank')
-    cursor.execute("""
-        CREATE TEMPORARY TABLE IF NOT EXISTS JAX_diagFrequencyRank
+    db.drop_temp_table('JAX_diagFrequencyRank')
+    db.create_temp_table_as('JAX_diagFrequencyRank', """
         WITH JAX_temp_diag AS (
             SELECT DISTINCT SUBJECT_ID, HADM_ID, 
                 CASE 
-                    WHEN(ICD9_CODE LIKE 'V%') THEN SUBSTRING(ICD9_CODE, 1, 3) 
-                    WHEN(ICD9_CODE LIKE 'E%') THEN SUBSTRING(ICD9_CODE, 1, 4) 
+                    WHEN(ICD9_CODE LIKE 'V%') THEN SUBSTR(ICD9_CODE, 1, 3)
+                    WHEN(ICD9_CODE LIKE 'E%') THEN SUBSTR(ICD9_CODE, 1, 4)
                 ELSE 
-                    SUBSTRING(ICD9_CODE, 1, 3) END AS ICD9_CODE 
+                    SUBSTR(ICD9_CODE, 1, 3) END AS ICD9_CODE
             FROM JAX_diagnosisProfile)
         SELECT 
             ICD9_CODE, COUNT(*) AS N
@@ -187,6 +212,7 @@ def rankICD():
         """)
 
 
+@metrics.timed()
 def rankHpoFromText(diagnosis, hpo_min_occurrence_per_encounter):
     """
     Rank frequently seen phenotypes (HPO term) from text mining among encounters of interest.
@@ -194,9 +220,8 @@ def rankHpoFromText(diagnosis, hpo_min_occurrence_per_encounter):
     meets a minimum threshold.
     @param hpo_min_occurrence_per_encounter: threshold for a phenotype abnormality to be called. Usually use 1.
     """
-    cursor.execute('DROP TEMPORARY TABLE IF EXISTS JAX_textHpoFrequencyRank')
-    cursor.execute('''
-            CREATE TEMPORARY TABLE JAX_textHpoFrequencyRank            
+    db.drop_temp_table('JAX_textHpoFrequencyRank')
+    db.create_temp_table_as('JAX_textHpoFrequencyRank', '''
             WITH pd AS(
                 SELECT 
                     JAX_textHpoProfile.*
@@ -208,18 +233,24 @@ def rankHpoFromText(diagnosis, hpo_min_occurrence_per_encounter):
                     FROM 
                         JAX_diagnosisProfile 
                     WHERE 
-                        ICD9_CODE LIKE '{}%') AS d
+                        ICD9_CODE LIKE ?) AS d
                 ON 
                     JAX_textHpoProfile.SUBJECT_ID = d.SUBJECT_ID AND JAX_textHpoProfile.HADM_ID = d.HADM_ID
                 WHERE 
-                    OCCURRANCE >= {})
+                    OCCURRANCE >= ?)
             SELECT 
-                MAP_TO, COUNT(*) AS N, 1 AS PHENOTYPE
-            FROM pd
-            GROUP BY MAP_TO
-            ORDER BY N DESC'''.format(diagnosis, hpo_min_occurrence_per_encounter))
+                r.MAP_TO, r.N, r.PHENOTYPE, h.HPO_ID
+            FROM (
+                SELECT
+                    MAP_TO, COUNT(*) AS N, 1 AS PHENOTYPE
+                FROM pd
+                GROUP BY MAP_TO) AS r
+            JOIN JAX_hpoDictionary AS h
+            ON r.MAP_TO = h.MAP_TO
+            ORDER BY N DESC''', params=[diagnosis + '%', hpo_min_occurrence_per_encounter])
 
 
+@metrics.timed()
 def rankHpoFromLab(diagnosis, hpo_min_occurrence_per_encounter):
     """
     Rank frequently seen phenotypes (HPO term) from lab texts among encounters of interest.
@@ -228,9 +259,8 @@ def rankHpoFromLab(diagnosis, hpo_min_occurrence_per_encounter):
     @param hpo_min_occurrence_per_encounter: threshold for a phenotype abnormality to be called.
     For example, if the parameter is set to 3, HP:0002153 Hyperkalemia is assigned iff three or more lab tests return higher than normal values for blood potassium concentrations
     """
-    cursor.execute('DROP TEMPORARY TABLE IF EXISTS JAX_labHpoFrequencyRank')
-    cursor.execute('''
-            CREATE TEMPORARY TABLE JAX_labHpoFrequencyRank            
+    db.drop_temp_table('JAX_labHpoFrequencyRank')
+    db.create_temp_table_as('JAX_labHpoFrequencyRank', '''
             WITH pd AS(
                 SELECT 
                     JAX_labHpoProfile.*
@@ -242,13 +272,18 @@ def rankHpoFromLab(diagnosis, hpo_min_occurrence_per_encounter):
                     FROM 
                         JAX_diagnosisProfile 
                     WHERE 
-                        ICD9_CODE LIKE '{}%') AS d
+                        ICD9_CODE LIKE ?) AS d
                 ON 
                     JAX_labHpoProfile.SUBJECT_ID = d.SUBJECT_ID AND JAX_labHpoProfile.HADM_ID = d.HADM_ID
                 WHERE
-                    OCCURRANCE >= {})
+                    OCCURRANCE >= ?)
             SELECT 
-                MAP_TO, COUNT(*) AS N, 1 AS PHENOTYPE
-            FROM pd
-            GROUP BY MAP_TO
-            ORDER BY N DESC'''.format(diagnosis, hpo_min_occurrence_per_encounter))
+                r.MAP_TO, r.N, r.PHENOTYPE, h.HPO_ID
+            FROM (
+                SELECT
+                    MAP_TO, COUNT(*) AS N, 1 AS PHENOTYPE
+                FROM pd
+                GROUP BY MAP_TO) AS r
+            JOIN JAX_hpoDictionary AS h
+            ON r.MAP_TO = h.MAP_TO
+            ORDER BY N DESC''', params=[diagnosis + '%', hpo_min_occurrence_per_encounter])
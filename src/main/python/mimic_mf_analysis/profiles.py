@@ -0,0 +1,157 @@
+import time
+import logging
+import pandas as pd
+import mimic_mf_analysis.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+# persistent table of the source ROW_IDs that each profile table has aggregated so far
+WATERMARK_TABLE = 'JAX_profileWatermark'
+
+# sources of the phenotype profiles: the rows of a source are ordered by the event ROW_ID that they were mapped from
+PROFILE_SOURCES = {
+    'JAX_textHpoProfile': [
+        {'source': 'NoteHpoClinPhen',
+         'watermark': 'NoteHpoClinPhen.NOTES_ROW_ID',
+         'inferred': False,
+         'select': '''
+            SELECT NOTEEVENTS.SUBJECT_ID, NOTEEVENTS.HADM_ID, NoteHpoClinPhen.MAP_TO
+            FROM NOTEEVENTS
+            JOIN NoteHpoClinPhen ON NOTEEVENTS.ROW_ID = NoteHpoClinPhen.NOTES_ROW_ID
+            WHERE 1 = 1'''},
+        {'source': 'Inferred_NoteHpo',
+         'watermark': 'Inferred_NoteHpo.NOTEEVENT_ROW_ID',
+         'inferred': True,
+         'select': '''
+            SELECT NOTEEVENTS.SUBJECT_ID, NOTEEVENTS.HADM_ID, Inferred_NoteHpo.INFERRED_TO AS MAP_TO
+            FROM NOTEEVENTS
+            JOIN Inferred_NoteHpo ON NOTEEVENTS.ROW_ID = Inferred_NoteHpo.NOTEEVENT_ROW_ID
+            WHERE 1 = 1'''}],
+    'JAX_labHpoProfile': [
+        {'source': 'LabHpo',
+         'watermark': 'LabHpo.ROW_ID',
+         'inferred': False,
+         'select': '''
+            SELECT LABEVENTS.SUBJECT_ID, LABEVENTS.HADM_ID, LabHpo.MAP_TO
+            FROM LABEVENTS
+            JOIN LabHpo ON LABEVENTS.ROW_ID = LabHpo.ROW_ID
+            WHERE LabHpo.NEGATED = 'F'
+            '''},
+        {'source': 'INFERRED_LABHPO',
+         'watermark': 'INFERRED_LABHPO.LABEVENT_ROW_ID',
+         'inferred': True,
+         'select': '''
+            SELECT LABEVENTS.SUBJECT_ID, LABEVENTS.HADM_ID, INFERRED_LABHPO.INFERRED_TO AS MAP_TO
+            FROM INFERRED_LABHPO
+            JOIN LABEVENTS ON INFERRED_LABHPO.LABEVENT_ROW_ID = LABEVENTS.ROW_ID
+            WHERE 1 = 1'''}]}
+
+PROFILE_KEY = ['SUBJECT_ID', 'HADM_ID', 'MAP_TO']
+
+
+def create_profile_table(table):
+    """
+    Create a persistent profile table if it does not exist, with the same columns as the temporary tables of
+    preparation.py, a primary key on (SUBJECT_ID, HADM_ID, MAP_TO) that upserts rely on, and the MAP_TO and
+    OCCURRANCE indexes.
+    """
+    from mimic_mf_analysis import db
+    if db.table_exists(table):
+        return
+    db.execute('''
+        CREATE TABLE {} (
+            SUBJECT_ID INT NOT NULL,
+            HADM_ID INT NOT NULL,
+            MAP_TO VARCHAR(255) NOT NULL,
+            OCCURRANCE BIGINT NOT NULL,
+            dummy INT NOT NULL,
+            PRIMARY KEY (SUBJECT_ID, HADM_ID, MAP_TO))'''.format(table))
+    db.create_index('{}_idx02'.format(table), table, 'MAP_TO')
+    db.create_index('{}_idx04'.format(table), table, 'OCCURRANCE')
+
+
+def create_watermark_table():
+    from mimic_mf_analysis import db
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS {} (
+            PROFILE_TABLE VARCHAR(64) NOT NULL,
+            SOURCE VARCHAR(64) NOT NULL,
+            WATERMARK BIGINT NOT NULL,
+            UPDATED VARCHAR(32) NOT NULL,
+            PRIMARY KEY (PROFILE_TABLE, SOURCE))'''.format(WATERMARK_TABLE))
+
+
+def watermarks(table):
+    """
+    :return: a dictionary from source table to the largest source ROW_ID aggregated into a profile table
+    """
+    from mimic_mf_analysis import db
+    create_watermark_table()
+    frame = db.read_sql('SELECT SOURCE, WATERMARK FROM {} WHERE PROFILE_TABLE = ?'.format(WATERMARK_TABLE), [table])
+    return dict(zip(frame.SOURCE, frame.WATERMARK.astype(int)))
+
+
+def set_watermark(table, source, watermark):
+    from mimic_mf_analysis import db
+    db.execute('DELETE FROM {} WHERE PROFILE_TABLE = ? AND SOURCE = ?'.format(WATERMARK_TABLE), [table, source])
+    db.execute('INSERT INTO {} (PROFILE_TABLE, SOURCE, WATERMARK, UPDATED) VALUES (?, ?, ?, ?)'.format(
+        WATERMARK_TABLE), [table, source, int(watermark), time.strftime('%Y-%m-%dT%H:%M:%S')])
+
+
+def refresh_profile(table, include_inferred=True, rebuild=False):
+    """
+    Bring a persistent profile table up to date with its sources. Only source rows above the watermark of each source
+    are aggregated, and their counts are added to the OCCURRANCE of existing (SUBJECT_ID, HADM_ID, MAP_TO) rows or
+    inserted as new rows, so a refresh costs time in proportion to the new rows rather than to NOTEEVENTS/LABEVENTS.
+    This assumes that rows mapped from an event are added together, i.e. no new source row refers to an event ROW_ID
+    at or below the watermark; use rebuild otherwise. Rows without HADM_ID are left out, as they never match an
+    encounter.
+    @param table: JAX_textHpoProfile or JAX_labHpoProfile
+    @param include_inferred: also aggregate the inferred phenotypes
+    @param rebuild: drop the table and aggregate all source rows
+    :return: a dictionary from source table to its watermarks before and after the refresh
+    """
+    from mimic_mf_analysis import db
+    if rebuild:
+        db.execute('DROP TABLE IF EXISTS {}'.format(table))
+        create_watermark_table()
+        db.execute('DELETE FROM {} WHERE PROFILE_TABLE = ?'.format(WATERMARK_TABLE), [table])
+    create_profile_table(table)
+    current = watermarks(table)
+
+    sources = [source for source in PROFILE_SOURCES[table] if include_inferred or not source['inferred']]
+    deltas = []
+    ranges = {}
+    for source in sources:
+        low = current.get(source['source'], 0)
+        # fix the upper end first, so rows that arrive during the refresh are left for the next one
+        high = db.read_sql('SELECT MAX({}) AS high FROM {}'.format(source['watermark'], source['source'])).high[0]
+        high = low if pd.isna(high) else max(int(high), low)
+        ranges[source['source']] = (low, high)
+        if high > low:
+            deltas.append('{} AND {} > {} AND {} <= {}'.format(source['select'], source['watermark'], low,
+                                                               source['watermark'], high))
+
+    if deltas:
+        select = '''
+            WITH abnorm AS ({})
+            SELECT SUBJECT_ID, HADM_ID, MAP_TO, COUNT(*) AS OCCURRANCE, 1 AS dummy
+            FROM abnorm
+            WHERE HADM_ID IS NOT NULL
+            GROUP BY SUBJECT_ID, HADM_ID, MAP_TO'''.format('\n UNION ALL \n'.join(deltas))
+        with metrics.timer('refresh_profile', table=table):
+            db.upsert_counts(table, select, PROFILE_KEY, 'OCCURRANCE')
+    for source, (low, high) in ranges.items():
+        set_watermark(table, source, high)
+    db.commit()
+    logger.info('{}: {}'.format(table, ', '.join(
+        '{} ROW_ID {} -> {}'.format(source, low, high) for source, (low, high) in ranges.items())))
+    return ranges
+
+
+def refresh_profiles(tables=None, include_inferred=True, rebuild=False):
+    """
+    Refresh the persistent profile tables, by default JAX_textHpoProfile and JAX_labHpoProfile.
+    :return: a dictionary from profile table to the output of refresh_profile()
+    """
+    return {table: refresh_profile(table, include_inferred, rebuild) for table in (tables or list(PROFILE_SOURCES))}
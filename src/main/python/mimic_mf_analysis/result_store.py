@@ -0,0 +1,404 @@
+import numpy as np
+import json
+import os
+import pathlib
+import pickle
+import logging
+from collections.abc import Mapping
+import mutual_information.mf as mf
+import mimic_mf_analysis.sparse_pairs as sparse_pairs
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.json'
+SUMMARY_TYPES = (mf.SummaryXY, mf.SummaryXYz, sparse_pairs.SparseSummaryXYz)
+
+# unsigned dtypes that compact summaries store counts in, smallest first
+COUNT_DTYPES = (np.uint8, np.uint16, np.uint32, np.uint64)
+# compact summaries store the ++ cells of phenotype pairs as (row, col, count) triplets when at most this fraction of
+# pairs ever co-occur
+SPARSE_DENSITY = 0.25
+
+
+class ResultStore:
+    """
+    On-disk store for analysis results, as an alternative to pickling whole dictionaries. Results are organized in
+    groups (e.g. summaries_diag_rad_lab), and each group holds entries keyed by disease (or job). Every array of an
+    entry is saved as its own .npy file so that readers can memory-map it and read a single disease, or a block of
+    phenotype pairs, without loading anything else. With compress=True, the arrays of an entry are saved in one
+    compressed .npz file instead, which is smaller but is read array by array rather than memory-mapped.
+    A JSON index lists the groups, entries, phenotype labels, scalar attributes and the shape and dtype of each array.
+
+    Layout:
+        {path}/index.json
+        {path}/{group}/{key}/{array}.npy  (or {path}/{group}/{key}/arrays.npz)
+    """
+    def __init__(self, path, create=False):
+        """
+        @param path: directory of the store
+        @param create: create the store if it does not exist
+        """
+        self.path = pathlib.Path(path)
+        index_path = self.path.joinpath(INDEX_FILE)
+        if index_path.exists():
+            with open(index_path, 'r') as f:
+                self.index = json.load(f)
+        elif create:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.index = {'version': 1, 'groups': {}}
+            self._write_index()
+        else:
+            raise FileNotFoundError('not a result store: {}'.format(path))
+
+    def _write_index(self):
+        # write then rename, so that readers never see a partial index
+        temp_path = self.path.joinpath(INDEX_FILE + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(temp_path, self.path.joinpath(INDEX_FILE))
+
+    def groups(self):
+        return list(self.index['groups'].keys())
+
+    def keys(self, group):
+        return list(self.index['groups'].get(group, {}).keys())
+
+    def entry(self, group, key):
+        """
+        Return the index entry of a result: kind, labels, attrs and array metadata.
+        """
+        try:
+            return self.index['groups'][group][key]
+        except KeyError:
+            raise KeyError('{}/{} not found in result store {}'.format(group, key, self.path))
+
+    def write_arrays(self, group, key, arrays, labels=None, attrs=None, kind='arrays', compress=False):
+        """
+        Write a dictionary of arrays as one entry. An existing entry with the same key is replaced.
+        @param group: group name
+        @param key: entry key, usually a disease code
+        @param arrays: a dictionary from array name to numpy array
+        @param labels: a dictionary from axis name to phenotype labels, e.g. {'set1': [...], 'set2': [...]}
+        @param attrs: a dictionary of JSON serializable scalar attributes
+        @param kind: what the arrays represent, used to rebuild objects when reading
+        @param compress: save the arrays in one compressed npz file instead of one npy file each
+        """
+        entry_dir = self.path.joinpath(group, str(key))
+        entry_dir.mkdir(parents=True, exist_ok=True)
+        if compress:
+            np.savez_compressed(entry_dir.joinpath('arrays.npz'), **arrays)
+        else:
+            for name, array in arrays.items():
+                np.save(entry_dir.joinpath(name + '.npy'), np.asarray(array), allow_pickle=False)
+        self.index['groups'].setdefault(group, {})[str(key)] = describe_entry(arrays, labels, attrs, kind, compress)
+        self._write_index()
+
+    def read_array(self, group, key, name, mmap=True):
+        """
+        Read one array of an entry. Uncompressed arrays are memory-mapped unless mmap is False.
+        """
+        entry = self.entry(group, key)
+        if name not in entry['arrays']:
+            raise KeyError('{} not found in {}/{}'.format(name, group, key))
+        entry_dir = self.path.joinpath(group, str(key))
+        if entry['compressed']:
+            with np.load(entry_dir.joinpath('arrays.npz'), allow_pickle=False) as arrays:
+                return arrays[name]
+        return np.load(entry_dir.joinpath(name + '.npy'), mmap_mode='r' if mmap else None, allow_pickle=False)
+
+    def read_block(self, group, key, name, rows=slice(None), cols=slice(None)):
+        """
+        Read a block of phenotype pairs, e.g. read_block('summaries_diag_rad_lab', '038', 'm2', slice(0, 10)).
+        Only the requested block is copied into memory.
+        """
+        return np.array(self.read_array(group, key, name)[rows, cols])
+
+    def read_arrays(self, group, key, mmap=True):
+        entry = self.entry(group, key)
+        return {name: self.read_array(group, key, name, mmap) for name in entry['arrays']}
+
+    def write_summary(self, group, key, summary, compress=False, compact=False):
+        """
+        Write an instance of SummaryXYz, SummaryXY or SparseSummaryXYz.
+        @param compact: store counts in the smallest unsigned dtype and only the cells that the marginals do not
+        determine (see compact_arrays). Compact entries are rebuilt in memory when read, not memory-mapped.
+        """
+        arrays, labels, attrs, kind = compact_arrays(summary) if compact else summary_to_arrays(summary)
+        self.write_arrays(group, key, arrays, labels, attrs, kind, compress)
+
+    def read_summary(self, group, key, mmap=True):
+        """
+        Rebuild an instance of SummaryXYz, SummaryXY or SparseSummaryXYz. Count arrays are memory-mapped unless mmap is
+        False.
+        """
+        entry = self.entry(group, key)
+        return arrays_to_summary(self.read_arrays(group, key, mmap), entry['labels'], entry['attrs'], entry['kind'])
+
+    def write_summaries(self, group, summaries, compress=False, compact=False):
+        """
+        Write a dictionary from disease to summary statistics, e.g. output of summarize_diagnosis_textHpo_labHpo.
+        """
+        for key, summary in summaries.items():
+            self.write_summary(group, key, summary, compress, compact)
+
+    def summaries(self, group, mmap=True):
+        """
+        Return a read-only dictionary of the summaries in a group. Summaries are loaded when accessed.
+        """
+        return LazyGroup(self, group, mmap)
+
+
+class LazyGroup(Mapping):
+    """
+    Dictionary view of a group of a result store, which loads an entry only when it is accessed.
+    """
+    def __init__(self, store, group, mmap=True):
+        self.store = store
+        self.group = group
+        self.mmap = mmap
+
+    def __getitem__(self, key):
+        if key not in self.store.keys(self.group):
+            raise KeyError(key)
+        entry = self.store.entry(self.group, key)
+        if entry['kind'] == 'arrays':
+            return self.store.read_arrays(self.group, key, self.mmap)
+        return self.store.read_summary(self.group, key, self.mmap)
+
+    def __iter__(self):
+        return iter(self.store.keys(self.group))
+
+    def __len__(self):
+        return len(self.store.keys(self.group))
+
+
+def describe_entry(arrays, labels=None, attrs=None, kind='arrays', compress=False):
+    """
+    Index entry for a dictionary of arrays.
+    """
+    return {'kind': kind,
+            'compressed': compress,
+            'labels': {axis: [str(label) for label in values] for axis, values in (labels or {}).items()},
+            'attrs': attrs or {},
+            'arrays': {name: {'shape': list(np.shape(array)), 'dtype': str(np.asarray(array).dtype)}
+                       for name, array in arrays.items()}}
+
+
+def summary_to_arrays(summary):
+    """
+    Split a summary object into arrays, labels, scalar attributes and kind.
+    """
+    if isinstance(summary, mf.SummaryXYz):
+        arrays = {'m1_set1': summary.m1['set1'], 'm1_set2': summary.m1['set2'], 'm2': summary.m2}
+        attrs = {'z_name': str(summary.z_name), 'case_N': int(summary.case_N), 'control_N': int(summary.control_N)}
+        return arrays, summary.vars_labels, attrs, 'SummaryXYz'
+    elif isinstance(summary, mf.SummaryXY):
+        labels = {'set1': summary.X_names, 'set2': summary.Y_names}
+        return {'m': summary.m}, labels, {'N': int(summary.N)}, 'SummaryXY'
+    elif isinstance(summary, sparse_pairs.SparseSummaryXYz):
+        arrays, labels, attrs = summary.to_arrays()
+        return arrays, labels, attrs, 'SparseSummaryXYz'
+    else:
+        raise ValueError('unsupported summary type: {}'.format(type(summary)))
+
+
+def arrays_to_summary(arrays, labels, attrs, kind):
+    """
+    Rebuild a summary object from arrays, labels and scalar attributes.
+    """
+    if attrs.get('compact'):
+        return expand_arrays(arrays, labels, attrs, kind)
+    if kind == 'SummaryXYz':
+        summary = mf.SummaryXYz(labels['set1'], labels['set2'], attrs['z_name'])
+        summary.m1 = {'set1': arrays['m1_set1'], 'set2': arrays['m1_set2']}
+        summary.m2 = arrays['m2']
+        summary.case_N = attrs['case_N']
+        summary.control_N = attrs['control_N']
+    elif kind == 'SummaryXY':
+        summary = mf.SummaryXY(labels['set1'], labels['set2'])
+        summary.m = arrays['m']
+        summary.N = attrs['N']
+    elif kind == 'SparseSummaryXYz':
+        summary = sparse_pairs.SparseSummaryXYz.from_arrays(arrays, labels, attrs)
+    else:
+        raise ValueError('unsupported summary type: {}'.format(kind))
+    return summary
+
+
+def count_dtype(n):
+    """
+    The smallest unsigned dtype that holds counts up to n.
+    """
+    for dtype in COUNT_DTYPES:
+        if n <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError('count {} does not fit into {}'.format(n, COUNT_DTYPES[-1].__name__))
+
+
+def _as_counts(array, dtype):
+    array = np.asarray(array)
+    if array.size and (array.min() < 0 or not np.array_equal(array, np.round(array))):
+        raise ValueError('summary holds values that are not counts')
+    return array.astype(dtype)
+
+
+def compact_arrays(summary):
+    """
+    Split a summary object into compact arrays. Counts are stored in the smallest unsigned dtype that holds the number
+    of encounters. Of the cells of a phenotype pair, only ++ (for either value of z) is stored: the other cells follow
+    from the marginals, e.g. +- = x+ - ++ and -- = N - x+ - y+ + ++, and are rebuilt by expand_arrays(). The ++ cells
+    are stored as (row, col, count) triplets if few phenotype pairs ever co-occur.
+    SparseSummaryXYz objects are already sparse and are returned as by summary_to_arrays().
+    :return: arrays, labels, scalar attributes and kind, as summary_to_arrays()
+    """
+    if isinstance(summary, mf.SummaryXYz):
+        dtype = count_dtype(int(summary.case_N) + int(summary.control_N))
+        # ++ cells for z = + and z = -
+        both = _as_counts(summary.m2[:, :, 0:2], dtype)
+        arrays = {'m1_set1': _as_counts(summary.m1['set1'], dtype), 'm1_set2': _as_counts(summary.m1['set2'], dtype)}
+        attrs = {'z_name': str(summary.z_name), 'case_N': int(summary.case_N), 'control_N': int(summary.control_N)}
+        labels = summary.vars_labels
+    elif isinstance(summary, mf.SummaryXY):
+        dtype = count_dtype(int(summary.N))
+        both = _as_counts(summary.m[:, :, 0:1], dtype)
+        # SummaryXY keeps no marginals; every pair of a phenotype has the same one
+        x = summary.m[:, 0, 0] + summary.m[:, 0, 1] if summary.M2 else np.zeros(summary.M1)
+        y = summary.m[0, :, 0] + summary.m[0, :, 2] if summary.M1 else np.zeros(summary.M2)
+        arrays = {'x': _as_counts(x, dtype), 'y': _as_counts(y, dtype)}
+        attrs = {'N': int(summary.N)}
+        labels = {'set1': summary.X_names, 'set2': summary.Y_names}
+    else:
+        return summary_to_arrays(summary)
+
+    rows, cols = np.nonzero(both.any(axis=-1))
+    attrs.update({'compact': True, 'shape': list(both.shape[:2])})
+    if len(rows) <= SPARSE_DENSITY * both.shape[0] * both.shape[1]:
+        index_dtype = count_dtype(max(both.shape[:2]))
+        arrays.update({'pp_rows': rows.astype(index_dtype), 'pp_cols': cols.astype(index_dtype),
+                       'pp': both[rows, cols]})
+    else:
+        arrays['pp'] = both
+    return arrays, labels, attrs, type(summary).__name__
+
+
+def expand_arrays(arrays, labels, attrs, kind):
+    """
+    Rebuild a summary object from the output of compact_arrays(). Counts keep the compact dtype.
+    """
+    M1, M2 = attrs['shape']
+    pp = np.asarray(arrays['pp'])
+    if 'pp_rows' in arrays:
+        both = np.zeros([M1, M2, pp.shape[-1]], dtype=pp.dtype)
+        both[np.asarray(arrays['pp_rows'], dtype=np.intp), np.asarray(arrays['pp_cols'], dtype=np.intp)] = pp
+    else:
+        both = pp
+    if kind == 'SummaryXYz':
+        set1, set2 = np.asarray(arrays['m1_set1']), np.asarray(arrays['m1_set2'])
+        m2 = np.empty([M1, M2, 8], dtype=pp.dtype)
+        for z, N in enumerate([attrs['case_N'], attrs['control_N']]):
+            # columns of m1: ++, +-, -+, -- of (x, z); of m2: +++, ++-, +-+, +--, -++, -+-, --+, --- of (x, y, z)
+            x, y, xy = set1[:, z].astype(np.int64)[:, np.newaxis], set2[:, z].astype(np.int64), both[:, :, z]
+            m2[:, :, z] = xy
+            m2[:, :, 2 + z] = x - xy
+            m2[:, :, 4 + z] = y - xy
+            m2[:, :, 6 + z] = N - x - y + xy
+        summary = mf.SummaryXYz(labels['set1'], labels['set2'], attrs['z_name'])
+        summary.m1 = {'set1': set1, 'set2': set2}
+        summary.m2 = m2
+        summary.case_N = attrs['case_N']
+        summary.control_N = attrs['control_N']
+    elif kind == 'SummaryXY':
+        x, y, xy = np.asarray(arrays['x'], dtype=np.int64)[:, np.newaxis], np.asarray(arrays['y'], dtype=np.int64), \
+            both[:, :, 0]
+        m = np.empty([M1, M2, 4], dtype=pp.dtype)
+        m[:, :, 0] = xy
+        m[:, :, 1] = x - xy
+        m[:, :, 2] = y - xy
+        m[:, :, 3] = attrs['N'] - x - y + xy
+        summary = mf.SummaryXY(labels['set1'], labels['set2'])
+        summary.m = m
+        summary.N = attrs['N']
+    else:
+        raise ValueError('unsupported summary type: {}'.format(kind))
+    return summary
+
+
+class CompactSummary:
+    """
+    Pickles a summary object in the compact form of compact_arrays(). Unpickling returns the rebuilt summary object,
+    not a CompactSummary, so readers of pickled results need no changes.
+    """
+    def __init__(self, summary):
+        self.arrays, self.labels, self.attrs, self.kind = compact_arrays(summary)
+
+    def __reduce__(self):
+        return expand_arrays, (self.arrays, {axis: [str(label) for label in values]
+                                             for axis, values in self.labels.items()}, self.attrs, self.kind)
+
+
+def compact(results):
+    """
+    Wrap the SummaryXY and SummaryXYz objects of results (a summary object or a dictionary of them) for compact
+    pickling. Other values are returned unchanged.
+    """
+    if isinstance(results, dict):
+        return {key: compact(value) for key, value in results.items()}
+    if isinstance(results, (mf.SummaryXY, mf.SummaryXYz)):
+        return CompactSummary(results)
+    return results
+
+
+def open_group(path, mmap=True):
+    """
+    Open a group directory of a result store as a dictionary, e.g. open_group('out/store/summaries_diag_rad_lab').
+    """
+    path = pathlib.Path(path)
+    return ResultStore(path.parent).summaries(path.name, mmap)
+
+
+def is_group(path):
+    path = pathlib.Path(path)
+    return path.is_dir() and path.parent.joinpath(INDEX_FILE).exists()
+
+
+def load_results(path):
+    """
+    Load analysis results from either a pickle file or a group of a result store.
+    """
+    if is_group(path):
+        return open_group(path)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def convert_pickle(pickle_path, store_path, group=None, compress=False):
+    """
+    Convert a pickled result into a group of a result store. Supported contents are a summary object
+    (summary_*.obj), a dictionary from disease to summary objects (summaries_diag_*.obj) and dictionaries of arrays
+    (*_distribution.obj, estimate output), optionally keyed by disease.
+    @param pickle_path: path of the pickle file
+    @param store_path: directory of the result store, created if it does not exist
+    @param group: group name, default to the file name without extension
+    :return: the group name
+    """
+    if group is None:
+        group = pathlib.Path(pickle_path).stem
+    with open(pickle_path, 'rb') as f:
+        content = pickle.load(f)
+    store = ResultStore(store_path, create=True)
+    if isinstance(content, SUMMARY_TYPES):
+        store.write_summary(group, 'all', content, compress)
+    elif isinstance(content, dict) and all(isinstance(value, np.ndarray) for value in content.values()):
+        store.write_arrays(group, 'all', content, compress=compress)
+    elif isinstance(content, dict):
+        for key, value in content.items():
+            if isinstance(value, SUMMARY_TYPES):
+                store.write_summary(group, key, value, compress)
+            elif isinstance(value, dict):
+                store.write_arrays(group, key, value, compress=compress)
+            else:
+                raise ValueError('cannot convert {} of type {}'.format(key, type(value)))
+    else:
+        raise ValueError('cannot convert content of type {}'.format(type(content)))
+    logger.info('converted {} into {}/{}'.format(pickle_path, store_path, group))
+    return group
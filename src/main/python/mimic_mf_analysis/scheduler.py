@@ -0,0 +1,190 @@
+import numpy as np
+import os
+import json
+import pickle
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from mutual_information.mf_random import synergy_random
+import mimic_mf_analysis.simulation as simulation
+import mimic_mf_analysis.shards as shards
+
+logger = logging.getLogger(__name__)
+
+
+def plan_path(dir, disease):
+    return os.path.join(dir, '{}_shard_plan.json'.format(disease))
+
+
+def plan_shards(total_simulations, shard_size, entropy=None):
+    """
+    Split simulations into shards with independent seed streams. Shard i draws its seeds from
+    SeedSequence(entropy).spawn(n)[i], so the same entropy reproduces every shard. The streams are independent, but
+    each simulation is seeded with a 32-bit seed (see shard_seeds()), so two simulations may repeat a seed by chance.
+    @param total_simulations: total number of simulations
+    @param shard_size: number of simulations per shard
+    @param entropy: root entropy of the seed sequence. Default to fresh entropy from the OS.
+    :return: a plan: a dictionary with the root entropy and a list of shards
+    """
+    seed_sequence = np.random.SeedSequence(entropy)
+    n_shards = int(np.ceil(total_simulations / shard_size))
+    plan = {'entropy': seed_sequence.entropy, 'total_simulations': total_simulations, 'shards': []}
+    for i, child in enumerate(seed_sequence.spawn(n_shards)):
+        plan['shards'].append({'shard': i,
+                               'simulations': min(shard_size, total_simulations - i * shard_size),
+                               'spawn_key': list(child.spawn_key)})
+    return plan
+
+
+def shard_seeds(plan, shard):
+    """
+    Seeds of the simulations of a shard, as accepted by synergy_random. np.random.seed only accepts 32-bit seeds, so
+    with n simulations in total, a repeated seed occurs with a probability of about n ** 2 / 2 ** 33 (roughly 1% for
+    10^4 simulations). A repeated seed only duplicates one draw of the null distribution.
+    """
+    seed_sequence = np.random.SeedSequence(plan['entropy'], spawn_key=tuple(shard['spawn_key']))
+    return [int(seed) for seed in seed_sequence.generate_state(shard['simulations'], dtype=np.uint32)]
+
+
+def save_plan(plan, dir, disease):
+    with open(plan_path(dir, disease), 'w') as f:
+        json.dump(plan, f, indent=1)
+
+
+def load_plan(dir, disease):
+    path = plan_path(dir, disease)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def shard_file_path(dir, disease, shard, mode):
+    # shard numbers restart at 0 for every plan, like the job ids of simulate, so the file names of the scheduler have
+    # their own prefix and both kinds of shards can share an output directory
+    suffix = '_counts.obj' if mode == 'counts' else '_distribution.obj'
+    return os.path.join(dir, '{}_shard{}{}'.format(disease, shard['shard'], suffix))
+
+
+def run_shard(summary, disease, plan, shard, out_dir, per_simulation=None, mode='distribution'):
+    """
+    Run the simulations of one shard serially, save them and record the shard in the manifest.
+    @param summary: observed summary statistics, an instance of SummaryXYz
+    @param disease: disease code
+    @param plan: the shard plan, see plan_shards()
+    @param shard: one shard of the plan
+    @param out_dir: output directory
+    @param per_simulation: number of encounters per simulation. Default to observed encounters.
+    @param mode: 'distribution' to save every simulated value, 'counts' to save exceedance counters
+    :return: path of the shard file
+    """
+    diag_prob, phenotype_prob1, phenotype_prob2, TOTAL = simulation.null_parameters(summary)
+    if per_simulation is None:
+        per_simulation = TOTAL
+    seeds = shard_seeds(plan, shard)
+    if mode == 'counts':
+        content = simulation.ExceedanceCounter(simulation.observed_statistics(summary), seed=seeds[0])
+        for seed in seeds:
+            content.add(synergy_random(diag_prob, phenotype_prob1, phenotype_prob2, per_simulation, seed))
+    else:
+        results = [synergy_random(diag_prob, phenotype_prob1, phenotype_prob2, per_simulation, seed)
+                   for seed in seeds]
+        content = {key: np.stack([result[key] for result in results], axis=-1) for key in simulation.STATISTICS}
+
+    path = shard_file_path(out_dir, disease, shard, mode)
+    # write under a temporary name first, so that an interrupted shard never looks complete
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(content, file=f, protocol=2)
+    os.replace(path + '.tmp', path)
+    seed = {'entropy': plan['entropy'], 'spawn_key': shard['spawn_key']}
+    shards.record_shard(out_dir, disease, shard['shard'], path, mode, seed, shard['simulations'], content)
+    return path
+
+
+def _belongs_to_plan(record, plan, shard):
+    return record['seed'] == {'entropy': plan['entropy'], 'spawn_key': shard['spawn_key']} and \
+        record['simulations'] == shard['simulations']
+
+
+def completed_shards(plan, out_dir, disease, mode):
+    """
+    Shards of the plan that are already recorded in the manifest with a matching file on disk.
+    """
+    records = shards.read_manifest(out_dir, disease)
+    done = set()
+    for shard in plan['shards']:
+        path = shard_file_path(out_dir, disease, shard, mode)
+        record = records.get(os.path.basename(path))
+        if record is not None and record['kind'] == mode and os.path.exists(path) and \
+                _belongs_to_plan(record, plan, shard) and shards.checksum(path) == record['sha256']:
+            done.add(shard['shard'])
+    return done
+
+
+def discard_stale_shards(plan, out_dir, disease):
+    """
+    Delete the scheduler shards of a disease that do not belong to the plan, with their manifest records, e.g. after
+    the plan was replaced with another seed or number of simulations. Otherwise shards of the old plan would be
+    loaded together with the new ones. Shards of simulate are left alone.
+    :return: file names of the deleted shards
+    """
+    records = shards.read_manifest(out_dir, disease)
+    current = dict()
+    for mode in shards.SHARD_SUFFIXES:
+        for shard in plan['shards']:
+            current[os.path.basename(shard_file_path(out_dir, disease, shard, mode))] = shard
+    prefix = '{}_shard'.format(disease)
+    on_disk = [file_name for mode in shards.SHARD_SUFFIXES for file_name in shards.discover(out_dir, disease, mode)
+               if file_name.startswith(prefix)]
+    listed = [file_name for file_name in records if file_name.startswith(prefix)]
+    stale = sorted(file_name for file_name in set(on_disk) | set(listed)
+                   if file_name not in current or file_name not in records or
+                   not _belongs_to_plan(records[file_name], plan, current[file_name]))
+    for file_name in stale:
+        if os.path.exists(os.path.join(out_dir, file_name)):
+            os.remove(os.path.join(out_dir, file_name))
+    shards.remove_records(out_dir, disease, stale)
+    if stale:
+        logger.info('{}: deleted {} shards of an earlier plan'.format(disease, len(stale)))
+    return stale
+
+
+def run_shards(summary, disease, plan, out_dir, per_simulation=None, mode='distribution', cpu=None, retries=2):
+    """
+    Run the shards of a plan on a local process pool. Shards already completed (e.g. by an earlier, interrupted
+    run) are skipped, and failed shards are retried with a new pool, so a crashed worker does not lose other shards.
+    @param retries: number of times failed shards are retried
+    :return: shard numbers that still failed after all retries (empty on success)
+    """
+    done = completed_shards(plan, out_dir, disease, mode)
+    pending = [shard for shard in plan['shards'] if shard['shard'] not in done]
+    logger.info('{}: {} shards planned, {} already completed'.format(disease, len(plan['shards']), len(done)))
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        failed = []
+        with ProcessPoolExecutor(max_workers=cpu) as executor:
+            futures = [(shard, executor.submit(run_shard, summary, disease, plan, shard, out_dir, per_simulation,
+                                               mode)) for shard in pending]
+            for shard, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.warning('shard {} of {} failed (attempt {}): {!r}'.format(shard['shard'], disease,
+                                                                                     attempt + 1, e))
+                    failed.append(shard)
+        pending = failed
+    return [shard['shard'] for shard in pending]
+
+
+def emit_jobs(plan, disease, job_manifest_path, command):
+    """
+    Write a job manifest for a cluster instead of running the shards locally. Each job runs one shard.
+    @param command: command line of the simulate-sharded call, each job appends --only_shard {shard}
+    """
+    jobs = [{'disease': disease,
+             'shard': shard['shard'],
+             'simulations': shard['simulations'],
+             'command': '{} --only_shard {}'.format(command, shard['shard'])} for shard in plan['shards']]
+    with open(job_manifest_path, 'w') as f:
+        json.dump({'entropy': plan['entropy'], 'jobs': jobs}, f, indent=1)
+    return jobs
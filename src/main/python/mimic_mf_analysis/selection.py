@@ -0,0 +1,111 @@
+import logging
+import numpy as np
+import mutual_information.mf as mf
+
+logger = logging.getLogger(__name__)
+
+CRITERIA = ('mrmr', 'cife')
+# variable sources, as in analysis.add_phenotype_columns()
+TEXT, LAB = 'TextHpo', 'LabHpo'
+
+
+class PairTables:
+    """
+    Counts of phenotype pairs with a diagnosis, for the textHpo and labHpo terms of a disease together, from its
+    textHpo * labHpo, textHpo * textHpo and labHpo * labHpo summaries. Variables are numbered textHpo first, then
+    labHpo. Mutual information of pairs is computed for one variable against all others at a time, when selection
+    needs it, so no M x M matrix is built.
+    """
+    def __init__(self, rad_lab, rad_rad, lab_lab):
+        """
+        @param rad_lab, rad_rad, lab_lab: instances of SummaryXYz of the same disease, e.g. values of
+        summaries_diag_rad_lab, summaries_diag_rad_rad and summaries_diag_lab_lab
+        """
+        text, lab = list(rad_lab.vars_labels['set1']), list(rad_lab.vars_labels['set2'])
+        for summary, expected in [(rad_rad, text), (lab_lab, lab)]:
+            if list(summary.vars_labels['set1']) != expected or list(summary.vars_labels['set2']) != expected:
+                raise ValueError('phenotypes of the summaries of {} differ'.format(rad_lab.z_name))
+        self.rad_lab, self.rad_rad, self.lab_lab = rad_lab, rad_rad, lab_lab
+        self.M1, self.M2 = len(text), len(lab)
+        self.labels = [(TEXT, str(label)) for label in text] + [(LAB, str(label)) for label in lab]
+        self.summary_z = np.array([rad_lab.case_N, rad_lab.control_N])
+
+    def relevance(self):
+        """
+        :return: mutual information I(v;z) of every variable with the diagnosis
+        """
+        mutual_info = mf.MutualInfoXYz(self.rad_lab)
+        return np.concatenate([mutual_info.mutual_info_Xz(), mutual_info.mutual_info_Yz()])
+
+    def cells(self, j):
+        """
+        :return: a (M1 + M2) x 8 matrix of counts of every variable (as x) with variable j (as y) and the diagnosis,
+        in the order of SummaryXYz.m2: +++, ++-, +-+, +--, -++, -+-, --+, ---
+        """
+        if j < self.M1:
+            # rad_lab holds the pairs with j as x; swap x and y of the cells
+            lab = np.asarray(self.rad_lab.m2[j, :, :])[:, [0, 1, 4, 5, 2, 3, 6, 7]]
+            return np.concatenate([np.asarray(self.rad_rad.m2[:, j, :]), lab])
+        b = j - self.M1
+        return np.concatenate([np.asarray(self.rad_lab.m2[:, b, :]), np.asarray(self.lab_lab.m2[:, b, :])])
+
+    def redundancy(self, j):
+        """
+        :return: mutual information I(v;j) of every variable v with variable j, and I(v;j|z) given the diagnosis
+        """
+        cells = self.cells(j).astype(float)
+        # with z summed out, the cells of (v, j) are ++, +-, -+, --, so I(v;j) is mf_Xz() with j in place of z
+        positive = cells[0, [0, 1, 4, 5]].sum()
+        pairwise, _, _ = mf.mf_Xz(cells.reshape([len(cells), 4, 2]).sum(axis=-1),
+                                  np.array([positive, self.summary_z.sum() - positive]))
+        return pairwise, conditional_mutual_info(cells)
+
+
+def conditional_mutual_info(cells):
+    """
+    Mutual information I(x;y|z) of pairs given z, from a K x 8 matrix of counts in the order +++, ++-, +-+, +--, -++,
+    -+-, --+, --- of (x, y, z). (mf.mf_XY_given_z() expects an M1 x M2 x 8 tensor with M1, M2 > 1.)
+    """
+    p = cells.reshape([len(cells), 2, 2, 2]) / cells[0].sum()
+    p_xz = p.sum(axis=2, keepdims=True)
+    p_yz = p.sum(axis=1, keepdims=True)
+    p_z = p.sum(axis=(1, 2), keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = p * np.log2(p * p_z / (p_xz * p_yz))
+    return np.where(p > 0, terms, 0).sum(axis=(1, 2, 3))
+
+
+def select(tables, k, criterion='mrmr'):
+    """
+    Greedy forward selection of phenotypes that tell the most about a diagnosis and the least about each other. Each
+    step adds the variable with the best score given the variables selected before:
+        mrmr: I(v;z) - mean over selected s of I(v;s)
+        cife: I(v;z) - sum over selected s of (I(v;s) - I(v;s|z))
+    Scores are updated with the pair information of the last selected variable only, so k steps take O(k * M) mutual
+    information evaluations and no subsets are enumerated.
+    @param tables: an instance of PairTables
+    @param k: number of variables to select
+    @param criterion: 'mrmr' or 'cife'
+    :return: a list of (source, phenotype, score), in the order of selection; source is TextHpo or LabHpo
+    """
+    if criterion not in CRITERIA:
+        raise ValueError('criterion has to be one of {}: {}'.format(', '.join(CRITERIA), criterion))
+    relevance = np.nan_to_num(tables.relevance())
+    penalty = np.zeros_like(relevance)
+    available = np.ones(len(relevance), dtype=bool)
+    selected = []
+    for step in range(min(k, len(relevance))):
+        if step == 0:
+            score = relevance
+        elif criterion == 'mrmr':
+            score = relevance - penalty / step
+        else:
+            score = relevance - penalty
+        # ties go to the variable listed first
+        j = int(np.argmax(np.where(available, score, -np.inf)))
+        selected.append(tables.labels[j] + (float(score[j]),))
+        available[j] = False
+        pairwise, conditional = (np.nan_to_num(values) for values in tables.redundancy(j))
+        penalty = penalty + (pairwise if criterion == 'mrmr' else pairwise - conditional)
+    logger.info('{} selected: {}'.format(criterion, ', '.join(label for _, label, _ in selected)))
+    return selected
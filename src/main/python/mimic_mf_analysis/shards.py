@@ -0,0 +1,195 @@
+import numpy as np
+import os
+import re
+import json
+import hashlib
+import pickle
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# file name patterns of simulation shards: {disease}_{job_id}_distribution.obj|npz and {disease}_{job_id}_counts.obj of
+# simulate, and {disease}_shard{shard}_distribution.obj and {disease}_shard{shard}_counts.obj of the scheduler
+SHARD_PREFIXES = ['', 'shard']
+SHARD_SUFFIXES = {'distribution': ['_distribution.obj', '_distribution.npz'], 'counts': ['_counts.obj']}
+
+ShardReport = namedtuple('ShardReport', ['loaded', 'missing', 'corrupt', 'unlisted'])
+
+
+def manifest_path(dir, disease):
+    return os.path.join(dir, '{}_manifest.jsonl'.format(disease))
+
+
+def checksum(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def shapes(content):
+    """
+    Shape of each array in a shard: a dictionary of arrays or an exceedance counter.
+    """
+    if hasattr(content, 'observed'):
+        content = content.observed
+    return {key: list(np.shape(value)) for key, value in content.items()}
+
+
+def record_shard(dir, disease, job_id, path, kind, seed, simulations, content):
+    """
+    Append a shard to the manifest of a disease. Each simulation job appends one line, so array jobs can record
+    their shards concurrently.
+    @param dir: directory of simulation output
+    @param disease: disease code
+    @param job_id: job id of the shard
+    @param path: path of the shard file
+    @param kind: 'distribution' or 'counts'
+    @param seed: seed of the first simulation in the shard
+    @param simulations: number of simulations in the shard
+    @param content: what was saved in the shard, to record array shapes
+    """
+    record = {'job_id': job_id, 'file': os.path.basename(path), 'kind': kind, 'seed': seed,
+              'simulations': simulations, 'sha256': checksum(path), 'shape': shapes(content)}
+    line = (json.dumps(record) + '\n').encode()
+    # a single write with O_APPEND keeps lines of concurrent writers intact
+    fd = os.open(manifest_path(dir, disease), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def read_manifest(dir, disease):
+    """
+    Return the manifest records of a disease keyed by file name. A shard recorded twice keeps its last record.
+    """
+    records = dict()
+    path = manifest_path(dir, disease)
+    if not os.path.exists(path):
+        return records
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                records[record['file']] = record
+    return records
+
+
+def remove_records(dir, disease, file_names):
+    """
+    Drop the manifest records of shard files, e.g. of shards that were deleted. The manifest is rewritten under a
+    temporary name and replaced, so it should not be called while simulation jobs are still recording shards.
+    """
+    path = manifest_path(dir, disease)
+    if not file_names or not os.path.exists(path):
+        return
+    file_names = set(file_names)
+    with open(path, 'r') as f:
+        lines = [line for line in f if line.strip() and json.loads(line)['file'] not in file_names]
+    with open(path + '.tmp', 'w') as f:
+        f.writelines(lines)
+    os.replace(path + '.tmp', path)
+
+
+def discover(dir, disease, kind='distribution'):
+    """
+    Find shard files of a disease with one directory read, of simulate array jobs and of the scheduler. The disease
+    code has to match exactly, so '03' does not pick up shards of '038'.
+    :return: file names
+    """
+    suffixes = '|'.join(re.escape(suffix) for suffix in SHARD_SUFFIXES[kind])
+    prefixes = '|'.join(re.escape(prefix) for prefix in SHARD_PREFIXES)
+    pattern = re.compile('^{}_({})\\d+({})$'.format(re.escape(disease), prefixes, suffixes))
+    with os.scandir(dir) as entries:
+        return sorted(entry.name for entry in entries if entry.is_file() and pattern.match(entry.name))
+
+
+def _read_shard(path):
+    if path.endswith('.npz'):
+        with np.load(path, allow_pickle=False) as arrays:
+            return dict(arrays)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _load_shard(dir, file_name, record):
+    # returns (file_name, content or None, error message or None)
+    path = os.path.join(dir, file_name)
+    try:
+        if record is not None and checksum(path) != record['sha256']:
+            return file_name, None, 'checksum mismatch'
+        content = _read_shard(path)
+        if record is not None and shapes(content) != record['shape']:
+            return file_name, None, 'shape {} differs from manifest {}'.format(shapes(content), record['shape'])
+        return file_name, content, None
+    except Exception as e:
+        return file_name, None, repr(e)
+
+
+def load_shards(dir, disease, kind='distribution', workers=8):
+    """
+    Load the simulation shards of a disease in parallel, driven by its manifest. Shards that are in the manifest but
+    not on disk are reported as missing; shards that cannot be read or do not match their checksum or shape are
+    reported as corrupt and skipped. Shards on disk without a manifest record (written before manifests existed) are
+    loaded and reported as unlisted.
+    @param dir: directory of simulation output
+    @param disease: disease code
+    @param kind: 'distribution' or 'counts'
+    @param workers: number of threads reading shards
+    :return: a list of shard contents and a ShardReport of file names
+    """
+    records = {file_name: record for file_name, record in read_manifest(dir, disease).items()
+               if record['kind'] == kind}
+    on_disk = discover(dir, disease, kind)
+    missing = sorted(set(records) - set(on_disk))
+    unlisted = sorted(set(on_disk) - set(records))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda file_name: _load_shard(dir, file_name, records.get(file_name)), on_disk))
+
+    contents, loaded, corrupt = [], [], []
+    for file_name, content, error in results:
+        if error is None:
+            contents.append(content)
+            loaded.append(file_name)
+        else:
+            corrupt.append(file_name)
+            logger.warning('corrupt simulation shard {}: {}'.format(os.path.join(dir, file_name), error))
+    for file_name in missing:
+        logger.warning('simulation shard {} is in the manifest but not found'.format(os.path.join(dir, file_name)))
+    if unlisted:
+        logger.warning('{} simulation shards of {} are not in the manifest'.format(len(unlisted), disease))
+    report = ShardReport(loaded, missing, corrupt, unlisted)
+    logger.info('{}: {} shards loaded, {} missing, {} corrupt'.format(disease, len(loaded), len(missing), len(corrupt)))
+    return contents, report
+
+
+def check_complete(report, dir, disease):
+    """
+    Raise an error if shards in the manifest are missing or corrupt, so that p values are not estimated from fewer
+    simulations than were run without notice.
+    """
+    if report.missing or report.corrupt:
+        raise RuntimeError('simulation shards of {} under {}: {} missing, {} corrupt (see the log)'.format(
+            disease, dir, len(report.missing), len(report.corrupt)))
+
+
+def load_distribution(dir, disease_prefix, strict=True):
+    """
+    Collect individual distribution profiles of a disease and concatenate them along the simulation axis.
+    @param strict: raise an error if shards are missing or corrupt, see check_complete(); otherwise use the shards
+    that could be loaded
+    """
+    simulations, report = load_shards(dir, disease_prefix, 'distribution')
+    if strict:
+        check_complete(report, dir, disease_prefix)
+    if len(simulations) == 0:
+        raise RuntimeError('no simulation shards found for {} under {}'.format(disease_prefix, dir))
+
+    empirical_distributions = dict()
+    for key in simulations[0]:
+        empirical_distributions[key] = np.concatenate([res[key] for res in simulations], axis=-1)
+    return empirical_distributions
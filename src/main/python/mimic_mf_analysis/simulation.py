@@ -0,0 +1,347 @@
+import numpy as np
+import multiprocessing
+import functools
+import os
+import logging
+import statistics
+import mutual_information.mf as mf
+from mutual_information.mf_random import synergy_random
+import mimic_mf_analysis.shards as shards
+from mimic_mf_analysis.dedup import synergy_random_dedup
+
+logger = logging.getLogger(__name__)
+
+# statistics returned by mutual_information.mf_random.synergy_random, in the
+# same order as MutualInfoRandomizer.p_values()
+STATISTICS = ['mf_XY_omit_z', 'mf_Xz', 'mf_Yz', 'mf_XY_z', 'mf_XY_given_z', 'synergy']
+
+
+def observed_statistics(summary):
+    """
+    Compute the observed values of the statistics that are simulated.
+    @param summary: an instance of SummaryXYz
+    :return: a dictionary from statistic name to an array (M1, M2 or M1 x M2)
+    """
+    mutualInfo_XYz = mf.MutualInfoXYz(summary)
+    observed = dict()
+    observed['mf_XY_omit_z'] = mutualInfo_XYz.mutual_info_XY_omit_z()
+    observed['mf_Xz'] = mutualInfo_XYz.mutual_info_Xz()
+    observed['mf_Yz'] = mutualInfo_XYz.mutual_info_Yz()
+    observed['mf_XY_z'] = mutualInfo_XYz.mutual_info_XY_z()
+    observed['mf_XY_given_z'] = mutualInfo_XYz.mutual_info_XY_given_z()
+    observed['synergy'] = mutualInfo_XYz.synergy_XY2z()
+    return observed
+
+
+def null_parameters(summary):
+    """
+    Prevalence of the diagnosis and of the phenotypes that simulations draw from. This is the same null model as
+    MutualInfoRandomizer.simulate(), so counts and full empirical distributions summarize the same simulations; only
+    the two-sided p values are defined differently (see ExceedanceCounter.p_values).
+    @param summary: an instance of SummaryXYz
+    :return: diagnosis prevalence, phenotype prevalence of set1, phenotype prevalence of set2, total encounters
+    """
+    TOTAL = summary.case_N + summary.control_N
+    diag_prob = summary.case_N / TOTAL
+    phenotype_prob1 = np.sum(summary.m1['set1'][:, 0:1], axis=1) / TOTAL
+    phenotype_prob2 = np.sum(summary.m1['set2'][:, 0:1], axis=1) / TOTAL
+    return diag_prob, phenotype_prob1, phenotype_prob2, TOTAL
+
+
+class ExceedanceCounter:
+    """
+    Running per-pair counts of simulated statistics against the observed ones. Instead of keeping every simulated
+    value (M1 x M2 x n_sims per statistic), the counter keeps how many simulations were at least as large (ge) or
+    at most as large (le) as the observed value, so memory does not grow with the number of simulations.
+    Optionally, a fixed-size reservoir of simulated values is kept for each pair (Algorithm R).
+    Counters from different jobs are combined with merge().
+    """
+    def __init__(self, observed, reservoir_size=0, seed=None):
+        """
+        @param observed: a dictionary from statistic name to observed values, see observed_statistics()
+        @param reservoir_size: number of simulated values to keep for each pair and statistic. 0 to disable.
+        @param seed: seed for the reservoir sampling
+        """
+        self.observed = {key: np.asarray(value) for key, value in observed.items()}
+        self.reservoir_size = reservoir_size
+        self.rng = np.random.default_rng(seed)
+        # number of simulations seen by each pair
+        self.n = {key: np.zeros(value.shape, dtype=np.int64) for key, value in self.observed.items()}
+        # number of simulations >= observed value
+        self.ge = {key: np.zeros(value.shape, dtype=np.int64) for key, value in self.observed.items()}
+        # number of simulations <= observed value
+        self.le = {key: np.zeros(value.shape, dtype=np.int64) for key, value in self.observed.items()}
+        # first and second moments of the simulated values
+        self.sum = {key: np.zeros(value.shape) for key, value in self.observed.items()}
+        self.sum_sq = {key: np.zeros(value.shape) for key, value in self.observed.items()}
+        self.reservoir = {key: np.zeros(value.shape + (reservoir_size,)) for key, value in self.observed.items()}
+
+    def add(self, simulation, mask=None):
+        """
+        Add one simulation.
+        @param simulation: a dictionary from statistic name to simulated values, e.g. output of synergy_random()
+        @param mask: optional dictionary from statistic name to a boolean array. Only pairs set to True are updated.
+        """
+        for key, observed in self.observed.items():
+            simulated = np.asarray(simulation[key])
+            if mask is None:
+                update = np.ones(observed.shape, dtype=bool)
+            else:
+                update = mask[key]
+            self.ge[key] += (simulated >= observed) & update
+            self.le[key] += (simulated <= observed) & update
+            self.sum[key] += np.where(update, simulated, 0)
+            self.sum_sq[key] += np.where(update, simulated ** 2, 0)
+            if self.reservoir_size > 0:
+                self._sample(key, simulated, update)
+            self.n[key] += update
+
+    def _sample(self, key, simulated, update):
+        # Algorithm R, vectorized over pairs: the i-th value seen by a pair takes a random slot with
+        # probability reservoir_size / (i + 1)
+        seen = self.n[key]
+        slot = np.where(seen < self.reservoir_size, seen,
+                        np.floor(self.rng.random(seen.shape) * (seen + 1)).astype(np.int64))
+        replace = update & (slot < self.reservoir_size)
+        index = np.nonzero(replace)
+        self.reservoir[key][index + (slot[index],)] = simulated[index]
+
+    def merge(self, other):
+        """
+        Add the counts of another counter built for the same observed statistics, e.g. from another simulation job.
+        @param other: an instance of ExceedanceCounter
+        :return: self
+        """
+        for key in self.observed:
+            if self.observed[key].shape != other.observed[key].shape or \
+                    not np.allclose(self.observed[key], other.observed[key], equal_nan=True):
+                raise ValueError('cannot merge counters of different observed statistics: {}'.format(key))
+            if self.reservoir_size > 0:
+                self.reservoir[key] = self._merge_reservoir(self.n[key], self.reservoir[key],
+                                                            other.n[key], other.reservoir[key])
+            self.n[key] += other.n[key]
+            self.ge[key] += other.ge[key]
+            self.le[key] += other.le[key]
+            self.sum[key] += other.sum[key]
+            self.sum_sq[key] += other.sum_sq[key]
+        return self
+
+    def _merge_reservoir(self, n_a, reservoir_a, n_b, reservoir_b):
+        # a uniform sample of the union takes a hypergeometric number of values from each side
+        k = self.reservoir_size
+        if reservoir_b.shape[-1] != k:
+            raise ValueError('cannot merge reservoirs of different sizes')
+        size = np.minimum(n_a + n_b, k)
+        # pairs without any simulation on either side draw nothing
+        from_a = self.rng.hypergeometric(n_a, n_b + (size == 0), np.maximum(size, 1)) * (size > 0)
+        # shuffle the filled slots of both reservoirs, then take from_a values of a and the rest from b
+        shuffled_a = np.take_along_axis(reservoir_a, self._shuffle_filled(n_a), axis=-1)
+        shuffled_b = np.take_along_axis(reservoir_b, self._shuffle_filled(n_b), axis=-1)
+        position = np.arange(k)
+        take_a = position < from_a[..., np.newaxis]
+        index_b = np.clip(position - from_a[..., np.newaxis], 0, k - 1)
+        merged = np.where(take_a, shuffled_a, np.take_along_axis(shuffled_b, index_b, axis=-1))
+        return np.where(position < size[..., np.newaxis], merged, 0)
+
+    def _shuffle_filled(self, n):
+        # random order of the filled slots first, empty slots last
+        filled = np.arange(self.reservoir_size) < np.minimum(n, self.reservoir_size)[..., np.newaxis]
+        keys = self.rng.random(filled.shape) + np.where(filled, 0, 2)
+        return np.argsort(keys, axis=-1)
+
+    def mean(self):
+        """
+        :return: a dictionary from statistic name to the mean of simulated values
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return {key: self.sum[key] / self.n[key] for key in self.observed}
+
+    def reservoir_samples(self, key):
+        """
+        Return the reservoir of a statistic. Slots beyond the number of simulations seen by a pair are NaN.
+        """
+        filled = np.arange(self.reservoir_size) < np.minimum(self.n[key], self.reservoir_size)[..., np.newaxis]
+        return np.where(filled, self.reservoir[key], np.nan)
+
+    def p_values(self, alternative='two.sided'):
+        """
+        Estimate p values from the counts. One-sided p values are the same as p_value_estimate() of
+        mutual_information.mf_random on the full distribution. The two-sided p value is twice the smaller tail, while
+        p_value_estimate() reflects the observed value around the mean of the simulations; that needs every simulated
+        value, as the mean is only known at the end. The two agree for symmetric null distributions, but not for
+        skewed ones such as those of mutual information, so p values of counts and distribution mode can differ.
+        @param alternative: 'two.sided', 'left' or 'right'
+        :return: a dictionary from statistic name to p values. Pairs without any simulation are NaN.
+        """
+        p = dict()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for key in self.observed:
+                n = self.n[key]
+                if alternative == 'two.sided':
+                    p[key] = np.minimum(2 * np.minimum(self.ge[key], self.le[key]) / n, 1)
+                elif alternative == 'left':
+                    p[key] = self.le[key] / n
+                elif alternative == 'right':
+                    p[key] = self.ge[key] / n
+                else:
+                    raise ValueError
+        return p
+
+
+def simulator(use_dedup=False):
+    """
+    Function that runs one simulation: synergy_random, or synergy_random_dedup that counts unique profiles.
+    """
+    return synergy_random_dedup if use_dedup else synergy_random
+
+
+def simulate_counts(summary, per_simulation=None, simulations=100, cpu=None, job_id=0, reservoir_size=0, dedup=False):
+    """
+    Run simulations like MutualInfoRandomizer.simulate(), but fold each one into an ExceedanceCounter as soon as it
+    finishes instead of stacking all of them. Seeds are the same as MutualInfoRandomizer.simulate().
+    @param summary: an instance of SummaryXYz, the observed summary statistics
+    @param per_simulation: number of encounters per simulation. Default to observed encounters.
+    @param simulations: number of simulations
+    @param cpu: number of processes
+    @param job_id: job id, used to derive seeds
+    @param reservoir_size: number of simulated values to keep per pair and statistic
+    @param dedup: count each simulated sample as unique profiles with multiplicities (see synergy_random_dedup)
+    :return: an instance of ExceedanceCounter
+    """
+    diag_prob, phenotype_prob1, phenotype_prob2, TOTAL = null_parameters(summary)
+    if per_simulation is None:
+        per_simulation = TOTAL
+    if cpu is None:
+        cpu = os.cpu_count()
+    counter = ExceedanceCounter(observed_statistics(summary), reservoir_size=reservoir_size, seed=job_id)
+    simulate_one = functools.partial(simulator(dedup), diag_prob, phenotype_prob1, phenotype_prob2, per_simulation)
+    seeds = [int(i + job_id * simulations) for i in np.arange(simulations)]
+    logger.info('number of workers created: {}'.format(cpu))
+    with multiprocessing.Pool(cpu) as workers:
+        for simulation in workers.imap_unordered(simulate_one, seeds):
+            counter.add(simulation)
+    return counter
+
+
+def wilson_interval(k, n, confidence=0.99):
+    """
+    Wilson score interval of a binomial proportion, vectorized.
+    @param k: number of successes
+    @param n: number of trials
+    @param confidence: confidence level
+    :return: lower and upper bounds
+    """
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p = k / n
+        center = (p + z ** 2 / (2 * n)) / (1 + z ** 2 / n)
+        half_width = z * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / (1 + z ** 2 / n)
+    return np.where(n > 0, center - half_width, 0), np.where(n > 0, center + half_width, 1)
+
+
+def simulate_sequential(summary, per_simulation=None, max_simulations=10000, batch_size=100, cpu=None, job_id=0,
+                        statistic='synergy', alpha=0.05, stop_after=10, confidence=0.99, reservoir_size=0,
+                        dedup=False):
+    """
+    Sequential Monte Carlo p values. Simulations are drawn in rounds of batch_size and each round only simulates the
+    phenotypes that still have undecided pairs. A pair stops receiving simulations when
+    1) it has seen stop_after simulations at least as extreme as the observed value (Besag & Clifford, 1991), so its
+    p value is clearly not small,
+    2) the confidence interval of its p value no longer contains alpha, or
+    3) it has seen max_simulations simulations.
+    Most pairs are clearly non-significant after a few hundred simulations and stop early by rule 1.
+    @param summary: an instance of SummaryXYz, the observed summary statistics
+    @param per_simulation: number of encounters per simulation. Default to observed encounters.
+    @param max_simulations: maximum number of simulations for any pair
+    @param batch_size: number of simulations per round
+    @param cpu: number of processes
+    @param job_id: job id, used to derive seeds
+    @param statistic: the pairwise statistic that decides when to stop, one of mf_XY_omit_z, mf_XY_z,
+    mf_XY_given_z and synergy. All statistics are counted for the pairs that are still simulated.
+    @param alpha: significance threshold
+    @param stop_after: Besag-Clifford h, number of extreme simulations after which a pair stops
+    @param confidence: confidence level of the p value interval compared against alpha
+    @param reservoir_size: number of simulated values to keep per pair and statistic
+    @param dedup: count each simulated sample as unique profiles with multiplicities (see synergy_random_dedup)
+    :return: an instance of ExceedanceCounter; counter.n[statistic] is the number of simulations of each pair
+    """
+    if statistic not in ['mf_XY_omit_z', 'mf_XY_z', 'mf_XY_given_z', 'synergy']:
+        raise ValueError('{} is not a pairwise statistic'.format(statistic))
+    diag_prob, phenotype_prob1, phenotype_prob2, TOTAL = null_parameters(summary)
+    if per_simulation is None:
+        per_simulation = TOTAL
+    if cpu is None:
+        cpu = os.cpu_count()
+    observed = observed_statistics(summary)
+    counter = ExceedanceCounter(observed, reservoir_size=reservoir_size, seed=job_id)
+    M1, M2 = observed[statistic].shape
+    active = np.ones([M1, M2], dtype=bool)
+    drawn = 0
+    # cost in units of simulated phenotype pairs
+    cost = 0
+    with multiprocessing.Pool(cpu) as workers:
+        while active.any() and drawn < max_simulations:
+            rows = _at_least_two(np.any(active, axis=1))
+            cols = _at_least_two(np.any(active, axis=0))
+            n_round = min(batch_size, max_simulations - drawn)
+            simulate_one = functools.partial(simulator(dedup), diag_prob, phenotype_prob1[rows],
+                                             phenotype_prob2[cols], per_simulation)
+            seeds = [int(drawn + i + job_id * max_simulations) for i in np.arange(n_round)]
+            mask = {key: active for key in observed}
+            mask['mf_Xz'] = rows
+            mask['mf_Yz'] = cols
+            for sub_simulation in workers.imap_unordered(simulate_one, seeds):
+                counter.add(_embed(sub_simulation, rows, cols, observed), mask=mask)
+            drawn += n_round
+            cost += n_round * np.sum(rows) * np.sum(cols)
+
+            n = counter.n[statistic]
+            extreme = np.minimum(counter.ge[statistic], counter.le[statistic])
+            lower, upper = wilson_interval(extreme, n, confidence)
+            # two-sided p value is twice the smaller tail
+            decided = (extreme >= stop_after) | (2 * upper < alpha) | (2 * lower > alpha)
+            active = active & ~decided
+            logger.info('{} simulations drawn, {} of {} pairs still undecided'.format(drawn, np.sum(active), M1 * M2))
+
+    logger.info('sequential simulation used {:.1%} of the compute of {} simulations for every pair'.format(
+        cost / (max_simulations * M1 * M2), max_simulations))
+    return counter
+
+
+def _at_least_two(selected):
+    # mutual_information squeezes its count arrays, so a simulation needs two or more phenotypes per set
+    selected = selected.copy()
+    for i in np.nonzero(~selected)[0][:max(2 - np.sum(selected), 0)]:
+        selected[i] = True
+    return selected
+
+
+def _embed(sub_simulation, rows, cols, observed):
+    # place statistics simulated for a subset of phenotypes into full size arrays
+    simulation = dict()
+    for key, value in observed.items():
+        simulation[key] = np.zeros(value.shape)
+    for key in sub_simulation:
+        if key == 'mf_Xz':
+            simulation[key][rows] = sub_simulation[key]
+        elif key == 'mf_Yz':
+            simulation[key][cols] = sub_simulation[key]
+        else:
+            simulation[key][np.ix_(rows, cols)] = sub_simulation[key]
+    return simulation
+
+
+def load_counts(dir, disease_prefix, strict=True):
+    """
+    Collect individual exceedance counters of a disease and merge them into one.
+    @param strict: raise an error if shards are missing or corrupt (see shards.check_complete)
+    """
+    counters, report = shards.load_shards(dir, disease_prefix, 'counts')
+    if strict:
+        shards.check_complete(report, dir, disease_prefix)
+    if len(counters) == 0:
+        raise RuntimeError('no simulation counts found for {} under {}'.format(disease_prefix, dir))
+    counter = counters[0]
+    for shard in counters[1:]:
+        counter.merge(shard)
+    return counter
@@ -0,0 +1,162 @@
+import numpy as np
+from scipy import sparse
+import mutual_information.mf as mf
+import mimic_mf_analysis.encoding as encoding
+
+
+class SparseSummaryXYz:
+    """
+    Sparse counterpart of mf.SummaryXYz for large phenotype panels. Instead of a dense M1 x M2 x 8 count tensor, it
+    accumulates two sparse M1 x M2 matrices, the number of encounters with both phenotypes (n_xy) and the number of
+    those that also have the diagnosis (n_xyz). Together with the per-phenotype counts in m1 (dense, M x 4 as in
+    SummaryXYz) and case_N/control_N, they determine all 8 cells of a pair. Phenotype profiles are sparse, so the
+    co-occurrence matrices only hold pairs that occur together at least once, and prune() keeps pairs with a minimum
+    support.
+    """
+    def __init__(self, X_names, Y_names, z_name):
+        self.vars_labels = {'set1': np.array(X_names),
+                            'set2': np.array(Y_names)}
+        self.z_name = z_name
+        self.M1 = len(X_names)
+        self.M2 = len(Y_names)
+        # columns: ++, +-, -+, -- of phenotype * diagnosis, as in SummaryXYz
+        self.m1 = {'set1': np.zeros([self.M1, 4], dtype=np.int64),
+                   'set2': np.zeros([self.M2, 4], dtype=np.int64)}
+        self.n_xy = sparse.csr_matrix((self.M1, self.M2), dtype=np.int64)
+        self.n_xyz = sparse.csr_matrix((self.M1, self.M2), dtype=np.int64)
+        self.case_N = 0
+        self.control_N = 0
+        self.min_support = 0
+
+    def add_batch(self, P1, P2, d):
+        """
+        Add a batch of encounters.
+        @param P1: a batch_size x M1 binary matrix of phenotypes in X, dense or scipy sparse
+        @param P2: a batch_size x M2 binary matrix of phenotypes in Y, dense or scipy sparse
+        @param d: a batch_size vector of diagnosis values (0 or 1)
+        """
+        P1 = sparse.csr_matrix(P1, dtype=np.int64)
+        P2 = sparse.csr_matrix(P2, dtype=np.int64)
+        d = np.asarray(d, dtype=np.int64).ravel()
+        case_N = int(d.sum())
+        control_N = len(d) - case_N
+
+        self.n_xy = self.n_xy + P1.T @ P2
+        self.n_xyz = self.n_xyz + P1.T @ sparse.diags(d, dtype=np.int64) @ P2
+        for key, P in [('set1', P1), ('set2', P2)]:
+            positive = np.asarray(P.sum(axis=0)).ravel()
+            positive_case = P.T @ d
+            self.m1[key] += np.stack([positive_case,
+                                      positive - positive_case,
+                                      case_N - positive_case,
+                                      control_N - positive + positive_case], axis=1)
+        self.case_N += case_N
+        self.control_N += control_N
+
+    def prune(self, min_support):
+        """
+        Drop pairs that co-occur in fewer than min_support encounters.
+        """
+        if min_support > 1:
+            keep = self.n_xy >= min_support
+            self.n_xy = self.n_xy.multiply(keep).astype(np.int64).tocsr()
+            self.n_xyz = self.n_xyz.multiply(keep).astype(np.int64).tocsr()
+        self.n_xy.eliminate_zeros()
+        self.min_support = max(self.min_support, min_support)
+
+    def pairs(self):
+        """
+        Indices of the stored pairs and their co-occurrence counts.
+        :return: rows (index in X), cols (index in Y), n_xy and n_xyz, as vectors of the same length
+        """
+        n_xy = self.n_xy.tocoo()
+        rows, cols = n_xy.row, n_xy.col
+        n_xyz = np.asarray(self.n_xyz[rows, cols]).ravel()
+        return rows, cols, n_xy.data, n_xyz
+
+    def m2(self):
+        """
+        The 8 cells of each stored pair, rebuilt from co-occurrence counts and per-phenotype counts.
+        :return: rows, cols and a K x 8 matrix of counts in the order of SummaryXYz.m2: +++, ++-, +-+, +--, -++, -+-,
+        --+, ---
+        """
+        rows, cols, n_xy, n_xyz = self.pairs()
+        x_case, x_control = self.m1['set1'][rows, 0], self.m1['set1'][rows, 1]
+        y_case, y_control = self.m1['set2'][cols, 0], self.m1['set2'][cols, 1]
+        n_xy_control = n_xy - n_xyz
+        cells = np.stack([n_xyz,
+                          n_xy_control,
+                          x_case - n_xyz,
+                          x_control - n_xy_control,
+                          y_case - n_xyz,
+                          y_control - n_xy_control,
+                          self.case_N - x_case - y_case + n_xyz,
+                          self.control_N - x_control - y_control + n_xy_control], axis=1)
+        return rows, cols, cells
+
+    def mutual_info(self):
+        """
+        Mutual information and synergy of the stored pairs.
+        :return: rows, cols and a dictionary of vectors aligned with them: mf_Xz, mf_Yz, mf_XY_z and synergy
+        """
+        rows, cols, cells = self.m2()
+        summary_z = np.array([self.case_N, self.control_N])
+        mf_Xz = mf.mf_Xz(self.m1['set1'], summary_z)[0][rows]
+        mf_Yz = mf.mf_Xz(self.m1['set2'], summary_z)[0][cols]
+        # mf_XY_z works on M1 x M2 x 8 tensors, so the pairs are laid out as a K x 1 tensor
+        mf_XY_z = mf.mf_XY_z(cells.reshape([-1, 1, 8]), summary_z).ravel()
+        return rows, cols, {'mf_Xz': mf_Xz,
+                            'mf_Yz': mf_Yz,
+                            'mf_XY_z': mf_XY_z,
+                            'synergy': mf_XY_z - mf_Xz - mf_Yz}
+
+    def to_arrays(self):
+        """
+        Split into arrays, labels and scalar attributes for a result store (see result_store.summary_to_arrays).
+        """
+        rows, cols, n_xy, n_xyz = self.pairs()
+        arrays = {'m1_set1': self.m1['set1'], 'm1_set2': self.m1['set2'],
+                  'rows': rows.astype(np.int32), 'cols': cols.astype(np.int32),
+                  'n_xy': n_xy, 'n_xyz': n_xyz}
+        attrs = {'z_name': str(self.z_name), 'case_N': int(self.case_N), 'control_N': int(self.control_N),
+                 'min_support': int(self.min_support)}
+        return arrays, self.vars_labels, attrs
+
+    @classmethod
+    def from_arrays(cls, arrays, labels, attrs):
+        summary = cls(labels['set1'], labels['set2'], attrs['z_name'])
+        summary.m1 = {'set1': np.asarray(arrays['m1_set1']), 'set2': np.asarray(arrays['m1_set2'])}
+        shape = (summary.M1, summary.M2)
+        summary.n_xy = sparse.csr_matrix((arrays['n_xy'], (arrays['rows'], arrays['cols'])), shape=shape)
+        summary.n_xyz = sparse.csr_matrix((arrays['n_xyz'], (arrays['rows'], arrays['cols'])), shape=shape)
+        summary.case_N = attrs['case_N']
+        summary.control_N = attrs['control_N']
+        summary.min_support = attrs['min_support']
+        return summary
+
+
+def positive_matrix(row_ids, phenotypes, start_index, end_index, phenotype_index, n_columns=None):
+    """
+    Build a sparse encounter x phenotype matrix from positive calls only, e.g. the rows of a profile table.
+    @param row_ids: ROW_ID of the encounter of each positive call
+    @param phenotypes: phenotype of each positive call
+    @param start_index: smallest ROW_ID of the batch, maps to row 0
+    @param end_index: largest ROW_ID of the batch
+    @param phenotype_index: a dictionary from phenotype to column index, or, for phenotypes given as integer codes, a
+    lookup vector from code to column index (see encoding.column_index). Calls of other phenotypes are dropped.
+    @param n_columns: number of columns, the size of the panel; default to len(phenotype_index) for a dictionary
+    :return: a (end_index - start_index + 1) x n_columns sparse matrix
+    """
+    if isinstance(phenotype_index, dict):
+        columns = np.array([phenotype_index.get(phenotype, -1) for phenotype in phenotypes], dtype=np.int64)
+        n_columns = len(phenotype_index) if n_columns is None else n_columns
+    else:
+        columns = encoding.columns_of(phenotype_index, phenotypes)
+        n_columns = int(phenotype_index.max()) + 1 if n_columns is None else n_columns
+    rows = np.asarray(row_ids, dtype=np.int64) - start_index
+    keep = columns >= 0
+    shape = (end_index - start_index + 1, n_columns)
+    matrix = sparse.csr_matrix((np.ones(np.sum(keep), dtype=np.int64), (rows[keep], columns[keep])), shape=shape)
+    # a phenotype called twice for an encounter is still one positive
+    matrix.data[:] = 1
+    return matrix
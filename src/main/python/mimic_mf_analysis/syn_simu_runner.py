@@ -2,6 +2,8 @@ import pickle
 import argparse
 import os.path
 from mutual_information.mf_random import MutualInfoRandomizer
+import mimic_mf_analysis.estimation as estimation
+import mimic_mf_analysis.shards as shards
 import logging.config
 import numpy as np
 
@@ -51,7 +53,9 @@ def main():
                                  action='store', dest='out_dir')
     estimate_parser.add_argument('-disease', help='specify if only to analyze such disease',
                                  default=[], dest='disease_of_interest',
-                                 type=str)
+                                 type=str, nargs='*')
+    estimate_parser.add_argument('-cpu', help='number of diseases to estimate in parallel',
+                                 default=None, type=int, dest='cpu')
     estimate_parser.set_defaults(func=estimate)
 
     args = parser.parse_args()
@@ -101,6 +105,10 @@ def simulate(args):
                                               '_distribution.obj')
         with open(distribution_file_path, 'wb') as f2:
             pickle.dump(randmizer.empirical_distribution, file=f2, protocol=2)
+        if job_id is not None:
+            shards.record_shard(dir, disease, job_id, distribution_file_path,
+                                'distribution', job_id * simulations,
+                                simulations, randmizer.empirical_distribution)
 
         if verbose:
             print('saved current batch of simulations {} for {}'.format(
@@ -112,6 +120,7 @@ def estimate(args):
     dist_path = args.dist_path
     out_path = args.out_dir
     disease_of_interest = args.disease_of_interest
+    cpu = args.cpu
 
     print(args)
     with open(input_path, 'rb') as in_file:
@@ -119,59 +128,21 @@ def estimate(args):
         logger.info('number of diseases to run simulations for {}'.format(
             len(mf_map)))
 
-    for disease, summary_statistics in mf_map.items():
-        if disease_of_interest is not None and \
-                        disease not in disease_of_interest:
-            continue
-        randmizer = MutualInfoRandomizer(summary_statistics)
-        empirical_distribution = load_distribution(dist_path, disease)
-        # serialize_empirical_distributions(empirical_distribution['synergy'],
-        #      os.path.join(out_path, disease +
-        #                   '_empirical_distribution_subset.obj'))
-        randmizer.empirical_distribution = empirical_distribution
-        p = randmizer.p_values()
+    diseases = [disease for disease in mf_map.keys() if
+                not disease_of_interest or disease in disease_of_interest]
+    # diseases are estimated in parallel; collect the p values of every
+    # disease instead of only the last one
+    p = dict()
+    for disease, p_disease in estimation.estimate_diseases(
+            mf_map, diseases, dist_path, 'distribution',
+            shards.load_distribution, cpu):
+        p[disease] = p_disease
 
     with open(out_path, 'wb') as f:
         pickle.dump(p, f, protocol=2)
     return p
 
 
-def load_distribution(dir, disease_prefix):
-    """
-    Collect individual distribution profiles
-    :param dir:
-    :param disease:
-    :return:
-    """
-    simulations = []
-    for i in np.arange(5000):
-        path = os.path.join(dir, disease_prefix + '_' + str(i) +
-                            '_distribution.obj')
-        if os.path.exists(path):
-            with open(path, 'rb') as f:
-                try:
-                    simulation = pickle.load(f)
-                    simulations.append(simulation)
-                except:
-                    pass
-
-    empirical_distributions = dict()
-    empirical_distributions['mf_XY_omit_z'] = \
-        np.concatenate([res['mf_XY_omit_z'] for res in simulations], axis=-1)
-    empirical_distributions['mf_Xz'] = \
-        np.concatenate([res['mf_Xz'] for res in simulations], axis=-1)
-    empirical_distributions['mf_Yz'] = \
-        np.concatenate([res['mf_Yz'] for res in simulations], axis=-1)
-    empirical_distributions['mf_XY_z'] = \
-        np.concatenate([res['mf_XY_z'] for res in simulations], axis=-1)
-    empirical_distributions['mf_XY_given_z'] = \
-        np.concatenate([res['mf_XY_given_z'] for res in simulations], axis=-1)
-    empirical_distributions['synergy'] = \
-        np.concatenate([res['synergy'] for res in simulations], axis=-1)
-
-    return empirical_distributions
-
-
 def serialize_empirical_distributions(distribution, path):
     M1 = distribution.shape[0]
     M2 = distribution.shape[1]
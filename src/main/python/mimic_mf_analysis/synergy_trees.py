@@ -0,0 +1,178 @@
+import os
+import json
+import multiprocessing
+import logging
+import numpy as np
+import mutual_information.mf as mf
+from mutual_information import synergy_tree
+from mutual_information.synergy_tree import SynergyTree
+import mimic_mf_analysis.selection as selection
+
+logger = logging.getLogger(__name__)
+
+
+def top_phenotypes(summary, k_text, k_lab):
+    """
+    Select the phenotypes that tell the most about a disease: the k_text textHpo and k_lab labHpo terms with the
+    largest mutual information I(x;z) with the diagnosis, from the precomputed summary of the disease.
+    @param summary: an instance of SummaryXYz with textHpo terms in set1 and labHpo terms in set2, e.g. a value of
+    summaries_diag_rad_lab
+    :return: two lists of phenotypes, textHpo and labHpo, by decreasing mutual information
+    """
+    mutual_info = mf.MutualInfoXYz(summary)
+    selected = []
+    for values, labels, k in [(mutual_info.mutual_info_Xz(), summary.vars_labels['set1'], k_text),
+                              (mutual_info.mutual_info_Yz(), summary.vars_labels['set2'], k_lab)]:
+        values = np.nan_to_num(np.asarray(values, dtype=float), nan=-np.inf)
+        # stable, so ties keep the order of the summary
+        order = np.argsort(-values, kind='stable')[:k]
+        selected.append([str(labels[i]) for i in order])
+    return selected[0], selected[1]
+
+
+def select_phenotypes(diagnosis, summaries, k_text, k_lab, criterion=None, rad_rad=None, lab_lab=None):
+    """
+    Select the phenotypes of a disease, either the top ones by mutual information with it (see top_phenotypes) or, with
+    a criterion of selection.select(), k_text + k_lab phenotypes of either kind by greedy forward selection, which
+    also needs the textHpo * textHpo and labHpo * labHpo summaries.
+    :return: two lists of phenotypes, textHpo and labHpo
+    """
+    if criterion is None:
+        return top_phenotypes(summaries[diagnosis], k_text, k_lab)
+    tables = selection.PairTables(summaries[diagnosis], rad_rad[diagnosis], lab_lab[diagnosis])
+    selected = selection.select(tables, k_text + k_lab, criterion)
+    return [hpo for source, hpo, _ in selected if source == selection.TEXT], \
+        [hpo for source, hpo, _ in selected if source == selection.LAB]
+
+
+def profile_counts(diagnosis, textHpos, labHpos, primary_diagnosis_only, textHpo_occurrance_min,
+                   labHpo_occurrance_min):
+    """
+    Count the encounters of every combination of the selected phenotypes and the diagnosis, using the variable table
+    Jax_multivariant_synergy_table. Call after analysis.initTables().
+    :return: the variable dictionary of analysis.add_phenotype_columns() and a data frame with one column per
+    variable, DIAGNOSIS and N
+    """
+    from mimic_mf_analysis import db
+    import mimic_mf_analysis.analysis as analysis
+
+    db.drop_temp_table('Jax_multivariant_synergy_table')
+    analysis.add_diag_columns(diagnosis, primary_diagnosis_only)
+    var_dict = analysis.add_phenotype_columns(labHpos=labHpos, textHpos=textHpos,
+                                              labHpo_threshold_min=labHpo_occurrance_min,
+                                              textHpo_threshold_min=textHpo_occurrance_min)
+    columns = ', '.join(list(var_dict) + ['DIAGNOSIS'])
+    counts = db.read_sql('SELECT {}, COUNT(*) AS N FROM Jax_multivariant_synergy_table GROUP BY {}'.format(
+        columns, columns))
+    counts['DIAGNOSIS'] = counts.DIAGNOSIS.astype(int)
+    return var_dict, counts
+
+
+def subset_mf(counts, variables):
+    """
+    Mutual information between the joint distribution of variables and the diagnosis, as analysis.precompute_mf(),
+    from the encounter counts of profile_counts() instead of a query per subset.
+    """
+    summary_counts = counts.groupby(list(variables) + ['DIAGNOSIS'], as_index=False).N.sum()
+    total = summary_counts.N.sum()
+    p = summary_counts.N / total
+    p_V = summary_counts.groupby(list(variables)).N.transform('sum') / total
+    p_D = summary_counts.groupby('DIAGNOSIS').N.transform('sum') / total
+    return float(np.sum(p * np.log2(p / (p_V * p_D))))
+
+
+def tree_to_dict(tree, node_id, var_dict, mf_dict):
+    """
+    Serialize a synergy tree (a treelib.Tree) from a node down, with the phenotypes of each node, the mutual information
+    of their joint distribution with the diagnosis and their synergy (None for single phenotypes).
+    """
+    node = tree.get_node(node_id)
+    return {'variables': list(node_id),
+            'phenotypes': [{'source': var_dict[var][0], 'hpo': var_dict[var][1]} for var in node_id],
+            'mutual_information': mf_dict[node_id],
+            'synergy': None if node.data is None else float(node.data),
+            'children': [tree_to_dict(tree, child.identifier, var_dict, mf_dict)
+                         for child in sorted(tree.children(node_id), key=lambda child: child.identifier)]}
+
+
+def build_tree(diagnosis, var_dict, counts):
+    """
+    Build the synergy tree of a disease from the encounter counts of its selected phenotypes.
+    :return: the serialized tree, see tree_to_dict()
+    """
+    var_ids = sorted(var_dict)
+    mf_dict = {subset: subset_mf(counts, subset) for subset in synergy_tree.subsets(var_ids, include_self=True)}
+    tree = SynergyTree(var_ids, var_dict, mf_dict).synergy_tree()
+    return {'disease': diagnosis, 'encounters': int(counts.N.sum()),
+            'cases': int(counts.N[counts.DIAGNOSIS == 1].sum()),
+            'tree': tree_to_dict(tree, tree.root, var_dict, mf_dict)}
+
+
+def _build_one(task):
+    diagnosis, var_dict, counts = task
+    logger.info('start building the synergy tree of {} with {} phenotypes'.format(diagnosis, len(var_dict)))
+    return diagnosis, build_tree(diagnosis, var_dict, counts)
+
+
+def _finished(pending, wait=False):
+    # yield the trees that are built and remove them from pending; with wait, wait for at least one
+    if wait:
+        pending[0][1].wait()
+    for diagnosis, result in [(diagnosis, result) for diagnosis, result in pending if result.ready()]:
+        pending.remove((diagnosis, result))
+        try:
+            _, tree = result.get()
+        except Exception as e:
+            logger.error('failed to build the synergy tree of {}: {!r}'.format(diagnosis, e))
+            continue
+        logger.info('synergy tree of {} built'.format(diagnosis))
+        yield diagnosis, tree
+
+
+def build_trees(summaries, diseases, k_text, k_lab, primary_diagnosis_only, textHpo_occurrance_min,
+                labHpo_occurrance_min, cpu=None, criterion=None, rad_rad=None, lab_lab=None):
+    """
+    Build the synergy trees of many diseases. The phenotypes of each disease are selected from its precomputed summary
+    (see top_phenotypes) and their encounters are counted in the database one disease at a time, while a process pool
+    builds the trees of the diseases counted before. Trees are yielded as soon as they are built, so they can be saved
+    while other diseases are still counted, and a disease whose tree fails is logged and skipped. The mutual
+    information of all 2^k subsets and the partition search grow quickly with k = k_text + k_lab, so keep k around 10
+    or below.
+    @param summaries: a dictionary from disease to SummaryXYz (textHpo * labHpo), e.g. summaries_diag_rad_lab
+    @param diseases: diseases to build trees for
+    @param cpu: number of processes
+    @param criterion: None to select phenotypes by their mutual information with the disease, or a criterion of
+    selection.select(), which also needs the rad_rad and lab_lab summaries (see select_phenotypes)
+    :return: a generator of (disease, serialized tree), in the order the trees are built
+    """
+    with multiprocessing.Pool(cpu) as workers:
+        pending = []
+        # the database connection stays in this process (and thread); workers only get the counts
+        for diagnosis in diseases:
+            try:
+                textHpos, labHpos = select_phenotypes(diagnosis, summaries, k_text, k_lab, criterion, rad_rad,
+                                                      lab_lab)
+                if not textHpos and not labHpos:
+                    logger.warning('no phenotypes to build a synergy tree of {}'.format(diagnosis))
+                    continue
+                logger.info('{}: textHpo {}, labHpo {}'.format(diagnosis, textHpos, labHpos))
+                var_dict, counts = profile_counts(diagnosis, textHpos, labHpos, primary_diagnosis_only,
+                                                  textHpo_occurrance_min, labHpo_occurrance_min)
+            except Exception as e:
+                logger.error('failed to count the phenotypes of {}: {!r}'.format(diagnosis, e))
+                continue
+            pending.append((diagnosis, workers.apply_async(_build_one, [(diagnosis, var_dict, counts)])))
+            yield from _finished(pending)
+        while pending:
+            yield from _finished(pending, wait=True)
+
+
+def save_tree(tree, out_dir):
+    """
+    Write a serialized synergy tree to {out_dir}/synergy_tree_{disease}.json.
+    :return: the path
+    """
+    path = os.path.join(out_dir, 'synergy_tree_{}.json'.format(tree['disease']))
+    with open(path, 'w') as f:
+        json.dump(tree, f, indent=1)
+    return path
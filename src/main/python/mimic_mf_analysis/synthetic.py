@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+# frequent 3-digit ICD-9 categories in MIMIC-III, most frequent first. The first four are the diseases of interest in
+# analysisConfig.yaml
+COMMON_ICD9 = ['428', '584', '038', '493', '401', '427', '414', '250', '272', '518', '599', '285', '276', '496',
+               '585', '244', '530', '995', 'V45', 'V58', '403', '287', '424', '311', '305', 'E87', '486', '410',
+               '998', '780']
+
+# columns of the tables that the analysis reads
+TABLE_COLUMNS = {'admissions': ['SUBJECT_ID', 'HADM_ID'],
+                 'DIAGNOSES_ICD': ['SUBJECT_ID', 'HADM_ID', 'ICD9_CODE', 'SEQ_NUM'],
+                 'JAX_textHpoProfile': ['SUBJECT_ID', 'HADM_ID', 'MAP_TO', 'OCCURRANCE', 'dummy'],
+                 'JAX_labHpoProfile': ['SUBJECT_ID', 'HADM_ID', 'MAP_TO', 'OCCURRANCE', 'dummy']}
+
+TABLE_INDEXES = {'admissions': ['SUBJECT_ID, HADM_ID'],
+                 'DIAGNOSES_ICD': ['SUBJECT_ID, HADM_ID', 'ICD9_CODE'],
+                 'JAX_textHpoProfile': ['MAP_TO', 'SUBJECT_ID, HADM_ID, MAP_TO', 'OCCURRANCE'],
+                 'JAX_labHpoProfile': ['MAP_TO', 'SUBJECT_ID, HADM_ID, MAP_TO', 'OCCURRANCE']}
+
+
+def disease_codes(n_diseases):
+    """
+    3-digit ICD-9 categories: the common ones first, then unused numeric categories.
+    """
+    codes = COMMON_ICD9[:n_diseases]
+    extra = (str(code) for code in range(100, 1000) if str(code) not in COMMON_ICD9)
+    while len(codes) < n_diseases:
+        codes.append(next(extra))
+    return codes
+
+
+def phenotype_terms(n, offset):
+    return ['HP:{:07d}'.format(offset + i) for i in range(n)]
+
+
+def _profiles(rng, membership, prevalence, effects, occurrance_mean, terms, subject_ids, hadm_ids):
+    # phenotype probability of an encounter: a baseline hazard plus the hazards added by each of its diagnoses
+    hazard = -np.log1p(-prevalence)[np.newaxis, :] + membership @ effects
+    positive = rng.uniform(size=hazard.shape) < -np.expm1(-hazard)
+    encounters, phenotypes = np.nonzero(positive)
+    return pd.DataFrame({'SUBJECT_ID': subject_ids[encounters],
+                         'HADM_ID': hadm_ids[encounters],
+                         'MAP_TO': np.asarray(terms)[phenotypes],
+                         'OCCURRANCE': 1 + rng.poisson(occurrance_mean - 1, size=len(encounters)),
+                         'dummy': 1})
+
+
+def generate(n_encounters=1000, n_text_phenotypes=300, n_lab_phenotypes=200, n_diseases=500,
+             diagnoses_per_encounter=11, associated_phenotypes=10, seed=0, chunk_size=20000):
+    """
+    Generate synthetic admissions, ICD-9 diagnoses and sparse phenotype profiles shaped like the MIMIC-III tables that
+    the analysis reads. Subjects have one or more admissions, diagnosis categories follow a Zipf-like frequency,
+    phenotype prevalence is log-uniform between 0.03% and 20%, and each diagnosis raises the probability of a few
+    associated phenotypes, so that mutual information and synergy are not all zero.
+    @param n_encounters: number of admissions
+    @param n_text_phenotypes: number of distinct phenotypes from text mining
+    @param n_lab_phenotypes: number of distinct phenotypes from lab tests
+    @param n_diseases: number of distinct 3-digit ICD-9 categories
+    @param diagnoses_per_encounter: mean number of diagnosis codes per admission (about 11 in MIMIC-III)
+    @param associated_phenotypes: number of phenotypes of each kind associated with each diagnosis
+    @param seed: random seed
+    @param chunk_size: number of admissions whose phenotypes are drawn at a time
+    :return: a dictionary from table name (admissions, DIAGNOSES_ICD, JAX_textHpoProfile, JAX_labHpoProfile) to data
+    frame
+    """
+    rng = np.random.default_rng(seed)
+
+    # admissions: subjects with geometrically distributed numbers of admissions
+    admissions_per_subject = rng.geometric(0.75, size=n_encounters)
+    subject_ids = 10000 + np.repeat(np.arange(n_encounters), admissions_per_subject)[:n_encounters]
+    hadm_ids = 100000 + rng.permutation(n_encounters)
+    admissions = pd.DataFrame({'SUBJECT_ID': subject_ids, 'HADM_ID': hadm_ids})
+
+    # diagnoses: distinct categories per admission, listed in a random order; SEQ_NUM 1 is the primary diagnosis
+    codes = np.array(disease_codes(n_diseases))
+    # the offset flattens the head, so the most frequent category is in about a quarter of admissions as in MIMIC-III
+    disease_prob = 1 / np.arange(11, n_diseases + 11) ** 1.1
+    disease_prob = disease_prob / disease_prob.sum()
+    n_diagnoses = 1 + rng.poisson(diagnoses_per_encounter - 1, size=n_encounters)
+    encounter_of_diagnosis = np.repeat(np.arange(n_encounters), n_diagnoses)
+    diagnoses = pd.DataFrame({'encounter': encounter_of_diagnosis,
+                              'disease': rng.choice(n_diseases, size=len(encounter_of_diagnosis), p=disease_prob)})
+    diagnoses = diagnoses.drop_duplicates().reset_index(drop=True)
+    diagnoses['SEQ_NUM'] = diagnoses.groupby('encounter').cumcount() + 1
+    # full codes add zero to two digits to the category, e.g. 428 -> 4280, 42823
+    suffix_length = rng.choice(3, size=len(diagnoses), p=[0.2, 0.4, 0.4])
+    suffix = rng.integers(0, 100, size=len(diagnoses))
+    two_digits = np.array(['{:02d}'.format(i) for i in range(100)])
+    suffixes = np.where(suffix_length == 0, '', np.where(suffix_length == 1, np.char.ljust(
+        np.array([digits[0] for digits in two_digits])[suffix], 1), two_digits[suffix]))
+    full_codes = np.char.add(codes[diagnoses.disease.values], suffixes)
+    diagnoses_icd = pd.DataFrame({'SUBJECT_ID': subject_ids[diagnoses.encounter.values],
+                                  'HADM_ID': hadm_ids[diagnoses.encounter.values],
+                                  'ICD9_CODE': full_codes,
+                                  'SEQ_NUM': diagnoses.SEQ_NUM.values})
+
+    # phenotypes
+    text_terms = phenotype_terms(n_text_phenotypes, 1)
+    lab_terms = phenotype_terms(n_lab_phenotypes, 1 + n_text_phenotypes)
+    text_prevalence = 10 ** rng.uniform(-3.5, -0.7, size=n_text_phenotypes)
+    lab_prevalence = 10 ** rng.uniform(-3.5, -0.7, size=n_lab_phenotypes)
+    text_effects = np.zeros([n_diseases, n_text_phenotypes])
+    lab_effects = np.zeros([n_diseases, n_lab_phenotypes])
+    for effects in [text_effects, lab_effects]:
+        for disease in range(n_diseases):
+            associated = rng.choice(effects.shape[1], size=min(associated_phenotypes, effects.shape[1]),
+                                    replace=False)
+            effects[disease, associated] = rng.uniform(0.05, 0.5, size=len(associated))
+
+    text_profiles, lab_profiles = [], []
+    for start in range(0, n_encounters, chunk_size):
+        end = min(start + chunk_size, n_encounters)
+        in_chunk = (diagnoses.encounter.values >= start) & (diagnoses.encounter.values < end)
+        membership = np.zeros([end - start, n_diseases])
+        membership[diagnoses.encounter.values[in_chunk] - start, diagnoses.disease.values[in_chunk]] = 1
+        text_profiles.append(_profiles(rng, membership, text_prevalence, text_effects, 1.5, text_terms,
+                                       subject_ids[start:end], hadm_ids[start:end]))
+        lab_profiles.append(_profiles(rng, membership, lab_prevalence, lab_effects, 4, lab_terms,
+                                      subject_ids[start:end], hadm_ids[start:end]))
+
+    data = {'admissions': admissions,
+            'DIAGNOSES_ICD': diagnoses_icd,
+            'JAX_textHpoProfile': pd.concat(text_profiles, ignore_index=True),
+            'JAX_labHpoProfile': pd.concat(lab_profiles, ignore_index=True)}
+    logger.info('synthetic data: {}'.format({name: len(table) for name, table in data.items()}))
+    return data
+
+
+def frequent_phenotypes(data, table, n, occurrance_min=1):
+    """
+    The n phenotypes called in the most admissions.
+    @param table: JAX_textHpoProfile or JAX_labHpoProfile
+    """
+    profile = data[table]
+    called = profile[profile.OCCURRANCE >= occurrance_min]
+    return called.MAP_TO.value_counts().index[:n].values
+
+
+def to_matrices(data, diagnosis, textHpos, labHpos, textHpo_occurrance_min=1, labHpo_occurrance_min=3,
+                primary_diagnosis_only=False):
+    """
+    Diagnosis vector and phenotype matrices of all admissions, in the same form that batch_query() produces.
+    @param diagnosis: ICD-9 code prefix, as in createDiagnosisTable()
+    @param textHpos: phenotypes from text mining, the columns of the first matrix
+    @param labHpos: phenotypes from lab tests, the columns of the second matrix
+    :return: d (size N), textHpo matrix (N x M1) and labHpo matrix (N x M2)
+    """
+    admissions = data['admissions']
+    row_of = pd.Series(np.arange(len(admissions)), index=admissions.HADM_ID.values)
+
+    diagnoses = data['DIAGNOSES_ICD']
+    selected = diagnoses.ICD9_CODE.str.startswith(diagnosis)
+    if primary_diagnosis_only:
+        selected = selected & (diagnoses.SEQ_NUM == 1)
+    d = np.zeros(len(admissions), dtype=int)
+    d[row_of[diagnoses.HADM_ID[selected].values].values] = 1
+
+    matrices = []
+    for table, phenotypes, occurrance_min in [('JAX_textHpoProfile', textHpos, textHpo_occurrance_min),
+                                              ('JAX_labHpoProfile', labHpos, labHpo_occurrance_min)]:
+        profile = data[table]
+        column_of = pd.Series(np.arange(len(phenotypes)), index=phenotypes)
+        called = profile[(profile.OCCURRANCE >= occurrance_min) & profile.MAP_TO.isin(phenotypes)]
+        matrix = np.zeros([len(admissions), len(phenotypes)], dtype=int)
+        matrix[row_of[called.HADM_ID.values].values, column_of[called.MAP_TO.values].values] = 1
+        matrices.append(matrix)
+    return d, matrices[0], matrices[1]
+
+
+def shadow_tables(data, db, chunk_size=10000):
+    """
+    Load synthetic tables into temporary tables with the names of the real ones. A temporary table hides the
+    permanent table of the same name for the rest of the session (in MySQL, DuckDB and SQLite alike), so the analysis
+    functions that use this connection read the synthetic data, while the real tables are left untouched.
+    @param data: output of generate()
+    @param db: a database backend, e.g. mimic_mf_analysis.db
+    @param chunk_size: rows per INSERT
+    """
+    for table, frame in data.items():
+        db.load_frame(table, frame[TABLE_COLUMNS[table]], temporary=True, chunk_size=chunk_size)
+        for i, index_columns in enumerate(TABLE_INDEXES[table]):
+            db.create_index('{}_synthetic_idx{:02d}'.format(table, i), table, index_columns)
+        logger.info('loaded {} synthetic rows into temporary table {}'.format(len(frame), table))
@@ -0,0 +1,28 @@
+import unittest
+import numpy as np
+import mutual_information.mf as mf
+from mimic_mf_analysis.analytic import chi2_sf, analytic_p_values
+
+
+class AnalyticTestCase(unittest.TestCase):
+    def test_chi2_sf(self):
+        # 5% critical values of the chi-square distribution
+        for df, critical in [(1, 3.841459), (2, 5.991465), (3, 7.814728)]:
+            self.assertAlmostEqual(float(chi2_sf(critical, df)), 0.05, places=5)
+
+    def test_analytic_p_values(self):
+        rng = np.random.default_rng(1)
+        X = (rng.uniform(size=[2000, 3]) < 0.3).astype(int)
+        Y = (rng.uniform(size=[2000, 2]) < 0.4).astype(int)
+        d = (rng.uniform(size=2000) < 0.2).astype(int)
+        summary = mf.SummaryXYz(['HP:1', 'HP:2', 'HP:3'], ['HP:4', 'HP:5'], '038')
+        summary.add_batch(X, Y, d)
+        p = analytic_p_values(summary)
+        self.assertEqual(p['synergy'].shape, (3, 2))
+        self.assertEqual(p['needs_simulation'].shape, (3, 2))
+        self.assertTrue(((p['synergy'] >= 0) & (p['synergy'] <= 1)).all())
+        self.assertTrue(p['reliable'].all())
+
+
+if __name__ == '__main__':
+    unittest.main()
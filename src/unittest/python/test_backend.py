@@ -0,0 +1,58 @@
+import unittest
+import numpy as np
+import pandas as pd
+import mimic_mf_analysis.metrics as metrics
+from mimic_mf_analysis.backend import connect
+
+
+class TestBackend(unittest.TestCase):
+    def setUp(self):
+        self.db = connect({'backend': 'sqlite'})
+        self.db.load_frame('admissions', pd.DataFrame({'SUBJECT_ID': [1, 2, 3], 'HADM_ID': [10, 20, 30]}))
+
+    def test_temporary_table_shadows_permanent(self):
+        self.db.load_frame('admissions', pd.DataFrame({'SUBJECT_ID': [4], 'HADM_ID': [40]}), temporary=True)
+        self.assertEqual(self.db.read_sql('SELECT * FROM admissions').HADM_ID.tolist(), [40])
+        self.db.drop_temp_table('admissions')
+        self.assertEqual(len(self.db.read_sql('SELECT * FROM admissions')), 3)
+
+    def test_row_id(self):
+        self.db.create_temp_table_as('encounters', 'SELECT SUBJECT_ID, HADM_ID FROM admissions ORDER BY HADM_ID DESC',
+                                     row_id=True)
+        self.assertEqual(self.db.read_sql('SELECT ROW_ID FROM encounters ORDER BY ROW_ID').ROW_ID.tolist(),
+                         [1, 2, 3])
+        self.db.create_temp_table_as('diag', 'SELECT SUBJECT_ID, HADM_ID FROM admissions')
+        self.db.create_index('diag_idx01', 'diag', 'SUBJECT_ID, HADM_ID')
+        self.db.add_row_id('diag')
+        self.assertEqual(sorted(self.db.read_sql('SELECT ROW_ID FROM diag').ROW_ID.tolist()), [1, 2, 3])
+
+    def test_table_exists(self):
+        self.assertTrue(self.db.table_exists('admissions'))
+        self.assertFalse(self.db.table_exists('JAX_textHpoProfile'))
+
+    def test_prepared_query(self):
+        metrics.registry.reset()
+        metrics.configure(prometheus_path='unused.prom')
+        try:
+            query = 'SELECT HADM_ID FROM admissions WHERE SUBJECT_ID BETWEEN ? AND ? ORDER BY HADM_ID'
+            for start, expected in [(1, [10, 20]), (np.int64(2), [20, 30]), (3, [30])]:
+                self.assertEqual(self.db.prepare(query).read([start, start + 1]).HADM_ID.tolist(), expected)
+            self.assertIs(self.db.prepare(query), self.db.prepare(query))
+            # parsing and planning is saved on every execution after the first
+            saved = [total for total in metrics.summary() if total['stage'] == 'prepare_saved']
+            self.assertEqual(saved[0]['calls'], 2)
+        finally:
+            metrics.configure()
+            metrics.registry.reset()
+
+    def test_bound_values_need_no_quoting(self):
+        self.db.load_frame('notes', pd.DataFrame({'TEXT': ["patient's history"]}))
+        self.assertEqual(len(self.db.read_sql('SELECT * FROM notes WHERE TEXT = ?', ["patient's history"])), 1)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            connect({'backend': 'oracle'})
+
+
+if __name__ == '__main__':
+    unittest.main()
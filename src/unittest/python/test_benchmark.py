@@ -0,0 +1,37 @@
+import unittest
+import copy
+import numpy as np
+from mimic_mf_analysis import synthetic, benchmark
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_synthetic_data(self):
+        data = synthetic.generate(500, seed=3)
+        self.assertEqual(len(data['admissions']), 500)
+        self.assertEqual(data['admissions'].HADM_ID.nunique(), 500)
+        self.assertTrue(set(data['DIAGNOSES_ICD'].HADM_ID) <= set(data['admissions'].HADM_ID))
+        self.assertTrue((data['JAX_labHpoProfile'].OCCURRANCE >= 1).all())
+        again = synthetic.generate(500, seed=3)
+        self.assertTrue(data['JAX_textHpoProfile'].equals(again['JAX_textHpoProfile']))
+
+        textHpos = synthetic.frequent_phenotypes(data, 'JAX_textHpoProfile', 5)
+        labHpos = synthetic.frequent_phenotypes(data, 'JAX_labHpoProfile', 4, 3)
+        d, X, Y = synthetic.to_matrices(data, '428', textHpos, labHpos)
+        self.assertEqual(X.shape, (500, 5))
+        self.assertEqual(Y.shape, (500, 4))
+        profile = data['JAX_textHpoProfile']
+        self.assertEqual(X[:, 0].sum(), np.sum(profile.MAP_TO == textHpos[0]))
+        self.assertTrue(0 < d.sum() < 500)
+
+    def test_compare(self):
+        report = benchmark.run_benchmarks(300, stages=['summarize', 'summarize_dedup'], panel_size=5)
+        self.assertEqual([result['stage'] for result in report['results']], ['summarize', 'summarize_dedup'])
+        baseline = copy.deepcopy(report)
+        baseline['results'][0]['wall_time'] /= 2
+        comparison = benchmark.compare(report, baseline, tolerance=0.2)
+        self.assertTrue(comparison[0]['regression'])
+        self.assertFalse(comparison[1]['regression'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import numpy as np
+import mutual_information.mf as mf
+import mimic_mf_analysis.bootstrap as bootstrap
+from mimic_mf_analysis.sparse_pairs import SparseSummaryXYz
+
+
+class TestBootstrap(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        self.d = rng.integers(0, 2, size=400)
+        self.P1 = rng.integers(0, 2, size=[400, 3])
+        self.P1[:, 0] = np.where(rng.uniform(size=400) < 0.8, self.d, 1 - self.d)
+        self.P2 = rng.integers(0, 2, size=[400, 2])
+        self.summary = mf.SummaryXYz(['HP:1', 'HP:2', 'HP:3'], ['HP:4', 'HP:5'], '428')
+        self.summary.add_batch(self.P1, self.P2, self.d)
+
+    def test_mutual_info(self):
+        mutual_info = mf.MutualInfoXYz(self.summary)
+        statistics = bootstrap.mutual_info_xyz(self.summary.m2)
+        np.testing.assert_allclose(statistics['mf_XY_z'], mutual_info.mutual_info_XY_z())
+        np.testing.assert_allclose(statistics['synergy'], mutual_info.synergy_XY2z())
+        np.testing.assert_allclose(bootstrap.mutual_info_xy(self.summary.m1['set1']), mutual_info.mutual_info_Xz())
+        # integer replicates take the lookup table
+        np.testing.assert_allclose(bootstrap.mutual_info_xyz(self.summary.m2.astype(np.int64))['synergy'],
+                                   mutual_info.synergy_XY2z())
+
+    def test_confidence_intervals(self):
+        mutual_info = mf.MutualInfoXYz(self.summary)
+        for method in bootstrap.METHODS:
+            intervals = bootstrap.confidence_intervals(self.summary, resamples=200, method=method, seed=1)
+            self.assertEqual(intervals['synergy_lower'].shape, (3, 2))
+            self.assertEqual(intervals['mf_Yz_upper'].shape, (2,))
+            # plug-in mutual information is biased upwards, so only the pairs far from 0 surely cover the estimate
+            mi = mutual_info.mutual_info_XY_z()[0]
+            self.assertTrue((intervals['mf_XY_z_lower'][0] <= mi).all() and (mi <= intervals['mf_XY_z_upper'][0]).all())
+            self.assertTrue((intervals['synergy_lower'] <= intervals['synergy_upper']).all())
+            # the phenotype that follows the diagnosis is clearly informative
+            self.assertGreater(intervals['mf_Xz_lower'][0], intervals['mf_Xz_upper'][1])
+
+        # chunking does not change the replicates
+        whole = bootstrap.confidence_intervals(self.summary, resamples=50, seed=3)
+        chunked = bootstrap.confidence_intervals(self.summary, resamples=50, seed=3, chunk_size=2)
+        for name in whole:
+            np.testing.assert_allclose(whole[name], chunked[name])
+        with self.assertRaises(ValueError):
+            bootstrap.confidence_intervals(self.summary, resamples=10, method='jackknife')
+
+    def test_summary_xy_and_sparse(self):
+        summary = mf.SummaryXY(['HP:1', 'HP:2', 'HP:3'], ['HP:4', 'HP:5'])
+        summary.add_batch(self.P1, self.P2)
+        intervals = bootstrap.confidence_intervals(summary, resamples=100, seed=1)
+        self.assertEqual(set(intervals), {'mf_XY_lower', 'mf_XY_upper'})
+        self.assertEqual(intervals['mf_XY_lower'].shape, (3, 2))
+
+        sparse = SparseSummaryXYz(['HP:1', 'HP:2', 'HP:3'], ['HP:4', 'HP:5'], '428')
+        sparse.add_batch(self.P1, self.P2, self.d)
+        dense = bootstrap.confidence_intervals(self.summary, resamples=100, seed=1)
+        intervals = bootstrap.confidence_intervals(sparse, resamples=100, seed=1)
+        # all pairs co-occur, so the sparse summary resamples the same tables
+        self.assertEqual(len(intervals['rows']), 6)
+        np.testing.assert_allclose(intervals['synergy_upper'],
+                                   dense['synergy_upper'][intervals['rows'], intervals['cols']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+import numpy as np
+import mutual_information.mf as mf
+from mimic_mf_analysis.dedup import ProfileCounter, add_weighted, synergy_random_dedup
+
+
+class DedupTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.X = (rng.uniform(size=[5000, 5]) < 0.1).astype(int)
+        self.Y = (rng.uniform(size=[5000, 4]) < 0.15).astype(int)
+        self.d = (rng.uniform(size=5000) < 0.2).astype(int)
+
+    def test_weighted_counts(self):
+        profiles = ProfileCounter(5, 4, buffer_size=1000)
+        for i in range(0, 5000, 100):
+            profiles.add_batch(self.X[i:i + 100], self.Y[i:i + 100], self.d[i:i + 100])
+        self.assertLess(len(profiles.keys), 500)
+        d, X, Y, weights = profiles.profiles()
+        self.assertEqual(np.sum(weights), 5000)
+
+        expected = mf.SummaryXYz(list('abcde'), list('fghi'), '038')
+        expected.add_batch(self.X, self.Y, self.d)
+        summary = mf.SummaryXYz(list('abcde'), list('fghi'), '038')
+        add_weighted(summary, X, Y, d, weights)
+        self.assertTrue((summary.m2 == expected.m2).all())
+        self.assertTrue((summary.m1['set1'] == expected.m1['set1']).all())
+        self.assertEqual((summary.case_N, summary.control_N), (expected.case_N, expected.control_N))
+
+        expected = mf.SummaryXY(list('abcde'), list('fghi'))
+        expected.add_batch(self.X, self.Y)
+        summary = mf.SummaryXY(list('abcde'), list('fghi'))
+        add_weighted(summary, X, Y, None, weights)
+        self.assertTrue((summary.m == expected.m).all())
+        self.assertEqual(summary.N, expected.N)
+
+    def test_synergy_random_dedup(self):
+        simulated = synergy_random_dedup(0.2, np.full(3, 0.1), np.full(2, 0.2), 1000, seed=1)
+        self.assertEqual(simulated['synergy'].shape, (3, 2))
+        self.assertEqual(simulated['mf_Xz'].shape, (3,))
+
+
+if __name__ == '__main__':
+    unittest.main()
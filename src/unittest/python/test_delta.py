@@ -0,0 +1,122 @@
+import unittest
+from unittest import mock
+import logging
+import os
+import pickle
+import tempfile
+import numpy as np
+import mutual_information.mf as mf
+import mimic_mf_analysis
+import mimic_mf_analysis.delta as delta
+import mimic_mf_analysis.synthetic as synthetic
+from mimic_mf_analysis.backend import connect
+
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.P1 = rng.integers(0, 2, size=[40, 3])
+        self.P2 = rng.integers(0, 2, size=[40, 4])
+        self.d = rng.integers(0, 2, size=40)
+        self.hadm_ids = np.arange(100, 140)
+
+    def summaries(self, P1, P2, d):
+        summaries = [mf.SummaryXYz(['HP:1', 'HP:2', 'HP:3'], ['HP:4', 'HP:5', 'HP:6', 'HP:7'], '428'),
+                     mf.SummaryXYz(['HP:1', 'HP:2', 'HP:3'], ['HP:1', 'HP:2', 'HP:3'], '428'),
+                     mf.SummaryXYz(['HP:4', 'HP:5', 'HP:6', 'HP:7'], ['HP:4', 'HP:5', 'HP:6', 'HP:7'], '428')]
+        summaries[0].add_batch(P1, P2, d)
+        summaries[1].add_batch(P1, P1, d)
+        summaries[2].add_batch(P2, P2, d)
+        return summaries
+
+    def test_apply_delta(self):
+        # the earlier run saw the first 30 encounters
+        stored = delta.EncounterVectors()
+        stored.add('428', self.hadm_ids[:30], self.P1[:30], self.P2[:30], self.d[:30])
+        summaries = self.summaries(self.P1[:30], self.P2[:30], self.d[:30])
+
+        # now encounter 105 has another phenotype, encounters 100 and 101 are gone and 130 to 139 are new
+        P1 = self.P1.copy()
+        P1[5, 0] = 1 - P1[5, 0]
+        fresh = delta.EncounterVectors()
+        fresh.add('428', self.hadm_ids[30:], P1[30:], self.P2[30:], self.d[30:])
+        fresh.add('428', self.hadm_ids[5:7], P1[5:7], self.P2[5:7], self.d[5:7])
+        updated, counts = delta.apply_delta(summaries, stored.get('428'), fresh.get('428'), self.hadm_ids[2:], 3, 4)
+
+        self.assertEqual(counts, (10, 1, 2))
+        for summary, expected in zip(summaries, self.summaries(P1[2:], self.P2[2:], self.d[2:])):
+            np.testing.assert_array_equal(summary.m2, expected.m2)
+            self.assertEqual((summary.case_N, summary.control_N), (expected.case_N, expected.control_N))
+        np.testing.assert_array_equal(updated[0], self.hadm_ids[2:])
+
+    def test_save_and_load(self):
+        vectors = delta.EncounterVectors()
+        vectors.add('all', self.hadm_ids[::-1], self.P1[::-1], self.P2[::-1])
+        with tempfile.TemporaryDirectory() as dir:
+            vectors.save(dir)
+            hadm_ids, packed = delta.EncounterVectors.load(dir).get('all')
+        np.testing.assert_array_equal(hadm_ids, self.hadm_ids)
+        np.testing.assert_array_equal(packed, vectors.get('all')[1])
+
+
+class TestUpdateRegardingDiagnosis(unittest.TestCase):
+    parameters = {'primary_diagnosis_only': False, 'textHpo_occurrance_min': 1, 'labHpo_occurrance_min': 3}
+
+    def setUp(self):
+        self.db = connect({'backend': 'sqlite'})
+        patch = mock.patch.dict(vars(mimic_mf_analysis), {'db': self.db})
+        patch.start()
+        self.addCleanup(patch.stop)
+        # analysis and preparation bind the connection when they are first imported
+        import mimic_mf_analysis.analysis as analysis
+        import mimic_mf_analysis.preparation as preparation
+        for module in [analysis, preparation]:
+            patch = mock.patch.dict(vars(module), {'db': self.db})
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.analysis = analysis
+        self.data = synthetic.generate(600, n_text_phenotypes=40, n_lab_phenotypes=30, n_diseases=20, seed=1)
+
+    def load(self, admissions, dropped_phenotypes=()):
+        data = dict(self.data)
+        data['admissions'] = admissions
+        text = self.data['JAX_textHpoProfile'].copy()
+        text.loc[text.HADM_ID.isin(dropped_phenotypes), 'OCCURRANCE'] = 0
+        data['JAX_textHpoProfile'] = text
+        synthetic.shadow_tables(data, self.db)
+        self.analysis.initTables()
+
+    def summarize(self, vectors=None):
+        return self.analysis.summarize_diagnosis_textHpo_labHpo(False, 1, 3, 0, 1, 10 ** 9, 1, 10 ** 9, ['428', '584'],
+                                                                logging.getLogger(__name__), vectors=vectors)
+
+    def test_update_matches_full_run(self):
+        admissions = self.data['admissions']
+        # encounters 100 to 104 lose their text phenotypes without new rows, so they are passed explicitly
+        changed = admissions.HADM_ID.values[100:105].tolist()
+        names = ['summaries_diag_rad_lab', 'summaries_diag_rad_rad', 'summaries_diag_lab_lab']
+        with tempfile.TemporaryDirectory() as dir:
+            self.load(admissions.iloc[:500])
+            vectors = delta.EncounterVectors()
+            for name, result in zip(names, self.summarize(vectors)):
+                with open(os.path.join(dir, name + '.obj'), 'wb') as f:
+                    pickle.dump(result, f, protocol=2)
+            vectors.save(dir)
+            delta.write_state(dir, 'regarding_diagnosis', names, self.parameters, delta.current_watermarks())
+
+            # 10 encounters are gone and 100 are new
+            self.load(admissions.iloc[10:], changed)
+            updated, vectors, _ = delta.update_regarding_diagnosis(dir, self.parameters, changed)
+        self.load(admissions.iloc[10:], changed)
+        for summaries, expected in zip(updated, self.summarize()):
+            for diagnosis in ['428', '584']:
+                summary, full = summaries[diagnosis], expected[diagnosis]
+                rows = [list(full.vars_labels['set1']).index(label) for label in summary.vars_labels['set1']]
+                cols = [list(full.vars_labels['set2']).index(label) for label in summary.vars_labels['set2']]
+                np.testing.assert_array_equal(summary.m2, full.m2[np.ix_(rows, cols)])
+                self.assertEqual((summary.case_N, summary.control_N), (full.case_N, full.control_N))
+        self.assertEqual(len(vectors.get('428')[0]), len(admissions) - 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
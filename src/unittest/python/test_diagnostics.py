@@ -0,0 +1,46 @@
+import unittest
+import pandas as pd
+import mimic_mf_analysis.diagnostics as diagnostics
+from mimic_mf_analysis.backend import connect
+
+
+class TestDiagnostics(unittest.TestCase):
+    def setUp(self):
+        diagnostics.registry.reset()
+
+    def tearDown(self):
+        diagnostics.configure(None)
+
+    def test_normalize(self):
+        sql = """SELECT * FROM JAX_mf_diag
+                 WHERE ROW_ID BETWEEN 101 AND 200 AND ICD9_CODE LIKE '428%' AND V1 IN (1, 2, 3)"""
+        self.assertEqual(diagnostics.normalize(sql),
+                         'SELECT * FROM JAX_mf_diag WHERE ROW_ID BETWEEN ? AND ? AND ICD9_CODE LIKE ? AND V1 IN (?)')
+        self.assertEqual(diagnostics.normalize(sql), diagnostics.normalize(sql.replace('428', '038')))
+
+    def test_explainable(self):
+        self.assertEqual(diagnostics.explainable('CREATE TEMPORARY TABLE t WITH a AS (SELECT 1) SELECT * FROM a'),
+                         'WITH a AS (SELECT 1) SELECT * FROM a')
+        self.assertIsNone(diagnostics.explainable('CREATE INDEX t_idx01 ON t (MAP_TO)'))
+        self.assertIsNone(diagnostics.explainable('ALTER TABLE t ADD COLUMN V1 INT DEFAULT 0'))
+
+    def test_report(self):
+        diagnostics.configure('unused.json', threshold=0)
+        db = connect({'backend': 'sqlite'})
+        db.load_frame('JAX_textHpoProfile', pd.DataFrame({'HADM_ID': [1, 2], 'MAP_TO': ['HP:1', 'HP:2']}))
+        for phenotype in ['HP:1', 'HP:2']:
+            db.read_sql("SELECT * FROM JAX_textHpoProfile WHERE MAP_TO = '{}'".format(phenotype))
+        db.create_index('JAX_textHpoProfile_idx02', 'JAX_textHpoProfile', 'MAP_TO')
+        db.read_sql("SELECT * FROM JAX_textHpoProfile WHERE MAP_TO = 'HP:3'")
+
+        report = diagnostics.registry.report()
+        template = [stats for stats in report['templates'] if stats['template'].startswith('SELECT')][0]
+        # the plan is captured the first time, before the index exists
+        self.assertEqual(template['calls'], 3)
+        self.assertEqual(template['full_scans'], ['JAX_textHpoProfile'])
+        self.assertEqual(len([query for query in report['slow_queries'] if query['template'] == template['template']]),
+                         3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+import numpy as np
+import mimic_mf_analysis.encoding as encoding
+from mimic_mf_analysis.sparse_pairs import positive_matrix
+
+
+class TestEncoding(unittest.TestCase):
+    def setUp(self):
+        self.dictionary = encoding.HpoDictionary([1, 2, 3, 4], ['HP:1', 'HP:2', 'HP:3', 'HP:4'])
+
+    def test_encode_decode(self):
+        codes = self.dictionary.encode(['HP:3', 'HP:1', 'HP:9'])
+        self.assertEqual(codes.dtype, encoding.CODE_DTYPE)
+        np.testing.assert_array_equal(codes, [3, 1, encoding.UNKNOWN])
+        self.assertEqual(list(self.dictionary.decode(codes[:2])), ['HP:3', 'HP:1'])
+        self.assertEqual(len(self.dictionary), 4)
+
+    def test_columns(self):
+        # a panel of HP:4 and HP:2, in this order
+        lookup = encoding.column_index([4, 2])
+        np.testing.assert_array_equal(encoding.columns_of(lookup, [2, 4, 1, 7, 0]), [1, 0, -1, -1, -1])
+        matrix = positive_matrix([5, 5, 7, 9], [4, 4, 2, 3], 5, 10, lookup)
+        self.assertEqual(matrix.shape, (6, 2))
+        np.testing.assert_array_equal(matrix.toarray()[[0, 2, 4]], [[1, 0], [0, 1], [0, 0]])
+
+    def test_check_panel(self):
+        # 3 encounters, phenotype by phenotype
+        encoding.check_panel(np.array([4, 2]), [4, 4, 4, 2, 2, 2], 3)
+        with self.assertRaises(AssertionError):
+            encoding.check_panel(np.array([2, 4]), [4, 4, 4, 2, 2, 2], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
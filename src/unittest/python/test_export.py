@@ -0,0 +1,72 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import mutual_information.mf as mf
+import mimic_mf_analysis.export as export
+from mimic_mf_analysis.sparse_pairs import SparseSummaryXYz
+from mimic_mf_analysis.backend import connect
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(11)
+        self.P1 = rng.integers(0, 2, size=[300, 3])
+        self.P2 = rng.integers(0, 2, size=[300, 2])
+        self.d = rng.integers(0, 2, size=300)
+        self.summaries = {}
+        for disease in ['428', '584']:
+            summary = mf.SummaryXYz(['HP:1', 'HP:2', 'HP:3'], ['HP:4', 'HP:5'], disease)
+            summary.add_batch(self.P1, self.P2, self.d)
+            self.summaries[disease] = summary
+        self.p_values = {'428': {'synergy': np.arange(6, dtype=float).reshape([3, 2]) / 10}}
+
+    def test_pair_table(self):
+        table = export.pair_table('428', self.summaries['428'], 'TextHpo', 'LabHpo', self.p_values['428'])
+        self.assertEqual(list(table.columns), export.COLUMNS)
+        self.assertEqual(len(table), 6)
+        row = table[(table.term1 == 'HP:3') & (table.term2 == 'HP:4')].iloc[0]
+        mutual_info = mf.MutualInfoXYz(self.summaries['428'])
+        self.assertAlmostEqual(row.mi, mutual_info.mutual_info_XY_z()[2, 0])
+        self.assertAlmostEqual(row.synergy, mutual_info.synergy_XY2z()[2, 0])
+        self.assertAlmostEqual(row.p, 0.4)
+
+        # the same phenotypes on both sides: each pair once
+        summary = mf.SummaryXYz(['HP:1', 'HP:2', 'HP:3'], ['HP:1', 'HP:2', 'HP:3'], '428')
+        summary.add_batch(self.P1, self.P1, self.d)
+        table = export.pair_table('428', summary, 'TextHpo', 'TextHpo')
+        self.assertEqual(list(zip(table.term1, table.term2)), [('HP:1', 'HP:2'), ('HP:1', 'HP:3'), ('HP:2', 'HP:3')])
+        self.assertTrue(table.p.isna().all())
+
+    def test_sparse_pair_table(self):
+        sparse = SparseSummaryXYz(['HP:1', 'HP:2', 'HP:3'], ['HP:4', 'HP:5'], '428')
+        sparse.add_batch(self.P1, self.P2, self.d)
+        dense = export.pair_table('428', self.summaries['428'], 'TextHpo', 'LabHpo')
+        table = export.pair_table('428', sparse, 'TextHpo', 'LabHpo')
+        merged = dense.merge(table, on=['term1', 'term2'])
+        self.assertEqual(len(merged), 6)
+        np.testing.assert_allclose(merged.mi_x, merged.mi_y)
+        np.testing.assert_allclose(merged.synergy_x, merged.synergy_y)
+
+    def test_write_and_load(self):
+        tables = list(export.pair_tables(self.summaries, p_values=self.p_values, chunk_rows=4))
+        self.assertEqual([len(table) for table in tables], [4, 2, 4, 2])
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'pairs.csv.gz')
+            self.assertEqual(export.write_csv(tables, path), 12)
+            written = pd.read_csv(path)
+        expected = pd.concat(tables, ignore_index=True)
+        pd.testing.assert_frame_equal(written[['disease', 'term1', 'term2']].astype(str),
+                                      expected[['disease', 'term1', 'term2']].astype(str))
+        np.testing.assert_allclose(written.mi, expected.mi)
+
+        db = connect({'backend': 'sqlite'})
+        self.assertEqual(export.load_table(tables, 'mf_pairs', db), 12)
+        loaded = db.read_sql('SELECT * FROM mf_pairs WHERE disease = ? ORDER BY term1, term2', ['584'])
+        self.assertEqual(len(loaded), 6)
+        self.assertTrue(loaded.p.isna().all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+import os
+import sys
+import subprocess
+
+# modules that a command loads only when it runs
+HEAVY_MODULES = ['numpy', 'pandas', 'scipy', 'mutual_information', 'obonetx', 'mysql', 'duckdb', 'matplotlib',
+                 'networkx', 'mimic_mf_analysis.backend', 'mimic_mf_analysis.analysis']
+
+
+def imported_modules(*args):
+    """
+    Run python -X importtime with args and return the cumulative import time of each module, in microseconds.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + list(args), env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+class TestImportTime(unittest.TestCase):
+    def assertLight(self, modules):
+        heavy = sorted(name for name in modules if name.split('.')[0] in HEAVY_MODULES or name in HEAVY_MODULES)
+        self.assertEqual(heavy, [])
+
+    def test_import_app(self):
+        modules = imported_modules('-c', 'import mimic_mf_analysis.app')
+        self.assertIn('mimic_mf_analysis.app', modules)
+        self.assertLight(modules)
+
+    def test_help(self):
+        self.assertLight(imported_modules('-m', 'mimic_mf_analysis.app', '--help'))
+
+
+if __name__ == '__main__':
+    unittest.main()
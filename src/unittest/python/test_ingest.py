@@ -0,0 +1,55 @@
+import unittest
+import os
+import tempfile
+from unittest import mock
+import pandas as pd
+import mimic_mf_analysis
+import mimic_mf_analysis.ingest as ingest
+import mimic_mf_analysis.profiles as profiles
+from mimic_mf_analysis.backend import connect
+
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db = connect({'backend': 'sqlite'})
+        patch = mock.patch.dict(vars(mimic_mf_analysis), {'db': self.db})
+        patch.start()
+        self.addCleanup(patch.stop)
+        exports = {
+            'ADMISSIONS': pd.DataFrame({'ROW_ID': [1, 2, 3], 'SUBJECT_ID': [1, 2, 3], 'HADM_ID': [10, 20, 30],
+                                        'ADMISSION_TYPE': ['EMERGENCY', 'ELECTIVE', 'EMERGENCY']}),
+            'DIAGNOSES_ICD': pd.DataFrame({'ROW_ID': [1, 2], 'SUBJECT_ID': [1, 2], 'HADM_ID': [10, 20],
+                                           'SEQ_NUM': [1, 1], 'ICD9_CODE': ['0389', '4280']}),
+            'NOTEEVENTS': pd.DataFrame({'ROW_ID': [1, 2, 3, 4], 'SUBJECT_ID': [1, 1, 2, 3],
+                                        'HADM_ID': [10, 10, 20, None],
+                                        'TEXT': ['chest x-ray,\n"no" effusion', 'ok', 'ok', 'outpatient']}),
+            'LABEVENTS': pd.DataFrame({'ROW_ID': [1, 2, 3], 'SUBJECT_ID': [1, 1, 2], 'HADM_ID': [10, 10, 20]}),
+            'NoteHpoClinPhen': pd.DataFrame({'NOTES_ROW_ID': [1, 1, 2, 3, 4],
+                                             'MAP_TO': ['HP:1', 'HP:2', 'HP:1', 'HP:1', 'HP:1']}),
+            'LabHpo': pd.DataFrame({'ROW_ID': [1, 2, 3], 'MAP_TO': ['HP:3', 'HP:3', 'HP:3'],
+                                    'NEGATED': ['F', 'F', 'T']})}
+        for name, frame in exports.items():
+            frame.to_csv(os.path.join(self.dir.name, name + '.csv.gz'), index=False)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def profile(self, table):
+        frame = self.db.read_sql('SELECT SUBJECT_ID, HADM_ID, MAP_TO, OCCURRANCE FROM {}'.format(table))
+        return sorted(map(tuple, frame.values.tolist()))
+
+    def test_ingest(self):
+        aggregated = ingest.ingest(self.dir.name, chunk_size=2)
+        self.assertEqual(aggregated, {'JAX_textHpoProfile': ['NoteHpoClinPhen'], 'JAX_labHpoProfile': ['LabHpo']})
+        # counts are added up across chunks; notes without HADM_ID and negated lab phenotypes are left out
+        self.assertEqual(self.profile('JAX_textHpoProfile'), [(1, 10, 'HP:1', 2), (1, 10, 'HP:2', 1),
+                                                              (2, 20, 'HP:1', 1)])
+        self.assertEqual(self.profile('JAX_labHpoProfile'), [(1, 10, 'HP:3', 2)])
+        self.assertEqual(self.db.read_sql('SELECT ICD9_CODE FROM DIAGNOSES_ICD').ICD9_CODE.tolist(), ['0389', '4280'])
+        self.assertEqual(list(self.db.read_sql('SELECT * FROM admissions').columns), ['SUBJECT_ID', 'HADM_ID'])
+        self.assertEqual(profiles.watermarks('JAX_textHpoProfile'), {'NoteHpoClinPhen': 4})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+import json
+import os
+import tempfile
+from mimic_mf_analysis.metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.metrics = Metrics()
+        self.jsonl_path = os.path.join(self.dir.name, 'metrics.jsonl')
+        self.prometheus_path = os.path.join(self.dir.name, 'metrics.prom')
+        self.metrics.configure(self.jsonl_path, self.prometheus_path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_timer_and_totals(self):
+        for rows in [10, 20]:
+            with self.metrics.timer('batch_query', diagnosis='428') as event:
+                event['rows'] = rows
+                event['bytes'] = 100
+        with self.metrics.timer('batch_query', diagnosis='584'):
+            pass
+        totals = {(total['stage'], total['labels']['diagnosis']): total for total in self.metrics.summary()}
+        self.assertEqual(totals[('batch_query', '428')]['calls'], 2)
+        self.assertEqual(totals[('batch_query', '428')]['rows'], 30)
+        self.assertEqual(totals[('batch_query', '428')]['bytes'], 200)
+        self.assertEqual(totals[('batch_query', '584')]['rows'], 0)
+        with open(self.jsonl_path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual(len(events), 3)
+        self.assertEqual(events[1]['rows'], 20)
+        self.assertEqual(events[1]['labels'], {'diagnosis': '428'})
+
+    def test_timed_and_prometheus(self):
+        @self.metrics.timed()
+        def rankICD():
+            return 1
+
+        self.assertEqual(rankICD(), 1)
+        self.metrics.write_prometheus()
+        with open(self.prometheus_path) as f:
+            lines = f.read().splitlines()
+        self.assertIn('# TYPE mimic_mf_stage_seconds_total counter', lines)
+        self.assertIn('mimic_mf_stage_calls_total{stage="rankICD"} 1', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
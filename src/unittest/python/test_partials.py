@@ -0,0 +1,63 @@
+import unittest
+import os
+import pickle
+import tempfile
+import numpy as np
+import mutual_information.mf as mf
+import mimic_mf_analysis.partials as partials
+
+
+class TestPartials(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.P1 = rng.integers(0, 2, size=[50, 3])
+        self.P2 = rng.integers(0, 2, size=[50, 4])
+        self.d = rng.integers(0, 2, size=50)
+
+    def summary(self, rows, X_names=('HP:1', 'HP:2', 'HP:3')):
+        summary = mf.SummaryXYz(list(X_names), ['HP:4', 'HP:5', 'HP:6', 'HP:7'], '428')
+        if len(rows) > 0:
+            summary.add_batch(self.P1[rows], self.P2[rows], self.d[rows])
+        return summary
+
+    def test_parse_shard(self):
+        self.assertEqual(partials.parse_shard('2/8'), (2, 8))
+        for text in ['0/8', '9/8', '2', 'a/b']:
+            with self.assertRaises(ValueError):
+                partials.parse_shard(text)
+
+    def test_shard_ranges_cover_encounters_once(self):
+        for n in [1, 3, 7, 20]:
+            ranges = [partials.shard_range(11, 27, (k, n)) for k in range(1, n + 1)]
+            row_ids = [row_id for first, last in ranges for row_id in range(first, last + 1)]
+            self.assertEqual(row_ids, list(range(11, 28)))
+
+    def test_merge_summaries(self):
+        merged = partials.merge_summaries([self.summary(np.arange(first - 1, last))
+                                           for first, last in [partials.shard_range(1, 50, (k, 3)) for k in [1, 2, 3]]])
+        full = self.summary(np.arange(50))
+        np.testing.assert_array_equal(merged.m2, full.m2)
+        np.testing.assert_array_equal(merged.m1['set1'], full.m1['set1'])
+        self.assertEqual((merged.case_N, merged.control_N), (full.case_N, full.control_N))
+
+        with self.assertRaises(ValueError):
+            partials.merge_summaries([self.summary(np.arange(25)),
+                                      self.summary(np.arange(25, 50), X_names=('HP:2', 'HP:1', 'HP:3'))])
+
+    def test_merge_shards(self):
+        with tempfile.TemporaryDirectory() as dir:
+            dirs = []
+            for k, rows in [(1, np.arange(20)), (2, np.arange(20, 50))]:
+                dirs.append(os.path.join(dir, str(k)))
+                os.mkdir(dirs[-1])
+                with open(os.path.join(dirs[-1], 'summaries_diag_rad_lab.obj'), 'wb') as f:
+                    pickle.dump({'428': self.summary(rows)}, f, protocol=2)
+                partials.write_manifest(dirs[-1], (k, 2), ['summaries_diag_rad_lab'], {'textHpo_threshold_min': 7})
+            merged = partials.merge_shards(dirs)['summaries_diag_rad_lab']['428']
+            np.testing.assert_array_equal(merged.m2, self.summary(np.arange(50)).m2)
+            with self.assertRaises(ValueError):
+                partials.merge_shards(dirs[:1])
+
+
+if __name__ == '__main__':
+    unittest.main()
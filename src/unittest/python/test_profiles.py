@@ -0,0 +1,57 @@
+import unittest
+from unittest import mock
+import pandas as pd
+import mimic_mf_analysis
+import mimic_mf_analysis.profiles as profiles
+from mimic_mf_analysis.backend import connect
+
+
+class TestRefreshProfiles(unittest.TestCase):
+    def setUp(self):
+        self.db = connect({'backend': 'sqlite'})
+        # the modules resolve the package connection when they use it, so no MySQL server is needed
+        patch = mock.patch.dict(vars(mimic_mf_analysis), {'db': self.db})
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.db.load_frame('LABEVENTS', pd.DataFrame({'ROW_ID': [1, 2, 3, 4, 5, 6],
+                                                      'SUBJECT_ID': [1, 1, 1, 2, 2, 3],
+                                                      'HADM_ID': [10, 10, 10, 20, 20, 30]}))
+        self.load_sources(pd.DataFrame({'ROW_ID': [1, 2, 3, 4], 'MAP_TO': ['HP:1', 'HP:1', 'HP:2', 'HP:1'],
+                                        'NEGATED': ['F', 'F', 'F', 'T']}),
+                          pd.DataFrame({'LABEVENT_ROW_ID': [1, 3], 'INFERRED_TO': ['HP:0', 'HP:0']}))
+
+    def load_sources(self, lab_hpo, inferred):
+        self.db.load_frame('LabHpo', lab_hpo)
+        self.db.load_frame('INFERRED_LABHPO', inferred)
+
+    def profile(self, table):
+        frame = self.db.read_sql('SELECT SUBJECT_ID, HADM_ID, MAP_TO, OCCURRANCE FROM {}'.format(table))
+        return sorted(map(tuple, frame.values.tolist()))
+
+    def test_incremental_refresh_matches_rebuild(self):
+        profiles.refresh_profile('JAX_labHpoProfile')
+        self.assertEqual(self.profile('JAX_labHpoProfile'), [(1, 10, 'HP:0', 2), (1, 10, 'HP:1', 2),
+                                                             (1, 10, 'HP:2', 1)])
+        self.assertEqual(profiles.watermarks('JAX_labHpoProfile'), {'LabHpo': 4, 'INFERRED_LABHPO': 3})
+
+        # phenotypes of new lab events
+        self.load_sources(pd.DataFrame({'ROW_ID': [1, 2, 3, 4, 5, 6], 'MAP_TO': ['HP:1', 'HP:1', 'HP:2', 'HP:1',
+                                                                                 'HP:1', 'HP:2'],
+                                        'NEGATED': ['F', 'F', 'F', 'T', 'F', 'F']}),
+                          pd.DataFrame({'LABEVENT_ROW_ID': [1, 3, 5, 6], 'INFERRED_TO': ['HP:0', 'HP:0', 'HP:0',
+                                                                                         'HP:0']}))
+        ranges = profiles.refresh_profile('JAX_labHpoProfile')
+        self.assertEqual(ranges, {'LabHpo': (4, 6), 'INFERRED_LABHPO': (3, 6)})
+        incremental = self.profile('JAX_labHpoProfile')
+        self.assertIn((2, 20, 'HP:1', 1), incremental)
+
+        profiles.refresh_profile('JAX_labHpoProfile', rebuild=True)
+        self.assertEqual(incremental, self.profile('JAX_labHpoProfile'))
+
+        # nothing new
+        self.assertEqual(profiles.refresh_profile('JAX_labHpoProfile'), {'LabHpo': (6, 6), 'INFERRED_LABHPO': (6, 6)})
+        self.assertEqual(incremental, self.profile('JAX_labHpoProfile'))
+
+
+if __name__ == '__main__':
+    unittest.main()
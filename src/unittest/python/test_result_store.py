@@ -0,0 +1,78 @@
+import unittest
+import tempfile
+import pathlib
+import pickle
+import numpy as np
+import mutual_information.mf as mf
+from mimic_mf_analysis.result_store import ResultStore, convert_pickle, load_results, compact
+
+
+class ResultStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        X = (rng.uniform(size=[200, 4]) < 0.3).astype(int)
+        Y = (rng.uniform(size=[200, 3]) < 0.4).astype(int)
+        d = (rng.uniform(size=200) < 0.2).astype(int)
+        self.summary = mf.SummaryXYz(['HP:1', 'HP:2', 'HP:3', 'HP:4'], ['HP:5', 'HP:6', 'HP:7'], '038')
+        self.summary.add_batch(X, Y, d)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir = pathlib.Path(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_summary_round_trip(self):
+        for compress in [False, True]:
+            store = ResultStore(self.dir.joinpath(str(compress)), create=True)
+            store.write_summary('summaries_diag_rad_lab', '038', self.summary, compress=compress)
+            loaded = ResultStore(self.dir.joinpath(str(compress))).read_summary('summaries_diag_rad_lab', '038')
+            self.assertTrue((loaded.m2 == self.summary.m2).all())
+            self.assertTrue((loaded.m1['set2'] == self.summary.m1['set2']).all())
+            self.assertEqual(loaded.case_N, self.summary.case_N)
+            self.assertEqual(list(loaded.vars_labels['set1']), ['HP:1', 'HP:2', 'HP:3', 'HP:4'])
+            self.assertTrue(np.allclose(mf.MutualInfoXYz(loaded).synergy_XY2z(),
+                                        mf.MutualInfoXYz(self.summary).synergy_XY2z()))
+
+    def test_compact_round_trip(self):
+        X = (np.random.default_rng(2).uniform(size=[300, 5]) < 0.05).astype(int)
+        summary_xy = mf.SummaryXY(['HP:1', 'HP:2', 'HP:3', 'HP:4', 'HP:5'], ['HP:1', 'HP:2', 'HP:3', 'HP:4', 'HP:5'])
+        summary_xy.add_batch(X, X)
+        store = ResultStore(self.dir, create=True)
+        store.write_summary('summaries_diag_rad_lab', '038', self.summary, compact=True)
+        store.write_summary('summary_rad_rad', 'all', summary_xy, compact=True)
+        # 200 encounters fit in uint8, and only ++ cells are stored
+        self.assertEqual(store.entry('summaries_diag_rad_lab', '038')['arrays']['pp'],
+                         {'shape': [4, 3, 2], 'dtype': 'uint8'})
+        loaded = store.read_summary('summaries_diag_rad_lab', '038')
+        np.testing.assert_array_equal(loaded.m2, self.summary.m2)
+        np.testing.assert_array_equal(loaded.m1['set1'], self.summary.m1['set1'])
+        self.assertEqual((loaded.case_N, loaded.control_N), (self.summary.case_N, self.summary.control_N))
+        np.testing.assert_array_equal(store.read_summary('summary_rad_rad', 'all').m, summary_xy.m)
+
+        # pickled compact summaries are rebuilt when unpickled
+        pickle_path = self.dir.joinpath('summaries.obj')
+        with open(pickle_path, 'wb') as f:
+            pickle.dump(compact({'038': self.summary, 'all': summary_xy}), f, protocol=2)
+        loaded = load_results(pickle_path)
+        np.testing.assert_array_equal(loaded['038'].m2, self.summary.m2)
+        np.testing.assert_array_equal(loaded['all'].m, summary_xy.m)
+        self.assertEqual(loaded['all'].N, 300)
+
+    def test_read_block(self):
+        store = ResultStore(self.dir, create=True)
+        store.write_summary('summaries_diag_rad_lab', '038', self.summary)
+        block = store.read_block('summaries_diag_rad_lab', '038', 'm2', slice(1, 3), slice(0, 2))
+        self.assertTrue((block == self.summary.m2[1:3, 0:2]).all())
+
+    def test_convert_pickle(self):
+        pickle_path = self.dir.joinpath('summaries_diag_rad_lab.obj')
+        with open(pickle_path, 'wb') as f:
+            pickle.dump({'038': self.summary}, f, protocol=2)
+        group = convert_pickle(pickle_path, self.dir.joinpath('store'))
+        summaries = load_results(self.dir.joinpath('store', group))
+        self.assertEqual(list(summaries), ['038'])
+        self.assertTrue((summaries['038'].m2 == self.summary.m2).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
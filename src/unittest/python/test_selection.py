@@ -0,0 +1,61 @@
+import unittest
+import numpy as np
+import mutual_information.mf as mf
+import mimic_mf_analysis.selection as selection
+
+
+def entropy(*columns):
+    _, counts = np.unique(np.stack(columns, axis=1), axis=0, return_counts=True)
+    p = counts / counts.sum()
+    return -np.sum(p * np.log2(p))
+
+
+class TestSelection(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.d = rng.integers(0, 2, size=500)
+        # HP:1 follows the diagnosis, HP:2 is noise; HP:4 copies HP:1, HP:5 follows the diagnosis less closely
+        self.P1 = rng.integers(0, 2, size=[500, 2])
+        self.P1[:, 0] = np.where(rng.uniform(size=500) < 0.9, self.d, 1 - self.d)
+        self.P2 = rng.integers(0, 2, size=[500, 2])
+        self.P2[:, 0] = self.P1[:, 0]
+        self.P2[:, 1] = np.where(rng.uniform(size=500) < 0.8, self.d, 1 - self.d)
+        summaries = []
+        for X, Y in [(self.P1, self.P2), (self.P1, self.P1), (self.P2, self.P2)]:
+            summary = mf.SummaryXYz(['HP:{}'.format(i) for i in range(X.shape[1])],
+                                    ['HP:{}'.format(i) for i in range(Y.shape[1])], '428')
+            summary.add_batch(X, Y, self.d)
+            summaries.append(summary)
+        # labels have to match within a source
+        summaries[0].vars_labels['set1'] = summaries[1].vars_labels['set1'] = summaries[1].vars_labels['set2'] = \
+            np.array(['HP:1', 'HP:2'])
+        summaries[0].vars_labels['set2'] = summaries[2].vars_labels['set1'] = summaries[2].vars_labels['set2'] = \
+            np.array(['HP:4', 'HP:5'])
+        self.tables = selection.PairTables(*summaries)
+        self.variables = np.concatenate([self.P1, self.P2], axis=1)
+
+    def test_mutual_information(self):
+        relevance = self.tables.relevance()
+        for j in range(4):
+            v = self.variables[:, j]
+            self.assertAlmostEqual(relevance[j], entropy(v) + entropy(self.d) - entropy(v, self.d))
+            pairwise, conditional = self.tables.redundancy(j)
+            for i in range(4):
+                u = self.variables[:, i]
+                self.assertAlmostEqual(pairwise[i], entropy(u) + entropy(v) - entropy(u, v))
+                self.assertAlmostEqual(conditional[i], entropy(u, self.d) + entropy(v, self.d) -
+                                       entropy(u, v, self.d) - entropy(self.d))
+
+    def test_select(self):
+        for criterion in selection.CRITERIA:
+            selected = selection.select(self.tables, 2, criterion)
+            # HP:4 is as relevant as HP:1 but adds nothing to it
+            self.assertEqual([(source, hpo) for source, hpo, _ in selected],
+                             [(selection.TEXT, 'HP:1'), (selection.LAB, 'HP:5')])
+        self.assertEqual(len(selection.select(self.tables, 10)), 4)
+        with self.assertRaises(ValueError):
+            selection.select(self.tables, 2, 'jmi')
+
+
+if __name__ == '__main__':
+    unittest.main()
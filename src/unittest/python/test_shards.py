@@ -0,0 +1,77 @@
+import unittest
+import os
+import pickle
+import tempfile
+import numpy as np
+import mutual_information.mf as mf
+import mimic_mf_analysis.shards as shards
+import mimic_mf_analysis.scheduler as scheduler
+
+
+class TestShards(unittest.TestCase):
+    def write_shards(self, dir):
+        rng = np.random.default_rng(2)
+        for job_id in range(3):
+            distribution = {'synergy': rng.normal(size=[2, 2, 10])}
+            path = os.path.join(dir, '428_{}_distribution.obj'.format(job_id))
+            with open(path, 'wb') as f:
+                pickle.dump(distribution, f, protocol=2)
+            shards.record_shard(dir, '428', job_id, path, 'distribution', job_id * 10, 10, distribution)
+
+    def test_load_distribution(self):
+        with tempfile.TemporaryDirectory() as dir:
+            self.write_shards(dir)
+            self.assertEqual(shards.load_distribution(dir, '428')['synergy'].shape, (2, 2, 30))
+
+            os.remove(os.path.join(dir, '428_1_distribution.obj'))
+            with open(os.path.join(dir, '428_2_distribution.obj'), 'ab') as f:
+                f.write(b'truncated')
+            contents, report = shards.load_shards(dir, '428')
+            self.assertEqual((report.missing, report.corrupt), (['428_1_distribution.obj'],
+                                                                ['428_2_distribution.obj']))
+            # a partial distribution is only used on request
+            with self.assertRaises(RuntimeError):
+                shards.load_distribution(dir, '428')
+            self.assertEqual(shards.load_distribution(dir, '428', strict=False)['synergy'].shape, (2, 2, 10))
+
+    def test_scheduler_and_simulate_shards(self):
+        rng = np.random.default_rng(4)
+        summary = mf.SummaryXYz(['HP:1', 'HP:2'], ['HP:3', 'HP:4'], '428')
+        summary.add_batch(rng.integers(0, 2, size=[100, 2]), rng.integers(0, 2, size=[100, 2]),
+                          rng.integers(0, 2, size=100))
+        plan = scheduler.plan_shards(6, 3, entropy=1)
+        with tempfile.TemporaryDirectory() as dir:
+            # simulate writes 428_0_distribution.obj; shard 0 of the scheduler must not replace it
+            self.write_shards(dir)
+            path = scheduler.run_shard(summary, '428', plan, plan['shards'][0], dir)
+            self.assertEqual(os.path.basename(path), '428_shard0_distribution.obj')
+            self.assertEqual(scheduler.completed_shards(plan, dir, '428', 'distribution'), {0})
+            self.assertEqual(shards.load_distribution(dir, '428')['synergy'].shape, (2, 2, 33))
+
+    def test_replanned_shards(self):
+        rng = np.random.default_rng(4)
+        summary = mf.SummaryXYz(['HP:1', 'HP:2'], ['HP:3', 'HP:4'], '428')
+        summary.add_batch(rng.integers(0, 2, size=[100, 2]), rng.integers(0, 2, size=[100, 2]),
+                          rng.integers(0, 2, size=100))
+        with tempfile.TemporaryDirectory() as dir:
+            old_plan = scheduler.plan_shards(8, 2, entropy=1)
+            for shard in old_plan['shards']:
+                scheduler.run_shard(summary, '428', old_plan, shard, dir)
+            # shards of another seed stream must not be mixed into the new plan
+            plan = scheduler.plan_shards(4, 2)
+            self.assertEqual(len(scheduler.discard_stale_shards(plan, dir, '428')), 4)
+            self.assertEqual(scheduler.completed_shards(plan, dir, '428', 'distribution'), set())
+            for shard in plan['shards']:
+                scheduler.run_shard(summary, '428', plan, shard, dir)
+            self.assertEqual(shards.load_distribution(dir, '428')['synergy'].shape, (2, 2, 4))
+
+            # fewer simulations with the same seed keep the shards that are still part of the plan
+            smaller_plan = scheduler.plan_shards(2, 2, entropy=plan['entropy'])
+            self.assertEqual(scheduler.discard_stale_shards(smaller_plan, dir, '428'),
+                             ['428_shard1_distribution.obj'])
+            self.assertEqual(scheduler.completed_shards(smaller_plan, dir, '428', 'distribution'), {0})
+            self.assertEqual(sorted(shards.read_manifest(dir, '428')), ['428_shard0_distribution.obj'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+import numpy as np
+import mutual_information.mf as mf
+from mutual_information.mf_random import p_value_estimate
+from mimic_mf_analysis.simulation import ExceedanceCounter, simulate_counts, simulate_sequential, wilson_interval, \
+    _at_least_two
+
+
+class ExceedanceCounterTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.observed = {'synergy': np.array([[0.0, 0.5], [-0.5, 2.0]]), 'mf_Xz': np.array([0.1, 0.9])}
+        self.simulations = [{'synergy': rng.normal(size=[2, 2]), 'mf_Xz': rng.uniform(size=2)} for i in range(200)]
+
+    def test_counts_match_full_distribution(self):
+        counter = ExceedanceCounter(self.observed)
+        for simulation in self.simulations:
+            counter.add(simulation)
+        distribution = np.stack([simulation['synergy'] for simulation in self.simulations], axis=-1)
+        ge = np.sum(distribution >= self.observed['synergy'][:, :, np.newaxis], axis=-1)
+        le = np.sum(distribution <= self.observed['synergy'][:, :, np.newaxis], axis=-1)
+        self.assertTrue((counter.ge['synergy'] == ge).all())
+        self.assertTrue((counter.le['synergy'] == le).all())
+        p = counter.p_values()
+        self.assertTrue(np.allclose(p['synergy'], np.minimum(2 * np.minimum(ge, le) / 200, 1)))
+        self.assertTrue(np.allclose(counter.mean()['synergy'], np.mean(distribution, axis=-1)))
+
+    def test_p_values_match_library(self):
+        counter = ExceedanceCounter(self.observed)
+        for simulation in self.simulations:
+            counter.add(simulation)
+        distribution = np.stack([simulation['synergy'] for simulation in self.simulations], axis=-1)
+        for alternative in ['left', 'right']:
+            self.assertTrue(np.allclose(counter.p_values(alternative)['synergy'],
+                                        p_value_estimate(self.observed['synergy'], distribution, alternative)))
+
+        # the two-sided definitions agree on a null distribution that is symmetric around its mean
+        symmetric = ExceedanceCounter(self.observed)
+        for simulation in self.simulations:
+            symmetric.add(simulation)
+            symmetric.add({key: -value for key, value in simulation.items()})
+        distribution = np.concatenate([distribution, -distribution], axis=-1)
+        self.assertTrue(np.allclose(symmetric.p_values()['synergy'],
+                                    p_value_estimate(self.observed['synergy'], distribution)))
+
+    def test_merge_equals_single_counter(self):
+        single = ExceedanceCounter(self.observed, reservoir_size=10)
+        first = ExceedanceCounter(self.observed, reservoir_size=10)
+        second = ExceedanceCounter(self.observed, reservoir_size=10)
+        for i, simulation in enumerate(self.simulations):
+            single.add(simulation)
+            (first if i < 50 else second).add(simulation)
+        merged = first.merge(second)
+        for key in self.observed:
+            self.assertTrue((merged.n[key] == single.n[key]).all())
+            self.assertTrue((merged.ge[key] == single.ge[key]).all())
+            self.assertTrue((merged.le[key] == single.le[key]).all())
+        # every value kept in the merged reservoir is one of the simulated values
+        simulated = np.stack([simulation['synergy'] for simulation in self.simulations], axis=-1)
+        reservoir = merged.reservoir_samples('synergy')
+        self.assertEqual(reservoir.shape, (2, 2, 10))
+        for i in range(2):
+            for j in range(2):
+                self.assertTrue(np.isin(reservoir[i, j], simulated[i, j]).all())
+
+    def test_mask(self):
+        counter = ExceedanceCounter(self.observed)
+        mask = {'synergy': np.array([[True, False], [False, False]]), 'mf_Xz': np.array([True, True])}
+        counter.add(self.simulations[0], mask=mask)
+        self.assertTrue((counter.n['synergy'] == mask['synergy']).all())
+        self.assertTrue(np.isnan(counter.p_values()['synergy'][1, 1]))
+
+
+class SequentialTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        P1 = rng.integers(0, 2, size=[400, 2])
+        P2 = rng.integers(0, 2, size=[400, 2])
+        # the diagnosis is the exclusive or of HP:1 and HP:3, a strongly synergistic pair; the other pairs are null
+        d = np.where(rng.uniform(size=400) < 0.9, P1[:, 0] ^ P2[:, 0], 1 - (P1[:, 0] ^ P2[:, 0]))
+        self.summary = mf.SummaryXYz(['HP:1', 'HP:2'], ['HP:3', 'HP:4'], '428')
+        self.summary.add_batch(P1, P2, d)
+
+    def test_stops_early(self):
+        counter = simulate_sequential(self.summary, max_simulations=100, batch_size=50, cpu=1)
+        n = counter.n['synergy']
+        self.assertTrue((n <= 100).all())
+        self.assertGreater(len(np.unique(n)), 1)
+        # the synergistic pair is still undecided after 100 simulations, the null pairs stop after the first round
+        self.assertEqual(n[0, 0], 100)
+        self.assertEqual(n[1, 1], 50)
+        self.assertLess(counter.p_values()['synergy'][0, 0], 0.05)
+
+        # with two phenotypes per set every round simulates all of them, with the seeds of simulate_counts, so each
+        # pair has the counts of a fixed number of simulations
+        p = counter.p_values()['synergy']
+        for simulations in np.unique(n):
+            fixed = simulate_counts(self.summary, simulations=int(simulations), cpu=1).p_values()['synergy']
+            self.assertTrue(np.allclose(p[n == simulations], fixed[n == simulations]))
+
+    def test_helpers(self):
+        lower, upper = wilson_interval(np.array([0, 5, 0]), np.array([100, 10, 0]))
+        self.assertAlmostEqual(lower[0], 0)
+        self.assertTrue(0 < upper[0] < 0.1)
+        self.assertTrue(lower[1] < 0.5 < upper[1])
+        self.assertEqual((lower[2], upper[2]), (0, 1))
+        self.assertEqual(_at_least_two(np.array([False, True, False])).tolist(), [True, True, False])
+        with self.assertRaises(ValueError):
+            simulate_sequential(self.summary, statistic='mf_Xz')
+
+
+if __name__ == '__main__':
+    unittest.main()
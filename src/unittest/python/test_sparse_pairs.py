@@ -0,0 +1,50 @@
+import unittest
+import tempfile
+import numpy as np
+import mutual_information.mf as mf
+from mimic_mf_analysis.sparse_pairs import SparseSummaryXYz, positive_matrix
+from mimic_mf_analysis.result_store import ResultStore
+
+
+class SparsePairsTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        X = (rng.uniform(size=[3000, 6]) < 0.2).astype(int)
+        Y = (rng.uniform(size=[3000, 5]) < 0.3).astype(int)
+        d = (rng.uniform(size=3000) < 0.25).astype(int)
+        self.dense = mf.SummaryXYz(list('abcdef'), list('ghijk'), '038')
+        self.sparse = SparseSummaryXYz(list('abcdef'), list('ghijk'), '038')
+        for i in range(0, 3000, 700):
+            self.dense.add_batch(X[i:i + 700], Y[i:i + 700], d[i:i + 700])
+            self.sparse.add_batch(X[i:i + 700], Y[i:i + 700], d[i:i + 700])
+
+    def test_same_as_dense(self):
+        self.assertTrue((self.sparse.m1['set1'] == self.dense.m1['set1']).all())
+        rows, cols, cells = self.sparse.m2()
+        self.assertEqual(len(rows), 30)
+        self.assertTrue((cells == self.dense.m2[rows, cols]).all())
+        rows, cols, statistics = self.sparse.mutual_info()
+        self.assertTrue(np.allclose(statistics['synergy'], mf.MutualInfoXYz(self.dense).synergy_XY2z()[rows, cols]))
+
+    def test_prune(self):
+        self.sparse.prune(120)
+        rows, cols, cells = self.sparse.m2()
+        support = self.dense.m2[..., 0:2].sum(axis=-1)
+        self.assertEqual(len(rows), np.sum(support >= 120))
+        self.assertTrue((cells == self.dense.m2[rows, cols]).all())
+
+    def test_result_store(self):
+        self.sparse.prune(120)
+        with tempfile.TemporaryDirectory() as dir:
+            ResultStore(dir, create=True).write_summary('sparse_summaries_diag_rad_lab', '038', self.sparse)
+            loaded = ResultStore(dir).read_summary('sparse_summaries_diag_rad_lab', '038')
+        self.assertTrue((loaded.m2()[2] == self.sparse.m2()[2]).all())
+
+    def test_positive_matrix(self):
+        matrix = positive_matrix([5, 5, 7, 9], ['a', 'a', 'b', 'c'], 5, 10, {'a': 0, 'b': 1})
+        self.assertEqual(matrix.shape, (6, 2))
+        self.assertEqual(matrix.toarray().tolist(), [[1, 0], [0, 0], [0, 1], [0, 0], [0, 0], [0, 0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import time
+from unittest import mock
+import numpy as np
+import pandas as pd
+import mutual_information.mf as mf
+import mimic_mf_analysis.synergy_trees as synergy_trees
+
+
+class TestSynergyTrees(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        self.d = rng.integers(0, 2, size=400)
+        # HP:2 and HP:5 follow the diagnosis, the other phenotypes are noise
+        self.P1 = rng.integers(0, 2, size=[400, 3])
+        self.P1[:, 1] = np.where(rng.uniform(size=400) < 0.9, self.d, 1 - self.d)
+        self.P2 = rng.integers(0, 2, size=[400, 2])
+        self.P2[:, 1] = np.where(rng.uniform(size=400) < 0.7, self.d, 1 - self.d)
+
+    def test_top_phenotypes(self):
+        summary = mf.SummaryXYz(['HP:1', 'HP:2', 'HP:3'], ['HP:4', 'HP:5'], '428')
+        summary.add_batch(self.P1, self.P2, self.d)
+        self.assertEqual(synergy_trees.top_phenotypes(summary, 1, 1), (['HP:2'], ['HP:5']))
+        self.assertEqual(synergy_trees.top_phenotypes(summary, 3, 0)[0][0], 'HP:2')
+
+    def test_build_tree(self):
+        frame = pd.DataFrame({'V1': self.P2[:, 1], 'V2': self.P1[:, 1], 'V3': self.P1[:, 0], 'DIAGNOSIS': self.d})
+        counts = frame.groupby(['V1', 'V2', 'V3', 'DIAGNOSIS'], as_index=False).size().rename(columns={'size': 'N'})
+        var_dict = {'V1': ('LabHpo', 'HP:5'), 'V2': ('TextHpo', 'HP:2'), 'V3': ('TextHpo', 'HP:1')}
+
+        summary = mf.SummaryXYz(['HP:2'], ['HP:5'], '428')
+        summary.add_batch(self.P1[:, 1:2], self.P2[:, 1:2], self.d)
+        self.assertAlmostEqual(synergy_trees.subset_mf(counts, ('V2',)), mf.MutualInfoXYz(summary).mutual_info_Xz()[0])
+
+        tree = synergy_trees.build_tree('428', var_dict, counts)
+        self.assertEqual((tree['encounters'], tree['cases']), (400, int(self.d.sum())))
+        root = tree['tree']
+        self.assertEqual(root['variables'], ['V1', 'V2', 'V3'])
+        leaves = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node['children'])
+            if not node['children']:
+                self.assertIsNone(node['synergy'])
+                leaves.extend(node['phenotypes'])
+        self.assertEqual(sorted(leave['hpo'] for leave in leaves), ['HP:1', 'HP:2', 'HP:5'])
+
+    def test_build_trees(self):
+        frame = pd.DataFrame({'V1': self.P2[:, 1], 'V2': self.P1[:, 1], 'DIAGNOSIS': self.d})
+        counts = frame.groupby(['V1', 'V2', 'DIAGNOSIS'], as_index=False).size().rename(columns={'size': 'N'})
+        var_dict = {'V1': ('LabHpo', 'HP:5'), 'V2': ('TextHpo', 'HP:2')}
+        counted = []
+
+        def profile_counts(diagnosis, *args):
+            counted.append(diagnosis)
+            # give the pool time to build the trees counted before
+            time.sleep(0.5)
+            if diagnosis == '038':
+                return var_dict, counts.drop(columns='N')
+            return var_dict, counts
+
+        with mock.patch.object(synergy_trees, 'select_phenotypes', return_value=(['HP:2'], ['HP:5'])), \
+                mock.patch.object(synergy_trees, 'profile_counts', profile_counts), \
+                self.assertLogs('mimic_mf_analysis.synergy_trees', level='ERROR') as logs:
+            trees = synergy_trees.build_trees(None, ['428', '038', '584'], 1, 1, False, 1, 1, cpu=2)
+            disease, tree = next(trees)
+            # the first tree comes before the last disease is counted
+            self.assertEqual((disease, counted), ('428', ['428', '038']))
+            self.assertEqual([disease for disease, _ in trees], ['584'])
+        # a failing tree is logged and does not stop the others
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('038', logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()